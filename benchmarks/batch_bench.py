@@ -0,0 +1,44 @@
+"""1メッセージずつの評価と FilterEngine.match_batch(100件ずつ)の処理時間を比較する
+
+実行: python -m benchmarks.batch_bench [メッセージ数]
+"""
+
+import random
+import sys
+import time
+
+from benchmarks.filter_bench import RULE, make_message
+from del_spam.filter import FilterEngine
+
+PAGE_SIZE = 100
+
+
+def main(count: int = 1_000_000) -> None:
+    engine = FilterEngine()
+    engine.load_rule("bench", RULE)
+    rng = random.Random(0)
+    pages = [
+        [make_message(rng) for _ in range(min(PAGE_SIZE, count - start))]
+        for start in range(0, count, PAGE_SIZE)
+    ]
+
+    start = time.perf_counter()
+    per_message = [engine.matches_rule("bench", m) for page in pages for m in page]
+    per_message_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = [flag for page in pages for flag in engine.match_batch("bench", page)]
+    batch_time = time.perf_counter() - start
+
+    assert per_message == batched
+
+    print(f"messages:         {count} ({sum(per_message)} matched)")
+    print(
+        f"per message:      {per_message_time:.2f}s ({count / per_message_time:,.0f} msg/s)"
+    )
+    print(f"match_batch:      {batch_time:.2f}s ({count / batch_time:,.0f} msg/s)")
+    print(f"speedup:          {per_message_time / batch_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
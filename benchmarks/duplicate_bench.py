@@ -0,0 +1,212 @@
+"""duplicate フィルターの検出漏れ・誤検出と、1メッセージあたりの処理時間を計測する
+
+多数のチャンネルに届く通常のメッセージに、同じ本文を表記を変えて数十秒のうちに
+複数チャンネルへ投稿するスパムの波を混ぜる。常駐モードと同じく時刻順に1件ずつ
+評価する場合と、履歴の走査と同じくチャンネルごとに新しい順の100件のページを
+チャンネルを入れ替えながら評価する場合を、content フィルターだけのルールと比べる。
+
+実行: python -m benchmarks.duplicate_bench [メッセージ数]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from loguru import logger
+
+from benchmarks.fake_discord import WORDS, FakeMessage, FakeRef, _snowflake
+from del_spam.filter import FilterEngine
+
+CHANNELS = 50
+# 全チャンネル合計の1秒あたりのメッセージ数
+RATE = 200.0
+WAVE_EVERY = 2_000
+WAVE_COPIES = 12
+WAVE_SECONDS = 30.0
+PAGE_SIZE = 100
+
+DUPLICATE_RULE = {
+    "enabled": True,
+    "conditions": {
+        "operator": "AND",
+        "filters": [
+            {
+                "type": "duplicate",
+                "operator": "AT_LEAST",
+                "copies": 3,
+                "within": 60,
+                "channels": 2,
+            }
+        ],
+    },
+}
+CONTENT_RULE = {
+    "enabled": True,
+    "conditions": {
+        "operator": "AND",
+        "filters": [{"type": "content", "operator": "CONTAINS", "values": ["nitro"]}],
+    },
+}
+
+
+def _vary(rng: random.Random, text: str) -> str:
+    """大文字・小文字、空白、記号、メンションを変えた同じ本文"""
+    words = [w.upper() if rng.random() < 0.3 else w for w in text.split()]
+    mention = f"<@{rng.randrange(10**17, 10**18)}>"
+    return f"{mention} {'  '.join(words)}{'!' * rng.randrange(4)}"
+
+
+def make_stream(count: int, seed: int = 0) -> list[FakeMessage]:
+    """時刻順のメッセージを返す"""
+    rng = random.Random(seed)
+    guild = FakeRef(1, "guild")
+    channels = [FakeRef(1000 + c, f"channel-{c}") for c in range(CHANNELS)]
+    author = FakeRef(1, "user")
+    now_ms = 1_700_000_000_000
+    events: list[tuple[int, FakeRef, str, int]] = []
+    for n in range(count):
+        now_ms += int(rng.expovariate(RATE) * 1000)
+        text = " ".join(rng.choices(WORDS, k=rng.randint(3, 12))) + f" {n}"
+        events.append((now_ms, rng.choice(channels), text, -1))
+        if n % WAVE_EVERY == WAVE_EVERY // 2:
+            spam = f"free nitro giveaway {n} claim now discord.gift/{n}"
+            for copy in range(WAVE_COPIES):
+                offset = int(rng.uniform(0, WAVE_SECONDS) * 1000)
+                events.append((now_ms + offset, rng.choice(channels), spam, n))
+    events.sort(key=lambda e: e[0])
+
+    messages = []
+    for sequence, (ms, channel, text, wave) in enumerate(events):
+        content = _vary(rng, text) if wave >= 0 else text
+        messages.append(
+            FakeMessage(_snowflake(ms, sequence), guild, channel, author, content)
+        )
+    return messages
+
+
+def scan_order(messages: list[FakeMessage]) -> list[list[FakeMessage]]:
+    """チャンネルごとに新しい順の100件のページを、チャンネルを入れ替えながら並べる"""
+    by_channel: dict[int, list[FakeMessage]] = {}
+    for message in reversed(messages):
+        by_channel.setdefault(message.channel.id, []).append(message)
+    pages_by_channel = [
+        [ms[i : i + PAGE_SIZE] for i in range(0, len(ms), PAGE_SIZE)]
+        for ms in by_channel.values()
+    ]
+    pages = []
+    for round_ in range(max(len(p) for p in pages_by_channel)):
+        pages.extend(p[round_] for p in pages_by_channel if round_ < len(p))
+    return pages
+
+
+def _engine(rule: dict) -> FilterEngine:
+    engine = FilterEngine()
+    engine.load_all_rules({"bench": rule})
+    return engine
+
+
+def check_out_of_order() -> None:
+    """作成時刻の順に届かない投稿でも、窓の幅を超える組を一致にしないことを確かめる
+
+    履歴の走査では、T、T+59秒、T-59秒のように同じ本文が前後して届く。3件は 118 秒に
+    わたるので、within=60 の条件には一致しない。T、T+30秒、T-29秒なら 59 秒に収まる。
+    """
+    rule = {
+        "enabled": True,
+        "conditions": {
+            "filters": [
+                {
+                    "type": "duplicate",
+                    "operator": "AT_LEAST",
+                    "copies": 3,
+                    "within": 60,
+                    "channels": 3,
+                }
+            ]
+        },
+    }
+    guild = FakeRef(1, "guild")
+    author = FakeRef(1, "user")
+    start_ms = 1_700_000_000_000
+    for offsets, expected in (((0, 59, -59), False), ((0, 30, -29), True)):
+        engine = _engine(rule)
+        page = [
+            FakeMessage(
+                _snowflake(start_ms + offset * 1000, c),
+                guild,
+                FakeRef(1000 + c, f"channel-{c}"),
+                author,
+                "free nitro",
+            )
+            for c, offset in enumerate(offsets)
+        ]
+        matched = set()
+        for message in page:
+            # チャンネルごとのページとして1件ずつ届く
+            if engine.match_rules_batch(["bench"], [message])[0]:
+                matched.add(message.id)
+            matched.update(m.id for m, _ in engine.take_duplicate_matches(["bench"]))
+        found = matched == {m.id for m in page}
+        assert found == expected and (found or not matched), (offsets, matched)
+
+
+def _index_size(engine: FilterEngine) -> int:
+    return sum(len(index) for index in engine.duplicates.values())
+
+
+def run_live(rule: dict, messages: list[FakeMessage]) -> tuple[set[int], float, int]:
+    engine = _engine(rule)
+    matched: set[int] = set()
+    start = time.perf_counter()
+    for message in messages:
+        if engine.get_matching_rules(message):
+            matched.add(message.id)
+        # しきい値に達する前に届いた同じ波の投稿
+        matched.update(m.id for m, _ in engine.take_duplicate_matches())
+    return matched, time.perf_counter() - start, _index_size(engine)
+
+
+def run_scan(rule: dict, pages: list[list[FakeMessage]]) -> tuple[set[int], float, int]:
+    engine = _engine(rule)
+    matched: set[int] = set()
+    start = time.perf_counter()
+    for page in pages:
+        for message, rules in zip(page, engine.match_rules_batch(["bench"], page)):
+            if rules:
+                matched.add(message.id)
+        matched.update(m.id for m, _ in engine.take_duplicate_matches(["bench"]))
+    return matched, time.perf_counter() - start, _index_size(engine)
+
+
+def main(count: int = 200_000) -> None:
+    logger.remove()
+    check_out_of_order()
+    messages = make_stream(count)
+    spam = {m.id for m in messages if "nitro" in m.content.lower()}
+    pages = scan_order(messages)
+    print(f"messages: {len(messages)}, spam: {len(spam)}")
+    print(
+        f"{'mode':<6}{'rule':<11}{'us/msg':>8}{'matched':>9}{'spam':>7}"
+        f"{'false+':>8}{'index':>8}{'peak MB':>9}"
+    )
+    for mode, run, data in (("live", run_live, messages), ("scan", run_scan, pages)):
+        for name, rule in (("content", CONTENT_RULE), ("duplicate", DUPLICATE_RULE)):
+            matched, elapsed, index_size = run(rule, data)
+            # tracemalloc は割り当てを遅くするので、メモリは別に実行して測る
+            tracemalloc.start()
+            run(rule, data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f"{mode:<6}{name:<11}{elapsed / len(messages) * 1e6:>8.2f}"
+                f"{len(matched):>9}{len(matched & spam):>7}"
+                f"{len(matched - spam):>8}{index_size:>8}{peak / 2**20:>9.1f}"
+            )
+            if name == "duplicate":
+                # 波のすべての投稿(しきい値に達する前のものも含む)を検出し、ほかは一致しない
+                assert matched == spam, (mode, len(matched & spam), len(matched - spam))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
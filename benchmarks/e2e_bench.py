@@ -0,0 +1,147 @@
+"""偽の Discord(benchmarks/fake_discord.py)に対して MessageDeleter を端から端まで動かし、
+メッセージ処理数/秒・削除数/秒・ピークメモリを計測する
+
+乱数のシードは固定なので、同じシナリオは毎回同じメッセージで実行される。
+ピークメモリは tracemalloc で計るため、処理速度はその分だけ遅く出る。
+
+実行: python -m benchmarks.e2e_bench [シナリオ名 ...]
+"""
+
+import asyncio
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+from loguru import logger
+
+from benchmarks.fake_discord import (
+    SPAM_PHRASES,
+    BackendProfile,
+    MessageProfile,
+    build_client,
+    install_config,
+)
+
+RULE = {
+    "enabled": True,
+    "conditions": {
+        "operator": "AND",
+        "filters": [
+            {"type": "content", "operator": "CONTAINS", "values": SPAM_PHRASES},
+        ],
+    },
+}
+
+
+@dataclass
+class Scenario:
+    name: str
+    messages: MessageProfile
+    backend: BackendProfile
+    dry_run: bool = False
+
+
+SCENARIOS = [
+    Scenario(
+        "scan-only",
+        MessageProfile(channels_per_guild=20, messages_per_channel=5_000),
+        BackendProfile(),
+        dry_run=True,
+    ),
+    # 1チャンネルの大きさだけを変え、ピークメモリが件数によらず一定であることを確かめる
+    Scenario(
+        "channel-10k",
+        MessageProfile(channels_per_guild=1, messages_per_channel=10_000),
+        BackendProfile(),
+        dry_run=True,
+    ),
+    Scenario(
+        "channel-300k",
+        MessageProfile(channels_per_guild=1, messages_per_channel=300_000),
+        BackendProfile(),
+        dry_run=True,
+    ),
+    Scenario(
+        "recent-spam",
+        MessageProfile(
+            channels_per_guild=10, messages_per_channel=5_000, max_age_days=7
+        ),
+        BackendProfile(latency=0.005),
+    ),
+    Scenario(
+        "mixed-age",
+        MessageProfile(
+            channels_per_guild=5, messages_per_channel=2_000, spam_ratio=0.05
+        ),
+        BackendProfile(latency=0.005),
+    ),
+    Scenario(
+        "rate-limited",
+        MessageProfile(
+            channels_per_guild=10, messages_per_channel=3_000, max_age_days=7
+        ),
+        BackendProfile(latency=0.005, rate_limit_every=5, retry_after=0.05),
+    ),
+]
+
+
+def run(scenario: Scenario, seed: int = 0) -> dict:
+    if "del_spam.config" not in sys.modules:
+        install_config()
+    from del_spam.deleter import MessageDeleter
+    from del_spam.filter import FilterEngine
+
+    client, spam = build_client(scenario.messages, scenario.backend, seed)
+    total = client.message_count
+    engine = FilterEngine()
+    engine.load_rule("spam", RULE)
+    deleter = MessageDeleter(engine)
+    deleter.dry_run = scenario.dry_run
+
+    # 偽のサーバーが持つメッセージを除いた、削除処理が使ったメモリだけを計る
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    deleted = asyncio.run(deleter.delete_by_rule(client, "spam"))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    stats = client.backend.stats
+    return {
+        "scenario": scenario.name,
+        "messages": total,
+        "spam": spam,
+        "deleted": deleted,
+        "seconds": elapsed,
+        "messages_per_sec": total / elapsed,
+        "deletes_per_sec": stats.deleted / elapsed,
+        "peak_mib": peak / 2**20,
+        "history_requests": stats.history_requests,
+        "delete_requests": stats.delete_requests,
+        "rate_limited": stats.rate_limited,
+    }
+
+
+def main(names: list[str]) -> None:
+    logger.remove()
+    install_config()
+    scenarios = [s for s in SCENARIOS if not names or s.name in names]
+    print(
+        f"{'scenario':<14}{'messages':>10}{'deleted':>9}{'seconds':>9}"
+        f"{'msg/s':>11}{'del/s':>9}{'peak MiB':>10}{'req':>7}{'429':>6}"
+    )
+    for scenario in scenarios:
+        r = run(scenario)
+        print(
+            f"{r['scenario']:<14}{r['messages']:>10}{r['deleted']:>9}"
+            f"{r['seconds']:>9.2f}{r['messages_per_sec']:>11,.0f}"
+            f"{r['deletes_per_sec']:>9,.0f}{r['peak_mib']:>10.1f}"
+            f"{r['history_requests'] + r['delete_requests']:>7}{r['rate_limited']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
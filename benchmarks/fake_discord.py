@@ -0,0 +1,301 @@
+"""ベンチマーク用の Discord の代替(Bot トークンや実際のサーバーなしで削除処理を動かす)
+
+MessageDeleter が使う Client.guilds / Guild.text_channels / TextChannel.history /
+delete_messages などだけを、設定可能な遅延・429 応答・合成メッセージで再現する。
+"""
+
+import asyncio
+import random
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from types import ModuleType
+from typing import AsyncIterator, Optional
+
+import discord
+
+from del_spam import sample_config
+from del_spam.snowflake import BULK_DELETE_MAX_AGE_MS, DISCORD_EPOCH_MS
+
+SPAM_PHRASES = ["free nitro", "discord.gift/abc", "claim your airdrop", "@everyone"]
+WORDS = ["hello", "meeting", "tomorrow", "thanks", "lunch", "merge", "review", "ok"]
+
+
+@dataclass
+class MessageProfile:
+    """合成するメッセージの分布"""
+
+    guilds: int = 1
+    channels_per_guild: int = 10
+    messages_per_channel: int = 2_000
+    spam_ratio: float = 0.1
+    max_age_days: float = 30.0
+    min_words: int = 3
+    max_words: int = 30
+    authors: int = 500
+
+
+@dataclass
+class BackendProfile:
+    """API 呼び出しの遅延とレート制限の再現方法"""
+
+    # 履歴1ページ(100件)や削除1回あたりの遅延(秒)
+    latency: float = 0.0
+    # 削除 API の N 回に1回を 429 にする(0 なら発生させない)
+    rate_limit_every: int = 0
+    retry_after: float = 0.05
+
+
+@dataclass
+class BackendStats:
+    history_requests: int = 0
+    delete_requests: int = 0
+    rate_limited: int = 0
+    deleted: int = 0
+
+
+class FakeResponse:
+    def __init__(self, status: int, reason: str, headers: Optional[dict] = None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class FakeRef:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: int, name: str = ""):
+        self.id = id
+        self.name = name
+
+
+class FakeMessage:
+    __slots__ = ("id", "guild", "channel", "author", "content")
+
+    def __init__(self, id, guild, channel, author, content):
+        self.id = id
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+    @property
+    def created_at(self) -> datetime:
+        ms = (self.id >> 22) + DISCORD_EPOCH_MS
+        return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def _snowflake(ms: int, sequence: int) -> int:
+    return ((ms - DISCORD_EPOCH_MS) << 22) | (sequence & 0x3FFFFF)
+
+
+class FakeBackend:
+    def __init__(self, profile: BackendProfile):
+        self.profile = profile
+        self.stats = BackendStats()
+        self._calls = 0
+
+    async def request(self) -> None:
+        if self.profile.latency:
+            await asyncio.sleep(self.profile.latency)
+
+    async def mutate(self) -> None:
+        """削除 API の呼び出し(設定に応じて 429 を返す)"""
+        await self.request()
+        self._calls += 1
+        every = self.profile.rate_limit_every
+        if every and self._calls % every == 0:
+            self.stats.rate_limited += 1
+            response = FakeResponse(
+                429,
+                "Too Many Requests",
+                {"Retry-After": str(self.profile.retry_after)},
+            )
+            raise discord.HTTPException(response, "You are being rate limited.")
+
+
+class FakeTextChannel:
+    def __init__(self, backend: FakeBackend, guild: "FakeGuild", id: int):
+        self.backend = backend
+        self.guild = guild
+        self.id = id
+        self.name = f"channel-{id}"
+        # ID の昇順
+        self._ids: list[int] = []
+        self._messages: dict[int, FakeMessage] = {}
+
+    def add(self, message: FakeMessage) -> None:
+        self._messages[message.id] = message
+
+    def finalize(self) -> None:
+        self._ids = sorted(self._messages)
+
+    @property
+    def message_count(self) -> int:
+        return len(self._messages)
+
+    async def history(
+        self,
+        limit: Optional[int] = 100,
+        before=None,
+        after=None,
+        oldest_first: Optional[bool] = None,
+    ) -> AsyncIterator[FakeMessage]:
+        low = 0 if after is None else bisect_right(self._ids, after.id)
+        high = len(self._ids) if before is None else bisect_left(self._ids, before.id)
+        # 大きなチャンネルで ID のリストを複製しないよう、位置だけを辿る
+        positions = range(low, high) if oldest_first else range(high - 1, low - 1, -1)
+        if limit is not None:
+            positions = positions[:limit]
+
+        yielded = 0
+        for position in positions:
+            message = self._messages.get(self._ids[position])
+            if message is None:
+                continue
+            if yielded % 100 == 0:
+                self.backend.stats.history_requests += 1
+                await self.backend.request()
+            yielded += 1
+            yield message
+
+    async def fetch_message(self, id: int) -> FakeMessage:
+        await self.backend.request()
+        message = self._messages.get(id)
+        if message is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        return message
+
+    async def delete_messages(self, messages) -> None:
+        ids = [m.id for m in messages]
+        self.backend.stats.delete_requests += 1
+        await self.backend.mutate()
+        if not 2 <= len(ids) <= 100:
+            raise discord.HTTPException(FakeResponse(400, "Bad Request"), "Bad batch")
+        oldest_ms = int(time.time() * 1000) - BULK_DELETE_MAX_AGE_MS
+        if any((i >> 22) + DISCORD_EPOCH_MS < oldest_ms for i in ids):
+            raise discord.HTTPException(
+                FakeResponse(400, "Bad Request"),
+                {
+                    "code": 50034,
+                    "message": "You can only bulk delete messages that are under "
+                    "14 days old.",
+                },
+            )
+        for message_id in ids:
+            if self._messages.pop(message_id, None) is not None:
+                self.backend.stats.deleted += 1
+
+    def get_partial_message(self, id: int) -> "FakePartialMessage":
+        return FakePartialMessage(self, id)
+
+
+class FakePartialMessage:
+    def __init__(self, channel: FakeTextChannel, id: int):
+        self.channel = channel
+        self.id = id
+
+    async def delete(self) -> None:
+        channel = self.channel
+        channel.backend.stats.delete_requests += 1
+        await channel.backend.mutate()
+        if channel._messages.pop(self.id, None) is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        channel.backend.stats.deleted += 1
+
+
+@dataclass
+class FakeGuild:
+    id: int
+    name: str
+    text_channels: list[FakeTextChannel] = field(default_factory=list)
+    members: list = field(default_factory=list)
+    chunked: bool = True
+
+
+class FakeClient:
+    def __init__(self, guilds: list[FakeGuild], backend: FakeBackend):
+        self.guilds = guilds
+        self.backend = backend
+
+    @property
+    def message_count(self) -> int:
+        return sum(c.message_count for g in self.guilds for c in g.text_channels)
+
+    def get_channel(self, id: int) -> Optional[FakeTextChannel]:
+        # REST だけのクライアントと同じく、キャッシュからは取得できないことにする
+        return None
+
+    async def fetch_channel(self, id: int) -> FakeTextChannel:
+        await self.backend.request()
+        for guild in self.guilds:
+            for channel in guild.text_channels:
+                if channel.id == id:
+                    return channel
+        raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Channel")
+
+
+def build_client(
+    profile: MessageProfile, backend_profile: BackendProfile, seed: int = 0
+) -> tuple[FakeClient, int]:
+    """合成メッセージを持つクライアントと、その中のスパムの件数を返す"""
+    rng = random.Random(seed)
+    backend = FakeBackend(backend_profile)
+    now_ms = int(time.time() * 1000)
+    max_age_ms = int(profile.max_age_days * 86_400_000)
+    authors = [FakeRef(i, f"user{i}") for i in range(1, profile.authors + 1)]
+    guilds = []
+    spam = 0
+    sequence = 0
+    for g in range(1, profile.guilds + 1):
+        guild = FakeGuild(id=g, name=f"guild-{g}")
+        for c in range(profile.channels_per_guild):
+            channel = FakeTextChannel(backend, guild, g * 1000 + c)
+            for _ in range(profile.messages_per_channel):
+                sequence += 1
+                words = rng.choices(
+                    WORDS, k=rng.randint(profile.min_words, profile.max_words)
+                )
+                if rng.random() < profile.spam_ratio:
+                    position = rng.randrange(len(words) + 1)
+                    words.insert(position, rng.choice(SPAM_PHRASES))
+                    spam += 1
+                message_id = _snowflake(now_ms - rng.randrange(max_age_ms), sequence)
+                channel.add(
+                    FakeMessage(
+                        message_id, guild, channel, rng.choice(authors), " ".join(words)
+                    )
+                )
+            channel.finalize()
+            guild.text_channels.append(channel)
+        guilds.append(guild)
+    return FakeClient(guilds, backend), spam
+
+
+def install_config(**overrides) -> ModuleType:
+    """sample_config を元にしたベンチマーク用の設定を del_spam.config として登録する
+
+    MessageDeleter を import する前に呼ぶ。チェックポイントやキャッシュは既定で無効にする。
+    """
+    config = ModuleType("del_spam.config")
+    for name in dir(sample_config):
+        if name.isupper():
+            setattr(config, name, getattr(sample_config, name))
+    defaults = {
+        "DRY_RUN": False,
+        "MAX_DELETIONS_PER_RUN": 10**9,
+        "BATCH_SIZE": 100,
+        "API_CALL_INTERVAL": 0.05,
+        "SINGLE_DELETE_INTERVAL": 0.0,
+        "CHECKPOINT_PATH": None,
+        "MESSAGE_CACHE_PATH": None,
+        "METRICS_PATH": None,
+        "METRICS_PORT": None,
+        "DRY_RUN_MATCHES_PATH": None,
+    }
+    for name, value in {**defaults, **overrides}.items():
+        setattr(config, name, value)
+    sys.modules["del_spam.config"] = config
+    return config
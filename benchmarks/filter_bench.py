@@ -0,0 +1,99 @@
+"""FilterGroup.matches とコンパイル済みルールの1メッセージあたりの評価時間を比較する
+
+実行: python -m benchmarks.filter_bench
+"""
+
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from del_spam.filter import FilterEngine
+from del_spam.snowflake import DISCORD_EPOCH_MS
+
+RULE = {
+    "enabled": True,
+    "conditions": {
+        "operator": "AND",
+        "filters": [
+            {"type": "guild", "operator": "IN", "values": list(range(1, 51))},
+            {"type": "channel", "operator": "NOT_IN", "values": list(range(100, 200))},
+            {"type": "user", "operator": "IN", "values": list(range(1000, 1500))},
+            {
+                "type": "timestamp",
+                "operator": "BETWEEN",
+                "start": "2024-01-01T00:00:00",
+                "end": "2024-12-31T23:59:59",
+            },
+            {
+                "type": "group",
+                "operator": "OR",
+                "conditions": [
+                    {
+                        "type": "content",
+                        "operator": "CONTAINS",
+                        "values": ["free nitro", "discord.gift", "airdrop"],
+                    },
+                    {
+                        "type": "content",
+                        "operator": "REGEX",
+                        "values": [r"https?://\S+\.ru/", r"@everyone\s+claim"],
+                    },
+                ],
+            },
+        ],
+    },
+}
+
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+WORDS = ["hello", "free nitro", "see you", "airdrop", "lol", "https://x.ru/a"]
+
+
+def make_message(rng: random.Random) -> SimpleNamespace:
+    created_at = BASE_TIME + timedelta(minutes=rng.randint(0, 600_000))
+    timestamp_ms = int(created_at.timestamp() * 1000)
+    return SimpleNamespace(
+        id=((timestamp_ms - DISCORD_EPOCH_MS) << 22) | rng.getrandbits(22),
+        guild=SimpleNamespace(id=rng.randint(1, 60)),
+        channel=SimpleNamespace(id=rng.randint(100, 400)),
+        author=SimpleNamespace(id=rng.randint(900, 1600)),
+        created_at=created_at,
+        content=" ".join(rng.choices(WORDS, k=4)),
+    )
+
+
+def make_messages(count: int, seed: int = 0) -> list[SimpleNamespace]:
+    rng = random.Random(seed)
+    return [make_message(rng) for _ in range(count)]
+
+
+def main(count: int = 10_000, repeat: int = 5) -> None:
+    engine = FilterEngine()
+    engine.load_rule("bench", RULE)
+    group = engine.filters["bench"]
+    compiled = engine.compiled["bench"]
+    messages = make_messages(count)
+
+    assert [group.matches(m) for m in messages] == [
+        compiled.matches(m) for m in messages
+    ]
+
+    def run_group():
+        for m in messages:
+            group.matches(m)
+
+    def run_compiled():
+        for m in messages:
+            compiled.matches(m)
+
+    group_time = min(timeit.repeat(run_group, number=1, repeat=repeat))
+    compiled_time = min(timeit.repeat(run_compiled, number=1, repeat=repeat))
+
+    print(f"messages:             {count}")
+    print(f"FilterGroup.matches:  {group_time / count * 1e6:.2f} us/message")
+    print(f"compiled predicate:   {compiled_time / count * 1e6:.2f} us/message")
+    print(f"speedup:              {group_time / compiled_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
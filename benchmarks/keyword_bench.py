@@ -0,0 +1,69 @@
+"""CONTAINS / STARTS_WITH / ENDS_WITH のキーワード数ごとの処理時間を、
+1件ずつ調べるループと compile_keywords で比較する
+
+実行: python -m benchmarks.keyword_bench [メッセージ数]
+"""
+
+import random
+import string
+import sys
+import time
+
+from del_spam.matcher import compile_keywords
+
+KEYWORD_COUNTS = (10, 1_000, 10_000)
+
+
+def make_keyword(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12)))
+
+
+def make_content(rng: random.Random, keywords: list[str]) -> str:
+    words = [make_keyword(rng) for _ in range(rng.randint(3, 20))]
+    if rng.random() < 0.1:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+    return " ".join(words)
+
+
+def loop_tests(keywords: list[str]) -> dict:
+    affixes = tuple(keywords)
+    return {
+        "contains": lambda text: any(keyword in text for keyword in keywords),
+        "prefix": lambda text: text.startswith(affixes),
+        "suffix": lambda text: text.endswith(affixes),
+    }
+
+
+def measure(test, contents: list[str]) -> tuple[float, list[bool]]:
+    start = time.perf_counter()
+    result = [test(content) for content in contents]
+    return time.perf_counter() - start, result
+
+
+def main(count: int = 20_000) -> None:
+    rng = random.Random(0)
+    for keyword_count in KEYWORD_COUNTS:
+        keywords = list({make_keyword(rng) for _ in range(keyword_count)})
+        contents = [make_content(rng, keywords) for _ in range(count)]
+        loops = loop_tests(keywords)
+
+        print(f"keywords: {len(keywords)}, messages: {count}")
+        for mode, loop in loops.items():
+            start = time.perf_counter()
+            compiled = compile_keywords(keywords, mode)
+            build_time = time.perf_counter() - start
+
+            loop_time, expected = measure(loop, contents)
+            compiled_time, actual = measure(compiled, contents)
+            assert expected == actual, mode
+
+            print(
+                f"  {mode:<8} loop {loop_time:7.3f}s  "
+                f"compiled {compiled_time:7.3f}s (build {build_time:.3f}s)  "
+                f"speedup {loop_time / compiled_time:6.1f}x  "
+                f"({sum(actual)} matched)"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
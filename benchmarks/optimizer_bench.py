@@ -0,0 +1,200 @@
+"""ルールの最適化(del_spam/optimizer.py)が判定結果を変えないことをランダムなルールで確かめ、
+最適化の前後で1メッセージあたりの評価時間を比較する
+
+ネストしたグループ・重複や矛盾する条件を含むルールとメッセージをランダムに生成し、
+FilterGroup.matches / 最適化前の述語 / 最適化後の述語 / 一括評価 / 実測での並べ替え後の
+結果がすべて一致することを確認する。食い違いがあれば、時間を測らずに終了コード 1 で終わる。
+
+実行: python -m benchmarks.optimizer_bench [ルール数]
+確認だけ: python -m benchmarks.optimizer_bench --check [ルール数]
+"""
+
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional
+
+from loguru import logger
+
+from del_spam.batch import MessageBatch
+from del_spam.filter import FilterEngine
+from del_spam.optimizer import optimize, reorder
+from del_spam.snowflake import DISCORD_EPOCH_MS
+
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+WORDS = ["hello", "free nitro", "gift", "airdrop", "lol", "https://x.ru/a", "ok"]
+PATTERNS = [r"https?://\S+\.ru/", r"^free", r"lol$", r"gi+ft"]
+ID_FIELDS = {"guild": (1, 8), "channel": (100, 120), "user": (900, 940)}
+ROLES = range(1, 10)
+
+
+class RoleLookup:
+    """MessageBatch.member_roles の代わりに、メッセージに付けたロールを返す"""
+
+    def roles_of(self, message: SimpleNamespace) -> Optional[frozenset]:
+        return message.roles
+
+
+def _timestamp(rng: random.Random) -> str:
+    moment = BASE_TIME + timedelta(days=rng.randint(0, 365))
+    return moment.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def random_filter(rng: random.Random, depth: int = 0) -> dict:
+    kind = rng.choice(
+        ["guild", "channel", "user", "role", "timestamp", "content", "content"]
+        + (["group", "group"] if depth < 3 else [])
+    )
+    if kind == "group":
+        return {
+            "type": "group",
+            "operator": rng.choice(["AND", "OR"]),
+            "conditions": [
+                random_filter(rng, depth + 1) for _ in range(rng.randint(0, 4))
+            ],
+        }
+    if kind in ID_FIELDS or kind == "role":
+        low, high = ID_FIELDS.get(kind, (ROLES.start, ROLES.stop - 1))
+        values = rng.sample(range(low, high + 1), rng.randint(1, 4))
+        operator = rng.choice(["IN", "NOT_IN", "EQUALS", "NOT_EQUALS"])
+        return {"type": kind, "operator": operator, "values": values}
+    if kind == "timestamp":
+        start, end = sorted([_timestamp(rng), _timestamp(rng)])
+        if rng.random() < 0.2:
+            start, end = end, start
+        operator = rng.choice(["BETWEEN", "AFTER", "BEFORE"])
+        return {"type": kind, "operator": operator, "start": start, "end": end}
+    operator = rng.choice(
+        ["CONTAINS", "NOT_CONTAINS", "STARTS_WITH", "ENDS_WITH", "REGEX"]
+    )
+    pool = PATTERNS if operator == "REGEX" else WORDS
+    return {"type": kind, "operator": operator, "values": rng.sample(pool, 2)}
+
+
+def random_rule(rng: random.Random) -> dict:
+    filters = [random_filter(rng) for _ in range(rng.randint(1, 6))]
+    # 同じ条件を重ねて、重複の除去とまとめ上げを通す
+    filters += rng.sample(filters, rng.randint(0, len(filters)))
+    return {
+        "enabled": True,
+        "conditions": {"operator": rng.choice(["AND", "OR"]), "filters": filters},
+    }
+
+
+def make_message(rng: random.Random) -> SimpleNamespace:
+    created_at = BASE_TIME + timedelta(minutes=rng.randint(0, 530_000))
+    timestamp_ms = int(created_at.timestamp() * 1000)
+    roles = None
+    if rng.random() < 0.9:
+        roles = frozenset(rng.sample(ROLES, rng.randint(0, 3)))
+    return SimpleNamespace(
+        id=((timestamp_ms - DISCORD_EPOCH_MS) << 22) | rng.getrandbits(22),
+        guild=SimpleNamespace(id=rng.randint(*ID_FIELDS["guild"])),
+        channel=SimpleNamespace(id=rng.randint(*ID_FIELDS["channel"])),
+        author=SimpleNamespace(id=rng.randint(*ID_FIELDS["user"])),
+        created_at=created_at,
+        content=" ".join(rng.choices(WORDS, k=rng.randint(0, 4))),
+        roles=roles,
+    )
+
+
+def check_equivalence(
+    rules: int, messages_per_rule: int, seed: int = 0
+) -> tuple[int, list[tuple[str, dict]]]:
+    """確認した (ルール, メッセージ) の組の数と、結果が食い違った (評価方法, ルール) を返す
+
+    seed が同じならいつも同じルールとメッセージで確かめる。
+    """
+    rng = random.Random(seed)
+    checked = 0
+    mismatches: list[tuple[str, dict]] = []
+    for i in range(rules):
+        rule = random_rule(rng)
+        engine = FilterEngine()
+        engine.load_rule("rule", rule)
+        group = engine.filters["rule"]
+        original = group.compile()
+        optimized = engine.compiled["rule"]
+        messages = [make_message(rng) for _ in range(messages_per_rule)]
+
+        expected = [group.matches(m, m.roles) for m in messages]
+        results = {
+            "unoptimized": [original.matches(m, m.roles) for m in messages],
+            "optimized": [optimized.matches(m, m.roles) for m in messages],
+        }
+        selectivity: dict[int, list[int]] = {}
+        batch = MessageBatch(messages, RoleLookup(), selectivity=selectivity)
+        results["optimized batch"] = batch.to_flags(optimized.select(batch, batch.all))
+        # 閾値に関係なく実測値で並べ替わるよう、件数を水増しする
+        for counts in selectivity.values():
+            counts[0] *= 1000
+            counts[1] *= 1000
+        reordered = reorder(optimized, selectivity)
+        results["reordered"] = [reordered.matches(m, m.roles) for m in messages]
+        batch = MessageBatch(messages, RoleLookup())
+        results["reordered batch"] = batch.to_flags(reordered.select(batch, batch.all))
+
+        if optimized != optimize(original):
+            mismatches.append(("compiled", rule))
+        for stage, flags in results.items():
+            if flags != expected:
+                mismatches.append((stage, rule))
+        checked += len(messages)
+    return checked, mismatches
+
+
+def check(rules: int = 500) -> int:
+    """最適化の前後で結果が変わらないかだけを確かめ、食い違えば 1 を返す"""
+    logger.remove()
+    checked, mismatches = check_equivalence(rules, messages_per_rule=200)
+    for stage, rule in mismatches:
+        print(f"MISMATCH ({stage}): {rule}", file=sys.stderr)
+    if mismatches:
+        print(
+            f"equivalence: {len(mismatches)} mismatch(es) in {rules} random rules",
+            file=sys.stderr,
+        )
+        return 1
+    print(f"equivalence: {rules} random rules, {checked} evaluations OK")
+    return 0
+
+
+def time_rules(rules: int, count: int = 2_000, repeat: int = 3, seed: int = 1):
+    rng = random.Random(seed)
+    originals = []
+    optimized = []
+    for _ in range(rules):
+        engine = FilterEngine()
+        engine.load_rule("rule", random_rule(rng))
+        originals.append(engine.filters["rule"].compile())
+        optimized.append(engine.compiled["rule"])
+    messages = [make_message(rng) for _ in range(count)]
+
+    def run(predicates):
+        def evaluate():
+            for predicate in predicates:
+                for m in messages:
+                    predicate.matches(m, m.roles)
+
+        return min(timeit.repeat(evaluate, number=1, repeat=repeat))
+
+    return run(originals) / (rules * count), run(optimized) / (rules * count)
+
+
+def main(rules: int = 500) -> int:
+    if check(rules):
+        return 1
+    before, after = time_rules(min(rules, 200))
+    print(f"unoptimized:  {before * 1e6:.2f} us/message/rule")
+    print(f"optimized:    {after * 1e6:.2f} us/message/rule")
+    print(f"speedup:      {before / after:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--check":
+        sys.exit(check(*(int(arg) for arg in args[1:])))
+    sys.exit(main(*(int(arg) for arg in args)))
@@ -0,0 +1,99 @@
+"""ドライランで書き出した削除計画の実行と、履歴を再スキャンする通常の実行を比べる
+
+同じ合成メッセージに対して次の3つを行い、時間と API リクエスト数を表示する。
+
+1. ドライラン(一致と削除計画を書き出す)
+2. 計画の実行(履歴を取得しない)と、同じ計画の2回目の実行(削除済みなので何も消えない)
+3. 計画を使わない通常の実行(履歴を再スキャンして削除する)
+
+実行: python -m benchmarks.plan_bench
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from benchmarks.e2e_bench import RULE
+from benchmarks.fake_discord import (
+    BackendProfile,
+    MessageProfile,
+    build_client,
+    install_config,
+)
+
+PROFILE = MessageProfile(
+    channels_per_guild=10, messages_per_channel=5_000, max_age_days=7
+)
+BACKEND = BackendProfile(latency=0.005)
+
+
+def _deleter(dry_run: bool):
+    from del_spam.deleter import MessageDeleter
+    from del_spam.filter import FilterEngine
+
+    engine = FilterEngine()
+    engine.load_rule("spam", RULE)
+    deleter = MessageDeleter(engine)
+    deleter.dry_run = dry_run
+    return deleter
+
+
+def _measure(client, coro) -> tuple[int, float, int, int]:
+    stats = client.backend.stats
+    history, deletes = stats.history_requests, stats.delete_requests
+    start = time.perf_counter()
+    result = asyncio.run(coro)
+    elapsed = time.perf_counter() - start
+    return (
+        result,
+        elapsed,
+        stats.history_requests - history,
+        stats.delete_requests - deletes,
+    )
+
+
+def main() -> None:
+    logger.remove()
+    workdir = Path(tempfile.mkdtemp(prefix="plan_bench_"))
+    plan_path = workdir / "plan.jsonl"
+    install_config(
+        DRY_RUN_MATCHES_PATH=str(workdir / "matches.jsonl"),
+        DRY_RUN_PLAN_PATH=str(plan_path),
+    )
+    from del_spam.plan_file import read_plan
+
+    client, spam = build_client(PROFILE, BACKEND)
+    print(f"{'run':<16}{'result':>9}{'seconds':>9}{'history':>9}{'deletes':>9}")
+
+    def show(name: str, row: tuple[int, float, int, int]) -> None:
+        print(f"{name:<16}{row[0]:>9}{row[1]:>9.2f}{row[2]:>9}{row[3]:>9}")
+
+    deleter = _deleter(dry_run=True)
+    show("dry run", _measure(client, deleter.delete_by_rule(client, "spam")))
+    _, batches = read_plan(plan_path)
+    # 同じ一致から作った計画は毎回同じ内容になる
+    first = plan_path.read_bytes()
+    deleter = _deleter(dry_run=True)
+    _measure(client, deleter.delete_by_rule(client, "spam"))
+    assert plan_path.read_bytes() == first, "plan is not deterministic"
+
+    before = client.backend.stats.deleted
+    deleter = _deleter(dry_run=False)
+    show("execute plan", _measure(client, deleter.delete_planned(client, batches)))
+    assert client.backend.stats.deleted - before == spam, "plan missed messages"
+    deleter = _deleter(dry_run=False)
+    show("execute again", _measure(client, deleter.delete_planned(client, batches)))
+    assert client.backend.stats.deleted - before == spam, "second run deleted more"
+
+    # 比較のため、同じメッセージを作り直して計画なしで削除する
+    client, _ = build_client(PROFILE, BACKEND)
+    deleter = _deleter(dry_run=False)
+    show("rescan", _measure(client, deleter.delete_by_rule(client, "spam")))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""ルール数ごとに、全ルールを順に評価する場合と RuleIndex で候補を絞る場合の
+1メッセージあたりの get_matching_rules の時間を比較する
+
+ルールの大半は特定のサーバー・チャンネル・送信者に紐づき、一部は ID の制約を持たない。
+
+実行: python -m benchmarks.rule_index_bench
+"""
+
+import random
+import timeit
+
+from loguru import logger
+
+from benchmarks.filter_bench import make_messages
+from del_spam.filter import FilterEngine
+
+CONTENT = {"type": "content", "operator": "CONTAINS", "values": ["free nitro"]}
+
+
+def _ids(filter_type: str, values: list[int]) -> dict:
+    return {"type": filter_type, "operator": "IN", "values": values}
+
+
+def make_rules(count: int, seed: int = 0) -> dict[str, dict]:
+    rng = random.Random(seed)
+    rules = {}
+    for i in range(count):
+        kind = rng.choice(["guild", "channel", "user", "user", "none"])
+        if kind == "none" and rng.random() < 0.9:
+            # ID の制約がないルールは全体の数%にとどめる
+            kind = "user"
+        filters = [CONTENT]
+        if kind == "guild":
+            filters.append(_ids("guild", [rng.randint(1, 60)]))
+        elif kind == "channel":
+            filters.append(_ids("channel", rng.sample(range(100, 401), 3)))
+        elif kind == "user":
+            filters.append(_ids("user", rng.sample(range(900, 1601), 2)))
+        rules[f"rule-{i}"] = {
+            "enabled": True,
+            "conditions": {"operator": "AND", "filters": filters},
+        }
+    return rules
+
+
+def main(count: int = 2_000, repeat: int = 3) -> None:
+    logger.remove()
+    messages = make_messages(count)
+    print(f"{'rules':>6}{'all rules us/msg':>18}{'indexed us/msg':>16}{'speedup':>9}")
+    for rules in (10, 100, 500, 1_000):
+        engine = FilterEngine()
+        engine.load_all_rules(make_rules(rules))
+
+        def scan_all():
+            return [
+                [name for name in engine.compiled if engine.matches_rule(name, m)]
+                for m in messages
+            ]
+
+        def indexed():
+            return [engine.get_matching_rules(m) for m in messages]
+
+        assert scan_all() == indexed()
+        all_time = min(timeit.repeat(scan_all, number=1, repeat=repeat)) / count
+        index_time = min(timeit.repeat(indexed, number=1, repeat=repeat)) / count
+        print(
+            f"{rules:>6}{all_time * 1e6:>18.2f}{index_time * 1e6:>16.2f}"
+            f"{all_time / index_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
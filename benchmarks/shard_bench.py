@@ -0,0 +1,79 @@
+"""偽の Discord(benchmarks/fake_discord.py)に対して、ワーカープロセス数ごとの
+削除処理全体のメッセージ処理数/秒を比較する
+
+各ワーカーは同じシードで同じメッセージを生成し、del_spam.shard と同じ方法で
+担当チャンネルを振り分け、削除件数の上限とレート制限を SQLite で共有する。
+
+実行: python -m benchmarks.shard_bench [ワーカー数 ...]
+"""
+
+import asyncio
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.e2e_bench import RULE
+from benchmarks.fake_discord import BackendProfile, MessageProfile, build_client
+from benchmarks.fake_discord import install_config
+
+PROFILE = MessageProfile(channels_per_guild=16, messages_per_channel=5_000)
+BACKEND = BackendProfile(latency=0.002, rate_limit_every=20, retry_after=0.05)
+MAX_DELETIONS = 10**9
+
+
+def run_worker(state_path: str, index: int, workers: int) -> None:
+    from loguru import logger
+
+    logger.remove()
+    install_config(MAX_DELETIONS_PER_RUN=MAX_DELETIONS)
+    from del_spam.coordination import SharedState, WorkerReport
+    from del_spam.deleter import MessageDeleter
+    from del_spam.filter import FilterEngine
+    from del_spam.shard import attach_worker
+
+    client, _ = build_client(PROFILE, BACKEND)
+    engine = FilterEngine()
+    engine.load_rule("spam", RULE)
+    deleter = MessageDeleter(engine)
+    state = SharedState(state_path)
+    attach_worker(deleter, state, index, workers)
+    deleted = asyncio.run(deleter.delete_by_rule(client, "spam"))
+    state.add_report(WorkerReport(index, deleted, 0, deleter.metrics.export()))
+    state.close()
+
+
+def run(workers: int) -> tuple[float, int]:
+    from del_spam.coordination import SharedState
+
+    with tempfile.TemporaryDirectory() as workdir:
+        state_path = str(Path(workdir) / "shared.db")
+        state = SharedState.create(state_path, MAX_DELETIONS)
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=run_worker, args=(state_path, index, workers))
+            for index in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        deleted = sum(report.deleted for report in state.reports())
+        state.close()
+    return elapsed, deleted
+
+
+def main(worker_counts: list[int]) -> None:
+    install_config()
+    total = PROFILE.guilds * PROFILE.channels_per_guild * PROFILE.messages_per_channel
+    print(f"{'workers':>8}{'seconds':>9}{'msg/s':>11}{'deleted':>9}")
+    for workers in worker_counts:
+        elapsed, deleted = run(workers)
+        print(f"{workers:>8}{elapsed:>9.2f}{total / elapsed:>11,.0f}{deleted:>9}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 2, 4])
@@ -0,0 +1,123 @@
+"""常駐モード(MessageWatcher)に、多くのチャンネルへまばらに届くスパムを流し、
+削除 API の呼び出し回数と受信から削除までの時間を計測する
+
+メッセージは実時間で届くので、各シナリオは DURATION 秒かかる。乱数のシードは固定。
+
+実行: python -m benchmarks.watch_bench [シナリオ名 ...]
+"""
+
+import asyncio
+import random
+import sys
+import time
+from dataclasses import dataclass
+
+from loguru import logger
+
+from benchmarks.e2e_bench import RULE
+from benchmarks.fake_discord import (
+    SPAM_PHRASES,
+    BackendProfile,
+    FakeBackend,
+    FakeGuild,
+    FakeMessage,
+    FakeRef,
+    FakeTextChannel,
+    _snowflake,
+    install_config,
+)
+
+DURATION = 10.0
+
+
+@dataclass
+class Scenario:
+    name: str
+    channels: int
+    # 全チャンネル合計の1秒あたりのスパムの件数
+    rate: float
+    backend: BackendProfile
+
+
+SCENARIOS = [
+    Scenario("sparse", channels=50, rate=50.0, backend=BackendProfile(latency=0.02)),
+    Scenario("dense", channels=5, rate=200.0, backend=BackendProfile(latency=0.02)),
+    Scenario(
+        "rate-limited",
+        channels=50,
+        rate=100.0,
+        backend=BackendProfile(latency=0.02, rate_limit_every=10, retry_after=1.0),
+    ),
+]
+
+
+async def _run(scenario: Scenario, seed: int) -> dict:
+    from del_spam.deleter import DeletionBudget, MessageDeleter
+    from del_spam.filter import FilterEngine
+    from del_spam.watcher import MessageWatcher
+
+    rng = random.Random(seed)
+    backend = FakeBackend(scenario.backend)
+    guild = FakeGuild(id=1, name="guild-1")
+    channels = [
+        FakeTextChannel(backend, guild, 1000 + c) for c in range(scenario.channels)
+    ]
+    guild.text_channels.extend(channels)
+    author = FakeRef(1, "spammer")
+
+    engine = FilterEngine()
+    engine.load_all_rules({"spam": RULE})
+    deleter = MessageDeleter(engine)
+    deleter.dry_run = False
+    watcher = MessageWatcher(deleter, ["spam"], DeletionBudget(10**9))
+
+    sent = 0
+    start = time.perf_counter()
+    deadline = start + DURATION
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.expovariate(scenario.rate))
+        sent += 1
+        channel = rng.choice(channels)
+        message = FakeMessage(
+            _snowflake(int(time.time() * 1000), sent),
+            guild,
+            channel,
+            author,
+            rng.choice(SPAM_PHRASES),
+        )
+        channel.add(message)
+        await watcher.on_message(message)
+    await watcher.close()
+
+    stats = backend.stats
+    return {
+        "scenario": scenario.name,
+        "sent": sent,
+        "deleted": stats.deleted,
+        "requests": stats.delete_requests,
+        "requests_per_deleted": stats.delete_requests / max(stats.deleted, 1),
+        "rate_limited": stats.rate_limited,
+        "p50_ms": watcher.latency.percentile(0.5),
+        "p95_ms": watcher.latency.percentile(0.95),
+    }
+
+
+def main(names: list[str]) -> None:
+    logger.remove()
+    install_config()
+    scenarios = [s for s in SCENARIOS if not names or s.name in names]
+    print(
+        f"{'scenario':<14}{'sent':>7}{'deleted':>9}{'req':>7}{'req/del':>9}"
+        f"{'429':>6}{'p50 ms':>9}{'p95 ms':>9}"
+    )
+    for scenario in scenarios:
+        r = asyncio.run(_run(scenario, seed=0))
+        print(
+            f"{r['scenario']:<14}{r['sent']:>7}{r['deleted']:>9}{r['requests']:>7}"
+            f"{r['requests_per_deleted']:>9.3f}{r['rate_limited']:>6}"
+            f"{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,93 @@
+from collections import Counter
+from typing import Any, Callable, Optional, Sequence
+
+from del_spam.duplicates import fingerprint
+
+
+def _guild_ids(batch: "MessageBatch") -> list[Optional[int]]:
+    return [None if m.guild is None else m.guild.id for m in batch.messages]
+
+
+def _role_sets(batch: "MessageBatch") -> list[Optional[frozenset]]:
+    if batch.member_roles is not None:
+        return [batch.member_roles.roles_of(m) for m in batch.messages]
+    result = []
+    for m in batch.messages:
+        roles = getattr(m.author, "roles", None)
+        result.append(None if roles is None else frozenset(r.id for r in roles))
+    return result
+
+
+_COLUMN_BUILDERS: dict[str, Callable[["MessageBatch"], list]] = {
+    "message_id": lambda batch: [m.id for m in batch.messages],
+    "guild": _guild_ids,
+    "channel": lambda batch: [m.channel.id for m in batch.messages],
+    "user": lambda batch: [m.author.id for m in batch.messages],
+    "content": lambda batch: [m.content.lower() for m in batch.messages],
+    "roles": _role_sets,
+    "fingerprint": lambda batch: [fingerprint(m.content) for m in batch.messages],
+}
+
+
+class MessageBatch:
+    """1ページ分のメッセージを列ごとに保持し、ルールを一括評価するための入れ物
+
+    判定の途中結果は、一致したメッセージのバッチ内の位置のリストで表す。
+    """
+
+    __slots__ = (
+        "messages",
+        "size",
+        "member_roles",
+        "evaluations",
+        "selectivity",
+        "_columns",
+    )
+
+    def __init__(
+        self,
+        messages: Sequence[Any],
+        member_roles: Any = None,
+        evaluations: Optional[Counter] = None,
+        selectivity: Optional[dict[int, list[int]]] = None,
+    ):
+        self.messages = messages
+        self.size = len(messages)
+        # ロールの列は、指定されていれば MemberRoleCache から引く
+        self.member_roles = member_roles
+        # 指定されていれば、フィルタータイプごとに評価したメッセージ数を数える
+        self.evaluations = evaluations
+        # 指定されていれば、述語ごとの通過率を記録する(評価順の最適化に使う)
+        self.selectivity = selectivity
+        self._columns: dict[str, list] = {}
+
+    @property
+    def all(self) -> list[int]:
+        return list(range(self.size))
+
+    def column(self, name: str) -> list:
+        values = self._columns.get(name)
+        if values is None:
+            values = self._columns[name] = _COLUMN_BUILDERS[name](self)
+        return values
+
+    def count(self, filter_type: str, evaluated: int) -> None:
+        if self.evaluations is not None:
+            self.evaluations[filter_type] += evaluated
+
+    def observe(self, predicate: Any, evaluated: int, passed: int) -> None:
+        """AND/OR の子を評価した件数と通過した件数を記録する"""
+        self.count(predicate.filter_type, evaluated)
+        if self.selectivity is not None:
+            counts = self.selectivity.get(id(predicate))
+            if counts is None:
+                self.selectivity[id(predicate)] = [evaluated, passed]
+            else:
+                counts[0] += evaluated
+                counts[1] += passed
+
+    def to_flags(self, selected: list[int]) -> list[bool]:
+        flags = [False] * self.size
+        for i in selected:
+            flags[i] = True
+        return flags
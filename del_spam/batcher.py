@@ -0,0 +1,138 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Optional
+
+import discord
+
+from del_spam.deleter import GLOBAL_BUCKET
+
+if TYPE_CHECKING:
+    from del_spam.deleter import DeletionBudget, MessageDeleter
+
+
+@dataclass
+class PendingBatch:
+    channel: discord.TextChannel
+    message_ids: list[int] = field(default_factory=list)
+    # 各メッセージを受信した時刻(time.monotonic)
+    arrivals: list[float] = field(default_factory=list)
+    # 件数の上限や保留件数の超過で、時間窓を待たずに送信する
+    urgent: bool = False
+    # 送信の時刻を見直す必要があるときに set する
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def wake(self, urgent: bool = False) -> None:
+        self.urgent = self.urgent or urgent
+        self.wakeup.set()
+
+
+class DeleteBatcher:
+    """削除するメッセージをチャンネルごとに溜め、件数・経過時間・全体の保留件数に応じて送信する
+
+    - batch_size 件に達したチャンネルはすぐに送信する
+    - それ以外は最初のメッセージから window 秒後に送信する。1件だけのチャンネルは
+      それでも1回の呼び出しを使うので、2件目を max_window 秒まで待つ
+    - 削除 API がレート制限や送信間隔で待機中のチャンネルは、待機が明けるまで溜め続けて
+      1回の呼び出しにまとめる
+    - 1つのチャンネルの送信は同時に1つだけ行い、送信中に届いた分は次の1回にまとめる
+    - 全チャンネルの保留件数が max_pending を超えたら、件数の多いチャンネルから送信する
+
+    1件だけのバッチは、一括削除ではなく通常の削除 API で送られる。
+    """
+
+    def __init__(
+        self,
+        deleter: "MessageDeleter",
+        budget: "DeletionBudget",
+        window: float,
+        max_window: float,
+        max_pending: int,
+        on_flushed: Optional[Callable[[PendingBatch, int], None]] = None,
+    ):
+        self.deleter = deleter
+        self.budget = budget
+        self.window = window
+        self.max_window = max(window, max_window)
+        self.max_pending = max_pending
+        self.on_flushed = on_flushed
+        self.pending_count = 0
+        self._pending: dict[int, PendingBatch] = {}
+        self._drainers: dict[int, asyncio.Task] = {}
+
+    def add(
+        self, channel: discord.TextChannel, message_id: int, arrived: float
+    ) -> None:
+        batch = self._pending.get(channel.id)
+        if batch is None:
+            batch = self._pending[channel.id] = PendingBatch(channel)
+        batch.message_ids.append(message_id)
+        batch.arrivals.append(arrived)
+        self.pending_count += 1
+        size = len(batch.message_ids)
+        if size >= self.deleter.batch_size:
+            batch.wake(urgent=True)
+        elif size == 2:
+            # 2件目が届いたら、延長していた待ち時間を通常の時間窓に戻す
+            batch.wake()
+        if self.pending_count > self.max_pending:
+            self._relieve_pressure()
+        if channel.id not in self._drainers:
+            self._drainers[channel.id] = asyncio.create_task(self._drain(channel.id))
+
+    def _relieve_pressure(self) -> None:
+        # 送信を待っていないチャンネルのうち、最も件数の多いものを先に送る
+        waiting = [b for b in self._pending.values() if not b.urgent]
+        if waiting:
+            max(waiting, key=lambda b: len(b.message_ids)).wake(urgent=True)
+
+    def _resume_at(self, channel_id: int) -> float:
+        scheduler = self.deleter.scheduler
+        return max(
+            scheduler.resume_at(("delete_messages", channel_id)),
+            scheduler.resume_at(("delete_message", channel_id)),
+            scheduler.resume_at(GLOBAL_BUCKET),
+        )
+
+    def _deadline(self, batch: PendingBatch) -> float:
+        window = self.window if len(batch.message_ids) > 1 else self.max_window
+        return max(batch.arrivals[0] + window, self._resume_at(batch.channel.id))
+
+    async def _drain(self, channel_id: int) -> None:
+        try:
+            while (batch := self._pending.get(channel_id)) is not None:
+                while not batch.urgent:
+                    delay = self._deadline(batch) - time.monotonic()
+                    if delay <= 0:
+                        break
+                    batch.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(batch.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                del self._pending[channel_id]
+                self.pending_count -= len(batch.message_ids)
+                await self._send(batch)
+        finally:
+            del self._drainers[channel_id]
+
+    async def _send(self, batch: PendingBatch) -> None:
+        batch_size = self.deleter.batch_size
+        for start in range(0, len(batch.message_ids), batch_size):
+            part = PendingBatch(
+                batch.channel,
+                batch.message_ids[start : start + batch_size],
+                batch.arrivals[start : start + batch_size],
+            )
+            deleted = await self.deleter._flush_batch(
+                part.channel, part.message_ids, self.budget
+            )
+            if self.on_flushed is not None:
+                self.on_flushed(part, deleted)
+
+    async def close(self) -> None:
+        """保留中のバッチを待たずにすべて送信する"""
+        for batch in self._pending.values():
+            batch.wake(urgent=True)
+        if self._drainers:
+            await asyncio.gather(*self._drainers.values(), return_exceptions=True)
@@ -0,0 +1,210 @@
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import discord
+from loguru import logger
+
+from del_spam.planner import IdScope, ScanPlan
+from del_spam.snowflake import snowflake_to_ms
+
+SYNC_COMMIT_INTERVAL = 1000
+# これより多い ID は SQL に展開せず、フィルター側の判定に任せる
+MAX_PUSHDOWN_IDS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    role_ids TEXT,
+    content TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    channel_id INTEGER PRIMARY KEY,
+    newest_id INTEGER NOT NULL
+);
+"""
+
+
+class CachedRef:
+    __slots__ = ("id",)
+
+    def __init__(self, id: int):
+        self.id = id
+
+
+class CachedAuthor:
+    __slots__ = ("id", "roles")
+
+    def __init__(self, id: int, roles: Optional[list[CachedRef]]):
+        self.id = id
+        self.roles = roles
+
+    def __str__(self) -> str:
+        return str(self.id)
+
+
+class CachedMessage:
+    """フィルターが参照する属性だけを持つ discord.Message の代替"""
+
+    __slots__ = ("id", "guild", "channel", "author", "content")
+
+    def __init__(
+        self,
+        id: int,
+        guild_id: int,
+        channel_id: int,
+        author_id: int,
+        role_ids: Optional[str],
+        content: str,
+    ):
+        self.id = id
+        self.guild = CachedRef(guild_id)
+        self.channel = CachedRef(channel_id)
+        roles = None
+        if role_ids is not None:
+            roles = [CachedRef(int(r)) for r in role_ids.split(",") if r]
+        self.author = CachedAuthor(author_id, roles)
+        self.content = content
+
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(snowflake_to_ms(self.id) / 1000, tz=timezone.utc)
+
+
+def _role_ids(message: discord.Message) -> Optional[str]:
+    roles = getattr(message.author, "roles", None)
+    if roles is None:
+        return None
+    return ",".join(str(role.id) for role in roles)
+
+
+def _scope_clause(
+    column: str, scope: IdScope, clauses: list[str], params: list[int]
+) -> None:
+    if scope.only is not None and len(scope.only) <= MAX_PUSHDOWN_IDS:
+        ids = [i for i in scope.only if isinstance(i, int)]
+        clauses.append(f"{column} IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    elif scope.only is None and 0 < len(scope.excluded) <= MAX_PUSHDOWN_IDS:
+        ids = [i for i in scope.excluded if isinstance(i, int)]
+        clauses.append(f"{column} NOT IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+
+
+class MessageCache:
+    """フィルターが参照する項目だけを SQLite に保存するメッセージキャッシュ
+
+    作成時刻はメッセージ ID(スノーフレーク)から求めるため保存しない。
+    """
+
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def newest_id(self, channel_id: int) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT newest_id FROM sync_state WHERE channel_id = ?", (channel_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, channel_id: int, messages: Iterable[discord.Message]) -> int:
+        rows = [
+            (
+                m.id,
+                m.guild.id if m.guild is not None else 0,
+                m.channel.id,
+                m.author.id,
+                _role_ids(m),
+                m.content,
+            )
+            for m in messages
+        ]
+        if not rows:
+            return 0
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        self._conn.execute(
+            "INSERT INTO sync_state VALUES (?, ?) ON CONFLICT (channel_id) "
+            "DO UPDATE SET newest_id = max(newest_id, excluded.newest_id)",
+            (channel_id, max(row[0] for row in rows)),
+        )
+        self._conn.commit()
+        return len(rows)
+
+    async def sync_channel(self, channel: discord.TextChannel) -> int:
+        """前回の最新メッセージ以降だけを取得してキャッシュに追加する"""
+        newest_id = self.newest_id(channel.id)
+        added = 0
+        chunk: list[discord.Message] = []
+        async for message in channel.history(
+            limit=None,
+            after=discord.Object(newest_id if newest_id is not None else 0),
+            oldest_first=True,
+        ):
+            chunk.append(message)
+            if len(chunk) >= SYNC_COMMIT_INTERVAL:
+                added += self.add(channel.id, chunk)
+                chunk = []
+        added += self.add(channel.id, chunk)
+        if added:
+            logger.info(f"[CACHE] Synced {added} message(s) from #{channel.name}")
+        return added
+
+    def remove(self, message_ids: Iterable[int]) -> None:
+        self._conn.executemany(
+            "DELETE FROM messages WHERE id = ?", ((i,) for i in message_ids)
+        )
+        self._conn.commit()
+
+    def iter_messages(
+        self,
+        plan: Optional[ScanPlan] = None,
+        channel_id: Optional[int] = None,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+    ) -> Iterator[CachedMessage]:
+        """新しい順にキャッシュ済みメッセージを返す(plan の範囲は SQL で絞り込む)"""
+        clauses: list[str] = []
+        params: list[int] = []
+        if channel_id is not None:
+            clauses.append("channel_id = ?")
+            params.append(channel_id)
+        if plan is not None:
+            if plan.empty:
+                return
+            _scope_clause("guild_id", plan.guilds, clauses, params)
+            _scope_clause("channel_id", plan.channels, clauses, params)
+            _scope_clause("id", plan.message_ids, clauses, params)
+            plan_after, plan_before = plan.history_bounds()
+            if plan_after is not None:
+                after = plan_after if after is None else max(after, plan_after)
+            if plan_before is not None:
+                before = plan_before if before is None else min(before, plan_before)
+        if after is not None:
+            clauses.append("id > ?")
+            params.append(after)
+        if before is not None:
+            clauses.append("id < ?")
+            params.append(before)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        cursor = self._conn.execute(
+            "SELECT id, guild_id, channel_id, author_id, role_ids, content "
+            f"FROM messages {where} ORDER BY id DESC",
+            params,
+        )
+        for row in cursor:
+            yield CachedMessage(*row)
+
+    def close(self) -> None:
+        self._conn.close()
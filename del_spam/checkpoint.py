@@ -0,0 +1,78 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    rule_key TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    oldest_scanned_id INTEGER,
+    newest_scanned_id INTEGER,
+    completed INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (rule_key, guild_id, channel_id)
+)
+"""
+
+
+@dataclass(frozen=True)
+class Checkpoint:
+    oldest_scanned_id: Optional[int]
+    newest_scanned_id: Optional[int]
+    completed: bool
+
+
+class CheckpointStore:
+    """ルール・サーバー・チャンネルごとのスキャン位置を SQLite に保存する"""
+
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+    def get(
+        self, rule_key: str, guild_id: int, channel_id: int
+    ) -> Optional[Checkpoint]:
+        row = self._conn.execute(
+            "SELECT oldest_scanned_id, newest_scanned_id, completed FROM checkpoints "
+            "WHERE rule_key = ? AND guild_id = ? AND channel_id = ?",
+            (rule_key, guild_id, channel_id),
+        ).fetchone()
+        if row is None:
+            return None
+        return Checkpoint(row[0], row[1], bool(row[2]))
+
+    def save(
+        self, rule_key: str, guild_id: int, channel_id: int, checkpoint: Checkpoint
+    ) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                rule_key,
+                guild_id,
+                channel_id,
+                checkpoint.oldest_scanned_id,
+                checkpoint.newest_scanned_id,
+                int(checkpoint.completed),
+                time.time(),
+            ),
+        )
+        self._conn.commit()
+
+    def clear(self, rule_key: Optional[str] = None) -> None:
+        if rule_key is None:
+            self._conn.execute("DELETE FROM checkpoints")
+        else:
+            self._conn.execute(
+                "DELETE FROM checkpoints WHERE rule_key = ?", (rule_key,)
+            )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
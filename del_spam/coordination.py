@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS budget (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    max_deletions INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    bucket TEXT PRIMARY KEY,
+    resume_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reports (
+    worker INTEGER PRIMARY KEY,
+    deleted INTEGER NOT NULL,
+    exit_code INTEGER NOT NULL,
+    metrics TEXT NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class WorkerReport:
+    worker: int
+    deleted: int
+    exit_code: int
+    metrics: dict[str, Any]
+
+
+class SharedState:
+    """複数のワーカープロセスで共有する削除件数とレート制限の状態(SQLite)
+
+    時刻はプロセスをまたいで比較できるよう壁時計(time.time)で保存し、
+    読み出すときに各プロセスの time.monotonic に換算する。
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        # 自動コミットにして、予約だけ BEGIN IMMEDIATE で排他する
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    @classmethod
+    def create(cls, path: str | Path, max_deletions: int) -> "SharedState":
+        state = cls(path)
+        state._conn.execute(
+            "INSERT OR REPLACE INTO budget VALUES (0, ?, 0)", (max_deletions,)
+        )
+        return state
+
+    @property
+    def limit(self) -> int:
+        return self._conn.execute("SELECT max_deletions FROM budget").fetchone()[0]
+
+    @property
+    def used(self) -> int:
+        return self._conn.execute("SELECT used FROM budget").fetchone()[0]
+
+    def reserve(self, count: int) -> int:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            limit, used = self._conn.execute(
+                "SELECT max_deletions, used FROM budget"
+            ).fetchone()
+            granted = max(0, min(count, limit - used))
+            if granted:
+                self._conn.execute("UPDATE budget SET used = used + ?", (granted,))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return granted
+
+    def release(self, count: int) -> None:
+        if count:
+            self._conn.execute("UPDATE budget SET used = used - ?", (count,))
+
+    def defer(self, bucket: str, retry_after: float) -> None:
+        self._conn.execute(
+            "INSERT INTO rate_limits VALUES (?, ?) ON CONFLICT (bucket) "
+            "DO UPDATE SET resume_at = MAX(resume_at, excluded.resume_at)",
+            (bucket, time.time() + retry_after),
+        )
+
+    def resume_at(self, buckets: Iterable[str]) -> float:
+        """buckets のいずれかに他のワーカーが記録した待機の終了時刻(time.monotonic 基準)"""
+        buckets = list(buckets)
+        placeholders = ", ".join("?" * len(buckets))
+        row = self._conn.execute(
+            f"SELECT MAX(resume_at) FROM rate_limits WHERE bucket IN ({placeholders})",
+            buckets,
+        ).fetchone()
+        if row[0] is None:
+            return 0.0
+        return time.monotonic() + (row[0] - time.time())
+
+    def add_report(self, report: WorkerReport) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?)",
+            (
+                report.worker,
+                report.deleted,
+                report.exit_code,
+                json.dumps(report.metrics),
+            ),
+        )
+
+    def reports(self) -> list[WorkerReport]:
+        rows = self._conn.execute(
+            "SELECT worker, deleted, exit_code, metrics FROM reports ORDER BY worker"
+        ).fetchall()
+        return [WorkerReport(w, d, e, json.loads(m)) for w, d, e, m in rows]
+
+    def budget(self) -> "SharedBudget":
+        return SharedBudget(self)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class SharedBudget:
+    """DeletionBudget と同じ使い方で、上限を SharedState を通じてワーカー間で共有する"""
+
+    def __init__(self, state: SharedState):
+        self.state = state
+        self.limit = state.limit
+
+    @property
+    def used(self) -> int:
+        return self.state.used
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.limit
+
+    def reserve(self, count: int) -> int:
+        return self.state.reserve(count)
+
+    def release(self, count: int) -> None:
+        self.state.release(count)
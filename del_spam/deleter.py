@@ -1,11 +1,204 @@
 import asyncio
-from typing import Optional
+import time
+from contextlib import asynccontextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+)
 
 import discord
 from loguru import logger
 
 import del_spam.config as config
+from del_spam.cache import MessageCache
+from del_spam.checkpoint import CheckpointStore
 from del_spam.filter import FilterEngine
+from del_spam.members import MemberRoleCache
+from del_spam.metrics import MatchLog, Metrics
+from del_spam.pipeline import DeletionPipeline
+from del_spam.plan_file import PlanBatch
+from del_spam.planner import ScanStats
+from del_spam.snowflake import is_bulk_deletable
+
+if TYPE_CHECKING:
+    from del_spam.coordination import SharedState
+
+GLOBAL_BUCKET = "global"
+# Discord の一括削除 API が1回で受け付ける最大件数
+BULK_DELETE_LIMIT = 100
+# 14日を過ぎたメッセージを含む一括削除を拒否したときの Discord のエラーコード
+BULK_DELETE_TOO_OLD = 50034
+
+
+def configured_batch_size() -> int:
+    """設定の BATCH_SIZE(古い名前の BULK_DELETE_MAX も可)を一括削除 API の上限に収めた値"""
+    size = getattr(config, "BATCH_SIZE", None)
+    if size is None:
+        size = getattr(config, "BULK_DELETE_MAX", BULK_DELETE_LIMIT)
+    return max(1, min(int(size), BULK_DELETE_LIMIT))
+
+
+def _rejected_for_age(error: discord.HTTPException, message_ids: list[int]) -> bool:
+    if error.code == BULK_DELETE_TOO_OLD:
+        return True
+    return error.status == 400 and not all(map(is_bulk_deletable, message_ids))
+
+
+class DeletionBudget:
+    """実行全体で共有する削除件数の上限(並行タスク間でも正確に守る)"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.limit
+
+    def reserve(self, count: int) -> int:
+        granted = max(0, min(count, self.limit - self.used))
+        self.used += granted
+        return granted
+
+    def release(self, count: int) -> None:
+        self.used -= count
+
+
+class IntervalBudget(DeletionBudget):
+    """常駐モード用の、interval 秒ごとに使った件数を戻す削除件数の上限
+
+    区間の途中で上限に達したら、次の区間が始まるまで削除しない。
+    """
+
+    def __init__(self, limit: int, interval: float):
+        super().__init__(limit)
+        self.interval = interval
+        self.started = time.monotonic()
+
+    @property
+    def resets_in(self) -> float:
+        return max(0.0, self.started + self.interval - time.monotonic())
+
+    def _roll(self) -> None:
+        now = time.monotonic()
+        if now - self.started >= self.interval:
+            self.started = now
+            self.used = 0
+
+    @property
+    def exhausted(self) -> bool:
+        self._roll()
+        return self.used >= self.limit
+
+    def reserve(self, count: int) -> int:
+        self._roll()
+        return super().reserve(count)
+
+    def release(self, count: int) -> None:
+        # 予約した区間が終わった後に戻された分で、次の区間の上限を増やさない
+        self.used = max(0, self.used - count)
+
+
+class RateLimitScheduler:
+    """チャンネルの並行スキャン数を制限し、レート制限のバケットごとに API 呼び出しを待機させる"""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        fallback_delay: float,
+        max_retries: int = 5,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._resume_at: dict[Hashable, float] = {}
+        self.fallback_delay = fallback_delay
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.sleep_time = 0.0
+        # 設定されていれば、429 による待機を他のワーカープロセスと共有する
+        self.shared: Optional["SharedState"] = None
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._slots:
+            yield
+
+    def resume_at(self, bucket: Hashable) -> float:
+        """bucket への次の呼び出しを待たずに送れる時刻(time.monotonic 基準)"""
+        return self._resume_at.get(bucket, 0.0)
+
+    async def _wait(self, bucket: Hashable) -> None:
+        while True:
+            resume_at = max(
+                self._resume_at.get(bucket, 0.0),
+                self._resume_at.get(GLOBAL_BUCKET, 0.0),
+            )
+            if self.shared is not None:
+                resume_at = max(
+                    resume_at, self.shared.resume_at((str(bucket), GLOBAL_BUCKET))
+                )
+            delay = resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            self.sleep_time += delay
+            if self.metrics is not None:
+                self.metrics.add_time("rate_limit_sleep", delay)
+            await asyncio.sleep(delay)
+
+    def _defer(self, bucket: Hashable, retry_after: float, is_global: bool) -> None:
+        key = GLOBAL_BUCKET if is_global else bucket
+        if self.metrics is not None:
+            scope = "global" if is_global else "bucket"
+            self.metrics.inc("rate_limited", scope=scope)
+        resume_at = time.monotonic() + retry_after
+        self._resume_at[key] = max(self._resume_at.get(key, 0.0), resume_at)
+        if self.shared is not None:
+            self.shared.defer(str(key), retry_after)
+        logger.warning(f"Rate limited on {key}, retrying in {retry_after:.2f}s")
+
+    def _retry_after(self, error: discord.HTTPException) -> tuple[float, bool]:
+        headers = getattr(error.response, "headers", None) or {}
+        for name in ("Retry-After", "X-RateLimit-Reset-After"):
+            try:
+                return float(headers[name]), headers.get("X-RateLimit-Global") == "true"
+            except (KeyError, TypeError, ValueError):
+                continue
+        return self.fallback_delay, False
+
+    def _space(self, bucket: Hashable, interval: float) -> None:
+        if interval > 0:
+            resume_at = time.monotonic() + interval
+            self._resume_at[bucket] = max(self._resume_at.get(bucket, 0.0), resume_at)
+
+    async def call(
+        self,
+        bucket: Hashable,
+        func: Callable[..., Awaitable[Any]],
+        *args: Any,
+        min_interval: float = 0.0,
+    ) -> Any:
+        error: Optional[Exception] = None
+        for _ in range(self.max_retries):
+            await self._wait(bucket)
+            try:
+                result = await func(*args)
+                self._space(bucket, min_interval)
+                return result
+            except discord.RateLimited as e:
+                error = e
+                self._defer(bucket, e.retry_after, is_global=False)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+                error = e
+                self._defer(bucket, *self._retry_after(e))
+        assert error is not None
+        raise error
 
 
 class MessageDeleter:
@@ -13,18 +206,46 @@ class MessageDeleter:
         self.filter_engine = filter_engine
         self.dry_run = config.DRY_RUN
         self.max_deletions = config.MAX_DELETIONS_PER_RUN
-        self.batch_size = config.BULK_DELETE_MAX
+        self.batch_size = configured_batch_size()
         self.api_call_interval = config.API_CALL_INTERVAL
+        self.max_concurrency = getattr(config, "MAX_CONCURRENT_CHANNELS", 5)
+        self.single_delete_interval = getattr(config, "SINGLE_DELETE_INTERVAL", 1.0)
+        self.metrics = Metrics()
+        self.match_log = MatchLog(getattr(config, "MATCH_LOG_SAMPLE", 20))
+        filter_engine.metrics = self.metrics
+        self.scheduler = RateLimitScheduler(
+            self.max_concurrency, self.api_call_interval, metrics=self.metrics
+        )
+        checkpoint_path = getattr(config, "CHECKPOINT_PATH", None)
+        self.checkpoints = CheckpointStore(checkpoint_path) if checkpoint_path else None
+        cache_path = getattr(config, "MESSAGE_CACHE_PATH", None)
+        self.cache = MessageCache(cache_path) if cache_path else None
+        self.member_roles = MemberRoleCache(
+            ttl=getattr(config, "MEMBER_ROLE_CACHE_TTL", 3600.0),
+            max_guilds=getattr(config, "MEMBER_ROLE_CACHE_MAX_GUILDS", 50),
+        )
+        filter_engine.member_roles = self.member_roles
+        # ドライランの一致と、それから作る削除計画の書き出し先
+        self.matches_path = getattr(config, "DRY_RUN_MATCHES_PATH", None)
+        self.plan_path = getattr(config, "DRY_RUN_PLAN_PATH", None)
+        # ワーカープロセスとして動くときの (番号, 総数) と、ワーカー間で共有する状態
+        self.shard: Optional[tuple[int, int]] = None
+        self.shared_state: Optional["SharedState"] = None
 
     async def _bulk_delete_messages(
         self, channel: discord.TextChannel, message_ids: list[int]
     ) -> int:
         if not message_ids:
             return 0
+        if len(message_ids) == 1:
+            return await self._delete_single_message(channel, message_ids[0])
 
         try:
-            await channel.delete_messages(
-                [discord.Object(msg_id) for msg_id in message_ids]
+            self.metrics.inc("delete_requests", kind="bulk")
+            await self.scheduler.call(
+                ("delete_messages", channel.id),
+                channel.delete_messages,
+                [discord.Object(msg_id) for msg_id in message_ids],
             )
             logger.info(
                 f"Bulk deleted {len(message_ids)} messages from #{channel.name}"
@@ -36,28 +257,101 @@ class MessageDeleter:
         except discord.Forbidden:
             logger.error(f"Permission denied to bulk delete in #{channel.name}")
             return 0
+        except discord.HTTPException as e:
+            if not _rejected_for_age(e, message_ids):
+                logger.error(f"Failed to bulk delete messages in #{channel.name}: {e}")
+                return 0
+            # 14日を過ぎたメッセージが混ざると一括削除全体が拒否されるため、分割して再試行する
+            logger.warning(
+                f"Bulk delete of {len(message_ids)} messages failed in "
+                f"#{channel.name}, splitting batch: {e}"
+            )
+            middle = len(message_ids) // 2
+            return await self._bulk_delete_messages(
+                channel, message_ids[:middle]
+            ) + await self._bulk_delete_messages(channel, message_ids[middle:])
         except Exception as e:
             logger.error(f"Failed to bulk delete messages in #{channel.name}: {e}")
             return 0
 
+    async def _delete_single_message(
+        self, channel: discord.TextChannel, message_id: int
+    ) -> int:
+        try:
+            self.metrics.inc("delete_requests", kind="single")
+            await self.scheduler.call(
+                ("delete_message", channel.id),
+                channel.get_partial_message(message_id).delete,
+                min_interval=self.single_delete_interval,
+            )
+            logger.info(f"Deleted message {message_id} from #{channel.name}")
+            return 1
+        except discord.NotFound:
+            logger.warning(f"Message {message_id} not found")
+            return 1
+        except discord.Forbidden:
+            logger.error(f"Permission denied to delete in #{channel.name}")
+            return 0
+        except Exception as e:
+            logger.error(
+                f"Failed to delete message {message_id} in #{channel.name}: {e}"
+            )
+            return 0
+
+    async def _flush_batch(
+        self,
+        channel: discord.TextChannel,
+        message_ids: list[int],
+        budget: DeletionBudget,
+    ) -> int:
+        with self.metrics.timer("delete"):
+            deleted = await self._bulk_delete_messages(channel, message_ids)
+        budget.release(len(message_ids) - deleted)
+        self.metrics.inc("deletes_succeeded", deleted)
+        self.metrics.inc("deletes_failed", len(message_ids) - deleted)
+        return deleted
+
+    def _owns(self, channel: discord.TextChannel) -> bool:
+        """チャンネルがこのワーカープロセスの担当か(チャンネル ID で振り分ける)"""
+        index, count = self.shard
+        return channel.id % count == index
+
     async def delete_by_rule(
         self, bot: discord.Client, rule_name: str, guild: Optional[discord.Guild] = None
     ) -> int:
-        logger.info(f"Starting deletion for rule: {rule_name}")
+        return await self.delete_by_rules(
+            bot, [rule_name], None if guild is None else [guild]
+        )
+
+    async def delete_by_rules(
+        self,
+        bot: discord.Client,
+        rule_names: list[str],
+        guilds: Optional[list[discord.Guild]] = None,
+    ) -> int:
+        """複数ルールに基づいてメッセージを削除(履歴の取得は全ルールで1回だけ行う)"""
+        logger.info(f"Starting deletion for rule(s): {', '.join(rule_names)}")
         logger.info(f"Dry run: {self.dry_run}")
         logger.info(f"Using bulk delete API (batch size: {self.batch_size})")
 
-        if rule_name not in self.filter_engine.filters:
+        filters = self.filter_engine.filters
+        missing = [name for name in rule_names if name not in filters]
+        for rule_name in missing:
             logger.error(f"Rule not found: {rule_name}")
+        rule_names = [name for name in rule_names if name not in missing]
+        if not rule_names:
             return 0
 
-        deleted_count = 0
+        plan = self.filter_engine.scan_plan(rule_names)
+        if plan.empty:
+            logger.warning(
+                f"Rule(s) {', '.join(rule_names)} can never match any message"
+            )
+            return 0
 
-        guilds_to_process = []
-        if guild is not None:
-            guilds_to_process = [guild]
-        else:
-            guilds_to_process = bot.guilds
+        stats = ScanStats()
+
+        guilds_to_process = bot.guilds if guilds is None else guilds
 
         if not guilds_to_process:
             logger.error("No guilds accessible")
@@ -65,89 +359,126 @@ class MessageDeleter:
 
         logger.info(f"Processing {len(guilds_to_process)} guild(s)")
 
+        load_roles = self.filter_engine.uses_roles(rule_names)
+        channels: list[discord.TextChannel] = []
         for target_guild in guilds_to_process:
-            if deleted_count >= self.max_deletions:
-                logger.info(f"Reached maximum deletions limit ({self.max_deletions})")
-                break
+            if not plan.guilds.allows(target_guild.id):
+                stats.guilds_skipped += 1
+                stats.channels_skipped += len(target_guild.text_channels)
+                logger.debug(f"Skipping guild outside rule scope: {target_guild.name}")
+                continue
 
             logger.info(
                 f"Processing guild: {target_guild.name} (ID: {target_guild.id})"
             )
-
+            guild_channels = []
             for channel in target_guild.text_channels:
-                if deleted_count >= self.max_deletions:
-                    logger.info(
-                        f"Reached maximum deletions limit ({self.max_deletions})"
-                    )
-                    break
+                if not plan.channels.allows(channel.id):
+                    stats.channels_skipped += 1
+                    continue
+                if self.shard is not None and not self._owns(channel):
+                    continue
+                guild_channels.append(channel)
 
-                try:
-                    message_batch: list[int] = []
-
-                    async for message in channel.history(limit=None):
-                        if deleted_count >= self.max_deletions:
-                            break
-
-                        if self.filter_engine.matches_rule(rule_name, message):
-                            message_batch.append(message.id)
-                            logger.info(
-                                f"[BATCH] Added message {message.id} to batch "
-                                f"(batch size: {len(message_batch)}/{self.batch_size}) "
-                                f"from {message.author} in #{channel.name}: "
-                                f"{message.content[:50]}"
-                            )
-
-                            if self.dry_run:
-                                logger.info(
-                                    f"[DRY RUN] Would delete message {message.id} "
-                                    f"from {message.author} in #{channel.name}: "
-                                    f"{message.content[:50]}"
-                                )
-                                deleted_count += 1
-
-                            if (
-                                not self.dry_run
-                                and len(message_batch) >= self.batch_size
-                            ):
-                                batch_to_delete = message_batch[: self.batch_size]
-                                deleted = await self._bulk_delete_messages(
-                                    channel, batch_to_delete
-                                )
-                                deleted_count += deleted
-                                message_batch = message_batch[self.batch_size :]
-
-                                await asyncio.sleep(self.api_call_interval)
-
-                    if not self.dry_run and message_batch:
-                        deleted = await self._bulk_delete_messages(
-                            channel, message_batch
-                        )
-                        deleted_count += deleted
-                        await asyncio.sleep(self.api_call_interval)
-
-                except discord.Forbidden:
-                    logger.warning(
-                        f"Permission denied for channel: {channel.name} in {target_guild.name}"
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Error processing channel {channel.name} in {target_guild.name}: {e}"
-                    )
+            if load_roles and guild_channels:
+                # ROLE フィルターのために、メンバーのロールを実行ごとに1回だけまとめて取得する
+                await self.member_roles.load(target_guild)
+            channels.extend(guild_channels)
+
+        logger.info(
+            f"Scanning {len(channels)} channel(s) (concurrency: {self.max_concurrency})"
+        )
+
+        if self.shared_state is None:
+            budget = DeletionBudget(self.max_deletions)
+        else:
+            budget = self.shared_state.budget()
+        pipeline = DeletionPipeline(
+            self, rule_names, plan, stats, budget, self.checkpoints
+        )
+        deleted_count = await pipeline.run(channels)
 
-            logger.info(f"Completed processing guild: {target_guild.name}")
+        if budget.exhausted:
+            logger.info(f"Reached maximum deletions limit ({self.max_deletions})")
 
+        stats.log_summary()
+        logger.info(f"Rate limit wait: {self.scheduler.sleep_time:.2f}s")
         logger.info(f"Deletion completed. Total: {deleted_count} messages")
         return deleted_count
 
-    async def delete_by_rules(
+    async def delete_planned(
+        self, bot: discord.Client, batches: list[PlanBatch]
+    ) -> int:
+        """ドライランで作った削除計画のメッセージを、履歴を取得せずに削除する
+
+        チャンネルは ID から1回だけ取得し、計画のバッチをそのまま削除リクエストにする。
+        計画の作成後に削除されたメッセージは削除済みとして数える。
+        """
+        logger.info(f"Dry run: {self.dry_run}")
+
+        by_channel: dict[int, list[PlanBatch]] = {}
+        for batch in batches:
+            by_channel.setdefault(batch.channel_id, []).append(batch)
+
+        if self.shared_state is None:
+            budget = DeletionBudget(self.max_deletions)
+        else:
+            budget = self.shared_state.budget()
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(
+                    self._delete_planned_channel(bot, channel_id, planned, budget)
+                )
+                for channel_id, planned in by_channel.items()
+            ]
+        deleted_count = sum(task.result() for task in tasks)
+
+        if budget.exhausted:
+            logger.info(f"Reached maximum deletions limit ({self.max_deletions})")
+        logger.info(f"Rate limit wait: {self.scheduler.sleep_time:.2f}s")
+        logger.info(f"Deletion completed. Total: {deleted_count} messages")
+        return deleted_count
+
+    async def _delete_planned_channel(
         self,
         bot: discord.Client,
-        rule_names: list[str],
-        guild: Optional[discord.Guild] = None,
+        channel_id: int,
+        batches: list[PlanBatch],
+        budget: DeletionBudget,
     ) -> int:
-        """複数ルールに基づいてメッセージを削除"""
-        total_deleted = 0
-        for rule_name in rule_names:
-            deleted = await self.delete_by_rule(bot, rule_name, guild)
-            total_deleted += deleted
-        return total_deleted
+        async with self.scheduler.slot():
+            channel = bot.get_channel(channel_id)
+            try:
+                if channel is None:
+                    channel = await bot.fetch_channel(channel_id)
+            except discord.NotFound:
+                logger.warning(f"Channel {channel_id} no longer exists, skipping")
+                return 0
+            except discord.HTTPException as e:
+                logger.error(f"Channel {channel_id} not accessible: {e}")
+                return 0
+
+            deleted = 0
+            for batch in batches:
+                message_ids = batch.message_ids
+                message_ids = message_ids[: budget.reserve(len(message_ids))]
+                if not message_ids:
+                    break
+                if self.dry_run:
+                    logger.info(
+                        f"[DRY RUN] Would delete {len(message_ids)} planned "
+                        f"message(s) from #{channel.name}"
+                    )
+                    deleted += len(message_ids)
+                    continue
+
+                # 計画の作成から時間が経って14日を過ぎたメッセージは1件ずつ削除する
+                bulk = [i for i in message_ids if is_bulk_deletable(i)]
+                old = [i for i in message_ids if not is_bulk_deletable(i)]
+                count = await self._flush_batch(channel, bulk, budget) if bulk else 0
+                for message_id in old:
+                    count += await self._flush_batch(channel, [message_id], budget)
+                if self.cache is not None:
+                    self.cache.remove(message_ids)
+                deleted += count
+            return deleted
@@ -0,0 +1,186 @@
+import hashlib
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from operator import itemgetter
+from typing import Any, Optional, Sequence
+
+from del_spam.snowflake import TIMESTAMP_SHIFT
+
+# 覚えておく本文(指紋)の数。超えたら最も長く投稿のない本文から忘れる
+MAX_FINGERPRINTS = 50_000
+# 1つの本文について覚えておく投稿数(ルールの copies がこれより大きければそちらに合わせる)
+MAX_COPIES_PER_FINGERPRINT = 64
+# duplicate フィルターの copies に指定できる上限
+MAX_COPIES = 1000
+# 一致とした投稿の ID を覚えておく件数
+MAX_FLAGGED = 100_000
+
+# メンション・チャンネル・カスタム絵文字の記法(投稿ごとに変えて重複判定を逃れやすい)
+_MARKUP = re.compile(r"<(?:@[!&]?|#|a?:\w+:)\d+>")
+_IGNORED = re.compile(r"[\W_]+")
+
+
+def fingerprint(content: str) -> Optional[int]:
+    """表記ゆれを吸収した本文の 64 ビットの指紋(比べる文字が残らなければ None)
+
+    NFKC で全角・半角をそろえ、大文字と小文字を区別せず、メンション・空白・記号・絵文字を無視する。
+    hash() と違ってプロセスによらず同じ値になるので、ログやワーカー間で比べられる。
+    """
+    normalized = unicodedata.normalize("NFKC", _MARKUP.sub("", content)).casefold()
+    # 空白を先に除くと、正規表現で置き換える箇所が減って速い
+    normalized = _IGNORED.sub("", "".join(normalized.split()))
+    if not normalized:
+        return None
+    digest = hashlib.blake2b(normalized.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class _Posts:
+    """1つの本文について、時間窓に残っている投稿とチャンネルごとの件数"""
+
+    __slots__ = ("entries", "ids", "channels", "pending")
+
+    def __init__(self):
+        # (メッセージ ID, チャンネル ID, メッセージ)(作成時刻 = メッセージ ID の順)
+        self.entries: deque[tuple[int, int, Any]] = deque()
+        self.ids: set[int] = set()
+        self.channels: Counter[int] = Counter()
+        # まだ一致としていない投稿の数
+        self.pending = 0
+
+    def insert(self, message_id: int, channel_id: int, message: Any) -> None:
+        entry = (message_id, channel_id, message)
+        entries = self.entries
+        # 常駐モードでは末尾に、履歴の走査ではほとんど先頭に入るので、両端を先に見る
+        if not entries or message_id > entries[-1][0]:
+            entries.append(entry)
+        elif message_id < entries[0][0]:
+            entries.appendleft(entry)
+        else:
+            entries.insert(bisect_left(entries, message_id, key=itemgetter(0)), entry)
+        self.ids.add(message_id)
+        self.channels[channel_id] += 1
+        self.pending += 1
+
+    def drop(self, oldest: bool, flagged: dict[int, None]) -> None:
+        entries = self.entries
+        message_id, channel_id, _ = entries.popleft() if oldest else entries.pop()
+        self.ids.discard(message_id)
+        self.channels[channel_id] -= 1
+        if not self.channels[channel_id]:
+            del self.channels[channel_id]
+        if message_id not in flagged:
+            self.pending = max(0, self.pending - 1)
+
+
+class DuplicateIndex:
+    """1つの duplicate 条件について、最近のメッセージを本文の指紋ごとに数える
+
+    指紋ごとに時間窓内の投稿を作成時刻の順に持ち、投稿数とチャンネルごとの件数を
+    追加・破棄のたびに更新するので、1件あたりの処理は投稿数によらない。
+    しきい値に達したら窓内の投稿をすべて一致とし、すでに判定を終えた投稿を返す。
+
+    履歴の走査では複数のチャンネルを並行に新しい順で読むので、同じ本文の投稿が
+    作成時刻の順に届くとは限らない。最古と最新の投稿の差が窓の幅を超えたら、
+    届いた投稿から遠い側の端を破棄し、数える投稿が常に窓の幅に収まるようにする。
+    """
+
+    def __init__(
+        self,
+        copies: int,
+        window_ms: int,
+        channels: int = 1,
+        max_fingerprints: int = MAX_FINGERPRINTS,
+    ):
+        self.copies = copies
+        self.window_ms = window_ms
+        self.channels = channels
+        self.max_fingerprints = max_fingerprints
+        self.max_copies = max(MAX_COPIES_PER_FINGERPRINT, copies)
+        self._span = window_ms << TIMESTAMP_SHIFT
+        # 指紋 -> 窓内の投稿(最後に投稿のあった順)。ほとんどの本文は1回しか投稿されないので、
+        # 最初の投稿は (メッセージ ID, チャンネル ID, メッセージ) のまま持ち、2件目で _Posts にする
+        self._posts: OrderedDict[int, _Posts | tuple[int, int, Any]] = OrderedDict()
+        # 一致としたメッセージ ID(挿入順に古いものから忘れる)
+        self._flagged: dict[int, None] = {}
+
+    def __len__(self) -> int:
+        return len(self._posts)
+
+    def is_flagged(self, message_id: int) -> bool:
+        return message_id in self._flagged
+
+    def add(self, key: Optional[int], message: Any) -> list[Any]:
+        """message を数え、しきい値に達したら、それまでに届いた窓内の投稿を返す
+
+        返した投稿と message は一致としたものとして is_flagged で True になる。
+        """
+        if key is None:
+            return []
+        message_id = message.id
+        posts = self._posts.get(key)
+        if posts is None:
+            self._posts[key] = (message_id, message.channel.id, message)
+            if len(self._posts) > self.max_fingerprints:
+                self._posts.popitem(last=False)
+            return []
+
+        self._posts.move_to_end(key)
+        # 編集イベントなどで同じメッセージが再び届いても数え直さない
+        if isinstance(posts, tuple):
+            if posts[0] == message_id:
+                return []
+            first = posts
+            posts = self._posts[key] = _Posts()
+            posts.insert(*first)
+        elif message_id in posts.ids:
+            return []
+
+        posts.insert(message_id, message.channel.id, message)
+        entries = posts.entries
+        span = self._span
+        flagged = self._flagged
+        while entries[-1][0] - entries[0][0] > span or len(entries) > self.max_copies:
+            # message から遠い側の端を捨てる(message 自身は残る)
+            posts.drop(
+                message_id - entries[0][0] >= entries[-1][0] - message_id, flagged
+            )
+
+        if len(entries) < self.copies or len(posts.channels) < self.channels:
+            return []
+        if posts.pending == 1:
+            # しきい値を超えた後の投稿は、届いた投稿だけが新たに一致する
+            wave = [message]
+        else:
+            wave = [m for posted_id, _, m in entries if posted_id not in flagged]
+        posts.pending = 0
+        for posted in wave:
+            flagged[posted.id] = None
+        while len(flagged) > MAX_FLAGGED:
+            del flagged[next(iter(flagged))]
+        return [posted for posted in wave if posted is not message]
+
+    def add_all(self, keys: Sequence[Optional[int]], messages: Sequence[Any]) -> list:
+        found = []
+        for key, message in zip(keys, messages):
+            if key is not None:
+                found.extend(self.add(key, message))
+        return found
+
+    def expire(self, message_id: int) -> None:
+        """最後の投稿が message_id より窓の幅以上前の本文を忘れる
+
+        メッセージが時刻順に届く常駐モードで使う(履歴の走査では順序が前後するので使わない)。
+        """
+        limit = message_id - self._span
+        posts = self._posts
+        while posts:
+            key, oldest = next(iter(posts.items()))
+            newest_id = (
+                oldest[0] if isinstance(oldest, tuple) else oldest.entries[-1][0]
+            )
+            if newest_id >= limit:
+                break
+            del posts[key]
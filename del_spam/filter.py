@@ -1,12 +1,62 @@
+import hashlib
+import json
+import math
 import re
+from collections import Counter
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, List
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
-import discord
 from loguru import logger
 
+from del_spam.batch import MessageBatch
+from del_spam.duplicates import MAX_COPIES, MAX_FLAGGED, DuplicateIndex, fingerprint
+from del_spam.metrics import Metrics
+from del_spam.optimizer import Selectivity, optimize, reorder
+from del_spam.planner import EMPTY_PLAN, ScanPlan, plan_scan
+from del_spam.predicate import (
+    AllOf,
+    AnyOf,
+    ContentContains,
+    ContentEndsWith,
+    ContentNotContains,
+    ContentRegex,
+    ContentStartsWith,
+    DuplicateContent,
+    IdIn,
+    IdNotIn,
+    Never,
+    Predicate,
+    RoleIn,
+    RoleNotIn,
+    TimeRange,
+    walk,
+)
+from del_spam.rule_index import RuleIndex
+from del_spam.snowflake import snowflake_range, snowflake_to_ms, utc_ms
+
+if TYPE_CHECKING:
+    import discord
+
+    from del_spam.cache import CachedMessage, MessageCache
+    from del_spam.members import MemberRoleCache
+
+# この数のバッチを評価するごとに、計測した通過率でルールの評価順を見直す
+REORDER_INTERVAL_BATCHES = 50
+
 
 class FilterType(Enum):
     GUILD = "guild"
@@ -16,6 +66,7 @@ class FilterType(Enum):
     MESSAGE_ID = "message_id"
     TIMESTAMP = "timestamp"
     CONTENT = "content"
+    DUPLICATE = "duplicate"
     GROUP = "group"
 
 
@@ -34,6 +85,7 @@ class Operator(Enum):
     REGEX = "REGEX"
     EXISTS = "EXISTS"
     NOT_EXISTS = "NOT_EXISTS"
+    AT_LEAST = "AT_LEAST"
 
 
 def parse_timestamp(timestamp_str: str) -> datetime:
@@ -60,9 +112,13 @@ class Filter:
     values: Any = None
     start: str | None = None
     end: str | None = None
+    # duplicate 用: within 秒以内に copies 件以上、channels 個以上のチャンネル
+    copies: int | None = None
+    within: float | None = None
+    channels: int | None = None
 
     def matches(
-        self, message: discord.Message, member: discord.Member | None = None
+        self, message: "discord.Message", member: "discord.Member | None" = None
     ) -> bool:
         try:
             if self.type == FilterType.GUILD:
@@ -79,6 +135,8 @@ class Filter:
                 return self._match_timestamp(message)
             elif self.type == FilterType.CONTENT:
                 return self._match_content(message)
+            elif self.type == FilterType.DUPLICATE:
+                return self._match_duplicate(message)
             else:
                 logger.warning(f"Unknown filter type: {self.type}")
                 return False
@@ -86,7 +144,7 @@ class Filter:
             logger.error(f"Error in filter matching: {e}")
             return False
 
-    def _match_guild(self, message: discord.Message) -> bool:
+    def _match_guild(self, message: "discord.Message") -> bool:
         if message.guild is None:
             return False
 
@@ -103,7 +161,7 @@ class Filter:
             return guild_id != values[0] if values else False
         return False
 
-    def _match_channel(self, message: discord.Message) -> bool:
+    def _match_channel(self, message: "discord.Message") -> bool:
         channel_id = message.channel.id
         values = self._normalize_values(self.values)
 
@@ -117,7 +175,7 @@ class Filter:
             return channel_id != values[0] if values else False
         return False
 
-    def _match_user(self, message: discord.Message) -> bool:
+    def _match_user(self, message: "discord.Message") -> bool:
         user_id = message.author.id
         values = self._normalize_values(self.values)
 
@@ -132,15 +190,19 @@ class Filter:
         return False
 
     def _match_role(
-        self, message: discord.Message, member: discord.Member | None
+        self, message: "discord.Message", member: "discord.Member | frozenset | None"
     ) -> bool:
-        if member is None and isinstance(message.author, discord.Member):
+        if member is None and getattr(message.author, "roles", None) is not None:
+            # discord.User にはロールがなく、discord.Member だけが roles を持つ
             member = message.author
 
         if member is None:
             return False
 
-        role_ids = [role.id for role in member.roles]
+        if isinstance(member, frozenset):
+            role_ids = member
+        else:
+            role_ids = [role.id for role in member.roles]
         values = self._normalize_values(self.values)
 
         if self.operator == Operator.IN:
@@ -153,7 +215,7 @@ class Filter:
             return values[0] not in role_ids if values else False
         return False
 
-    def _match_message_id(self, message: discord.Message) -> bool:
+    def _match_message_id(self, message: "discord.Message") -> bool:
         message_id = message.id
         values = self._normalize_values(self.values)
 
@@ -167,31 +229,30 @@ class Filter:
             return message_id != values[0] if values else False
         return False
 
-    def _match_timestamp(self, message: discord.Message) -> bool:
-        msg_timestamp = message.created_at.replace(tzinfo=None)
+    def _match_timestamp(self, message: "discord.Message") -> bool:
+        # 作成時刻はメッセージ ID に含まれるので、datetime を作らずに UTC のミリ秒で比べる
+        msg_ms = snowflake_to_ms(message.id)
 
         if self.operator == Operator.BETWEEN:
             if not self.start or not self.end:
                 return False
-            start = parse_timestamp(self.start)
-            end = parse_timestamp(self.end)
-            return start <= msg_timestamp <= end
+            start_ms = utc_ms(parse_timestamp(self.start), round_up=True)
+            end_ms = utc_ms(parse_timestamp(self.end))
+            return start_ms <= msg_ms <= end_ms
 
         elif self.operator == Operator.AFTER:
             if not self.start:
                 return False
-            start = parse_timestamp(self.start)
-            return msg_timestamp >= start
+            return msg_ms >= utc_ms(parse_timestamp(self.start), round_up=True)
 
         elif self.operator == Operator.BEFORE:
             if not self.end:
                 return False
-            end = parse_timestamp(self.end)
-            return msg_timestamp <= end
+            return msg_ms <= utc_ms(parse_timestamp(self.end))
 
         return False
 
-    def _match_content(self, message: discord.Message) -> bool:
+    def _match_content(self, message: "discord.Message") -> bool:
         content = message.content.lower()
         values = self.values if isinstance(self.values, list) else [self.values]
 
@@ -211,6 +272,10 @@ class Filter:
                 return False
         return False
 
+    def _match_duplicate(self, message: "discord.Message") -> bool:
+        # 重複は FilterEngine が登録した最近のメッセージの索引で数えるので、単独では判定できない
+        return False
+
     def _normalize_values(self, values: Any) -> list:
         if values is None:
             return []
@@ -218,6 +283,97 @@ class Filter:
             return [normalize_value(v) for v in values]
         return [normalize_value(values)]
 
+    def compile(self) -> Predicate:
+        compiler = _FILTER_COMPILERS.get(self.type)
+        if compiler is None:
+            logger.warning(f"Unknown filter type: {self.type}")
+            return Never()
+        return compiler(self)
+
+    def _compile_ids(self) -> Predicate:
+        values = self._normalize_values(self.values)
+        target = self.type.value
+
+        if self.operator == Operator.IN:
+            return IdIn(target, frozenset(values))
+        elif self.operator == Operator.NOT_IN:
+            return IdNotIn(target, frozenset(values))
+        elif self.operator == Operator.EQUALS and values:
+            return IdIn(target, frozenset(values[:1]))
+        elif self.operator == Operator.NOT_EQUALS and values:
+            return IdNotIn(target, frozenset(values[:1]))
+        return Never()
+
+    def _compile_role(self) -> Predicate:
+        values = self._normalize_values(self.values)
+
+        if self.operator == Operator.IN:
+            return RoleIn(frozenset(values))
+        elif self.operator == Operator.NOT_IN:
+            return RoleNotIn(frozenset(values))
+        elif self.operator == Operator.EQUALS and values:
+            return RoleIn(frozenset(values[:1]))
+        elif self.operator == Operator.NOT_EQUALS and values:
+            return RoleNotIn(frozenset(values[:1]))
+        return Never()
+
+    def _compile_timestamp(self) -> Predicate:
+        # 境界はルールの読み込み時に一度だけメッセージ ID の範囲に変換する
+        try:
+            if self.operator == Operator.BETWEEN and self.start and self.end:
+                return TimeRange(
+                    *snowflake_range(
+                        parse_timestamp(self.start), parse_timestamp(self.end)
+                    )
+                )
+            elif self.operator == Operator.AFTER and self.start:
+                return TimeRange(*snowflake_range(parse_timestamp(self.start), None))
+            elif self.operator == Operator.BEFORE and self.end:
+                return TimeRange(*snowflake_range(None, parse_timestamp(self.end)))
+        except ValueError:
+            pass
+        return Never()
+
+    def _compile_content(self) -> Predicate:
+        values = self.values if isinstance(self.values, list) else [self.values]
+        needles = tuple(str(v).lower() for v in values)
+
+        if self.operator == Operator.CONTAINS:
+            return ContentContains(needles)
+        elif self.operator == Operator.NOT_CONTAINS:
+            return ContentNotContains(needles)
+        elif self.operator == Operator.STARTS_WITH:
+            return ContentStartsWith(needles)
+        elif self.operator == Operator.ENDS_WITH:
+            return ContentEndsWith(needles)
+        elif self.operator == Operator.REGEX:
+            try:
+                return ContentRegex(tuple(re.compile(str(v)) for v in values))
+            except re.error as e:
+                logger.error(f"Invalid regex pattern: {e}")
+        return Never()
+
+    def _compile_duplicate(self) -> Predicate:
+        if self.operator == Operator.AT_LEAST and self.copies and self.within:
+            return DuplicateContent(
+                copies=int(self.copies),
+                window_ms=int(float(self.within) * 1000),
+                channels=int(self.channels or 1),
+            )
+        return Never()
+
+
+_FILTER_COMPILERS: Dict[FilterType, Callable[[Filter], Predicate]] = {
+    FilterType.GUILD: Filter._compile_ids,
+    FilterType.CHANNEL: Filter._compile_ids,
+    FilterType.USER: Filter._compile_ids,
+    FilterType.MESSAGE_ID: Filter._compile_ids,
+    FilterType.ROLE: Filter._compile_role,
+    FilterType.TIMESTAMP: Filter._compile_timestamp,
+    FilterType.CONTENT: Filter._compile_content,
+    FilterType.DUPLICATE: Filter._compile_duplicate,
+}
+
 
 class FilterGroup:
     def __init__(self, operator: str, filters: List[Any]):
@@ -225,7 +381,7 @@ class FilterGroup:
         self.filters = filters
 
     def matches(
-        self, message: discord.Message, member: discord.Member | None = None
+        self, message: "discord.Message", member: "discord.Member | None" = None
     ) -> bool:
         if self.operator == "AND":
             return all(f.matches(message, member) for f in self.filters)
@@ -233,10 +389,210 @@ class FilterGroup:
             return any(f.matches(message, member) for f in self.filters)
         return False
 
+    def compile(self) -> Predicate:
+        children = tuple(f.compile() for f in self.filters)
+        if self.operator == "AND":
+            return AllOf(children)
+        elif self.operator == "OR":
+            return AnyOf(children)
+        return Never()
+
+
+_ID_OPERATORS = frozenset(
+    {Operator.IN, Operator.NOT_IN, Operator.EQUALS, Operator.NOT_EQUALS}
+)
+# フィルタータイプごとに意味を持つ演算子(それ以外は何にも一致しない)
+_OPERATORS_BY_TYPE: Dict[FilterType, frozenset] = {
+    FilterType.GUILD: _ID_OPERATORS,
+    FilterType.CHANNEL: _ID_OPERATORS,
+    FilterType.USER: _ID_OPERATORS,
+    FilterType.MESSAGE_ID: _ID_OPERATORS,
+    FilterType.ROLE: _ID_OPERATORS,
+    FilterType.TIMESTAMP: frozenset(
+        {Operator.BETWEEN, Operator.AFTER, Operator.BEFORE}
+    ),
+    FilterType.CONTENT: frozenset(
+        {
+            Operator.CONTAINS,
+            Operator.NOT_CONTAINS,
+            Operator.STARTS_WITH,
+            Operator.ENDS_WITH,
+            Operator.REGEX,
+        }
+    ),
+    FilterType.DUPLICATE: frozenset({Operator.AT_LEAST}),
+}
+_TIMESTAMP_FIELDS = {
+    Operator.BETWEEN: ("start", "end"),
+    Operator.AFTER: ("start",),
+    Operator.BEFORE: ("end",),
+}
+
+
+class RuleConfigError(ValueError):
+    """ルール設定の誤り。errors は「場所: 内容」の形の文字列のリスト"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def validate_rules(rules: Any) -> List[str]:
+    """ルール設定の誤りを「場所: 内容」の形で返す(空なら問題なし)
+
+    load_rule は読めないフィルターを読み飛ばすが、ここではそれらもすべて誤りとして報告する。
+    """
+    if not isinstance(rules, dict):
+        return ["rules: expected a mapping of rule name to rule"]
+    errors: List[str] = []
+    for rule_name, rule_config in rules.items():
+        path = str(rule_name)
+        if not isinstance(rule_config, dict):
+            errors.append(f"{path}: expected a mapping")
+            continue
+        if not isinstance(rule_config.get("enabled", False), bool):
+            errors.append(f"{path}.enabled: expected true or false")
+        conditions = rule_config.get("conditions", {})
+        if not isinstance(conditions, dict):
+            errors.append(f"{path}.conditions: expected a mapping")
+            continue
+        _validate_group(f"{path}.conditions", conditions, "filters", errors)
+    return errors
+
+
+def _validate_group(
+    path: str, group: Dict[str, Any], key: str, errors: List[str]
+) -> None:
+    operator = group.get("operator", "AND")
+    if operator not in ("AND", "OR"):
+        errors.append(f"{path}.operator: expected AND or OR, got {operator!r}")
+    filters = group.get(key, [])
+    if not isinstance(filters, list):
+        errors.append(f"{path}.{key}: expected a list")
+        return
+    for i, filter_def in enumerate(filters):
+        _validate_filter(f"{path}.{key}[{i}]", filter_def, errors)
+
+
+def _validate_filter(path: str, filter_def: Any, errors: List[str]) -> None:
+    if not isinstance(filter_def, dict):
+        errors.append(f"{path}: expected a mapping")
+        return
+    if filter_def.get("type") == "group":
+        _validate_group(path, filter_def, "conditions", errors)
+        return
+
+    raw_type = filter_def.get("type")
+    try:
+        filter_type = FilterType[str(raw_type).upper()]
+        operators = _OPERATORS_BY_TYPE[filter_type]
+    except KeyError:
+        errors.append(f"{path}.type: unknown filter type {raw_type!r}")
+        return
+    raw_operator = filter_def.get("operator")
+    operator = Operator.__members__.get(str(raw_operator).upper())
+    if operator not in operators:
+        supported = ", ".join(sorted(o.value for o in operators))
+        errors.append(
+            f"{path}.operator: {filter_type.value} supports {supported}, "
+            f"got {raw_operator!r}"
+        )
+        return
+
+    if filter_type == FilterType.TIMESTAMP:
+        for field_name in _TIMESTAMP_FIELDS[operator]:
+            value = filter_def.get(field_name)
+            if not isinstance(value, str) or not value:
+                errors.append(f"{path}.{field_name}: required for {operator.value}")
+                continue
+            try:
+                datetime.fromisoformat(value.rstrip("Z"))
+            except ValueError:
+                errors.append(f"{path}.{field_name}: invalid timestamp {value!r}")
+        return
+
+    if filter_type == FilterType.DUPLICATE:
+        _validate_duplicate(path, filter_def, errors)
+        return
+
+    values = filter_def.get("values")
+    if values is None or values == []:
+        errors.append(f"{path}.values: at least one value is required")
+        return
+    if operator == Operator.REGEX:
+        for i, value in enumerate(values if isinstance(values, list) else [values]):
+            try:
+                re.compile(str(value))
+            except re.error as e:
+                errors.append(f"{path}.values[{i}]: invalid regex {value!r}: {e}")
+
+
+def _validate_duplicate(path: str, filter_def: Any, errors: List[str]) -> None:
+    copies = filter_def.get("copies")
+    if not _is_int(copies) or not 2 <= copies <= MAX_COPIES:
+        errors.append(f"{path}.copies: expected an integer from 2 to {MAX_COPIES}")
+    within = filter_def.get("within")
+    if not _is_number(within) or not (math.isfinite(within) and within > 0):
+        errors.append(f"{path}.within: expected a positive number of seconds")
+    channels = filter_def.get("channels", 1)
+    if not _is_int(channels) or channels < 1:
+        errors.append(f"{path}.channels: expected a positive integer")
+    elif _is_int(copies) and channels > copies:
+        errors.append(f"{path}.channels: cannot exceed copies ({copies})")
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value: Any) -> bool:
+    return _is_int(value) or isinstance(value, float)
+
+
+def _rule_key(rule_name: str, conditions: Dict) -> str:
+    digest = hashlib.sha1(
+        json.dumps(conditions, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    # 条件が変わったルールのチェックポイントを再利用しないよう、内容のハッシュを含める
+    return f"{rule_name}:{digest[:12]}"
+
+
+@dataclass
+class RuleSet:
+    """FilterEngine.prepare_rules で作った、入れ替え前のルールセット"""
+
+    filters: Dict[str, FilterGroup]
+    compiled: Dict[str, Predicate]
+    rule_keys: Dict[str, str]
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+    @property
+    def unchanged(self) -> int:
+        return len(self.filters) - len(self.added) - len(self.changed)
+
 
 class FilterEngine:
     def __init__(self):
         self.filters: Dict[str, FilterGroup] = {}
+        self.compiled: Dict[str, Predicate] = {}
+        self.rule_keys: Dict[str, str] = {}
+        # 設定されていれば、ロールのわからない送信者のロールをここから引く
+        self.member_roles: Optional["MemberRoleCache"] = None
+        self.metrics: Optional[Metrics] = None
+        # 実行中に計測した述語ごとの通過率と、ルールごとの評価したバッチ数
+        self.selectivity: Selectivity = {}
+        self._batches_since_reorder: Counter[str] = Counter()
+        # ID からルールを引く索引(ルールを読み込むと作り直す)
+        self._index: Optional[RuleIndex] = None
+        # duplicate の条件((copies, window_ms, channels))ごとの最近のメッセージの索引
+        # 同じ条件の索引はルールの入れ替え後も引き継ぎ、空ならメッセージを登録しない
+        self.duplicates: Dict[Tuple[int, int, int], DuplicateIndex] = {}
+        # 波がしきい値に達して後から一致した、判定済みのメッセージ
+        self._late_duplicates: List[Any] = []
+        # duplicate を使うルールがあるとき、一致したメッセージの ID(二重に返さないため)
+        self._matched_ids: Dict[int, None] = {}
 
     def load_rule(self, rule_name: str, rule_config: Dict):
         if not rule_config.get("enabled", False):
@@ -244,11 +600,89 @@ class FilterEngine:
             return
 
         conditions = rule_config.get("conditions", {})
-        operator = conditions.get("operator", "AND")
-        filters = self._build_filters(conditions.get("filters", []))
-        self.filters[rule_name] = FilterGroup(operator, filters)
+        self.filters[rule_name] = self._build_group(conditions)
+        self.compiled[rule_name] = optimize(self.filters[rule_name].compile())
+        self._bind_duplicates(self.compiled.values())
+        # 捨てた述語の id が再利用されても古い計測値を引き継がないよう、計測し直す
+        self.selectivity.clear()
+        self._batches_since_reorder.clear()
+        self._index = None
+        self.rule_keys[rule_name] = _rule_key(rule_name, conditions)
         logger.info(f"Loaded rule: {rule_name}")
 
+    def _build_group(self, conditions: Dict) -> FilterGroup:
+        operator = conditions.get("operator", "AND")
+        return FilterGroup(operator, self._build_filters(conditions.get("filters", [])))
+
+    def prepare_rules(self, rules: Dict[str, Dict]) -> RuleSet:
+        """現在のルールを変えずに、rules から入れ替え用のルールセットを作る
+
+        条件が変わっていないルールはコンパイル済みのものを使い回し、変わったルールだけ作り直す。
+        誤りがあれば RuleConfigError を送出する。イベントループの外(別スレッド)で呼んでよい。
+        """
+        errors = validate_rules(rules)
+        if errors:
+            raise RuleConfigError(errors)
+
+        filters: Dict[str, FilterGroup] = {}
+        compiled: Dict[str, Predicate] = {}
+        rule_keys: Dict[str, str] = {}
+        added: List[str] = []
+        changed: List[str] = []
+        for rule_name, rule_config in rules.items():
+            if not rule_config.get("enabled", False):
+                continue
+            conditions = rule_config.get("conditions", {})
+            key = _rule_key(rule_name, conditions)
+            if self.rule_keys.get(rule_name) == key:
+                filters[rule_name] = self.filters[rule_name]
+                compiled[rule_name] = self.compiled[rule_name]
+            else:
+                (changed if rule_name in self.filters else added).append(rule_name)
+                filters[rule_name] = self._build_group(conditions)
+                compiled[rule_name] = optimize(filters[rule_name].compile())
+            rule_keys[rule_name] = key
+        removed = [rule_name for rule_name in self.filters if rule_name not in filters]
+        return RuleSet(filters, compiled, rule_keys, added, changed, removed)
+
+    def swap_rules(self, rule_set: RuleSet) -> None:
+        """prepare_rules で作ったルールセットに入れ替える
+
+        バッチの評価は同期的に行われるので、イベントループ上で呼べば
+        1つのバッチの途中でルールが入れ替わることはない。
+        """
+        index = RuleIndex(rule_set.compiled)
+        live = {
+            id(node)
+            for predicate in rule_set.compiled.values()
+            for node in walk(predicate)
+        }
+        self.filters = rule_set.filters
+        self.compiled = rule_set.compiled
+        self.rule_keys = rule_set.rule_keys
+        self._index = index
+        self._bind_duplicates(self.compiled.values())
+        # 変わっていないルールの通過率の計測値は引き継ぐ
+        self.selectivity = {k: v for k, v in self.selectivity.items() if k in live}
+        self._batches_since_reorder.clear()
+
+    def _bind_duplicates(self, compiled: Iterable[Predicate]) -> None:
+        """duplicate の述語を条件ごとの索引に結び付ける(同じ条件の述語は索引を共有する)"""
+        indexes: Dict[Tuple[int, int, int], DuplicateIndex] = {}
+        for predicate in compiled:
+            for node in walk(predicate):
+                if not isinstance(node, DuplicateContent):
+                    continue
+                key = (node.copies, node.window_ms, node.channels)
+                index = indexes.get(key)
+                if index is None:
+                    index = self.duplicates.get(key)
+                if index is None:
+                    index = DuplicateIndex(*key)
+                indexes[key] = index
+                node.bind(index)
+        self.duplicates = indexes
+
     def _build_filters(self, filter_list: List[Dict]) -> List[Any]:
         result = []
         for filter_def in filter_list:
@@ -283,6 +717,9 @@ class FilterEngine:
                             values=filter_def.get("values"),
                             start=filter_def.get("start"),
                             end=filter_def.get("end"),
+                            copies=filter_def.get("copies"),
+                            within=filter_def.get("within"),
+                            channels=filter_def.get("channels"),
                         )
                     )
             except Exception as e:
@@ -294,25 +731,201 @@ class FilterEngine:
     def matches_rule(
         self,
         rule_name: str,
-        message: discord.Message,
-        member: discord.Member | None = None,
+        message: "discord.Message",
+        member: "discord.Member | frozenset | None" = None,
     ) -> bool:
-        if rule_name not in self.filters:
+        predicate = self.compiled.get(rule_name)
+        if predicate is None:
+            return False
+        if member is None and self.member_roles is not None:
+            member = self.member_roles.roles_of(message)
+        try:
+            matched = predicate.matches(message, member)
+        except Exception as e:
+            logger.error(f"Error in filter matching: {e}")
             return False
-        return self.filters[rule_name].matches(message, member)
+        if self.metrics is not None:
+            self.metrics.inc("filter_evaluations", rule=rule_name)
+            if matched:
+                self.metrics.inc("matches", rule=rule_name)
+        return matched
+
+    def match_batch(self, rule_name: str, messages: Sequence[Any]) -> List[bool]:
+        """メッセージ列をまとめて評価し、各メッセージが一致したかを返す"""
+        batch = self._new_batch(messages)
+        flags = self._select_batch(rule_name, batch)
+        self._record_evaluations(batch)
+        return flags
+
+    def _new_batch(self, messages: Sequence[Any]) -> MessageBatch:
+        evaluations = None if self.metrics is None else Counter()
+        batch = MessageBatch(messages, self.member_roles, evaluations, self.selectivity)
+        if self.duplicates:
+            # ルールの条件によらず、評価するすべてのメッセージを重複の数に含める
+            keys = batch.column("fingerprint")
+            late = []
+            for index in self.duplicates.values():
+                late.extend(index.add_all(keys, messages))
+            if late:
+                # このバッチのメッセージは、これから評価するときに一致する
+                page_ids = set(batch.column("message_id"))
+                self._late_duplicates.extend(m for m in late if m.id not in page_ids)
+        return batch
+
+    def _record_evaluations(self, batch: MessageBatch) -> None:
+        if self.metrics is None or batch.evaluations is None:
+            return
+        for filter_type, evaluated in batch.evaluations.items():
+            self.metrics.inc("filter_type_evaluations", evaluated, type=filter_type)
+
+    def _select_batch(self, rule_name: str, batch: MessageBatch) -> List[bool]:
+        predicate = self.compiled.get(rule_name)
+        if predicate is None:
+            return [False] * batch.size
+        try:
+            batch.count(predicate.filter_type, batch.size)
+            selected = predicate.select(batch, batch.all)
+        except Exception as e:
+            logger.error(f"Error in batch filter matching: {e}")
+            return [self.matches_rule(rule_name, message) for message in batch.messages]
+        if self.metrics is not None:
+            self.metrics.inc("filter_evaluations", batch.size, rule=rule_name)
+            self.metrics.inc("matches", len(selected), rule=rule_name)
+        self._batches_since_reorder[rule_name] += 1
+        if self._batches_since_reorder[rule_name] >= REORDER_INTERVAL_BATCHES:
+            # 実測の通過率に合わせて、AND/OR の子の評価順を入れ替える
+            self._batches_since_reorder[rule_name] = 0
+            self.compiled[rule_name] = reorder(predicate, self.selectivity)
+        return batch.to_flags(selected)
+
+    def match_rules_batch(
+        self, rule_names: Sequence[str], messages: Sequence[Any]
+    ) -> List[List[str]]:
+        """メッセージ列をまとめて評価し、各メッセージに一致したルール名のリストを返す"""
+        # 列はルール間で共有するので、メッセージごとの属性の取り出しは1回で済む
+        batch = self._new_batch(messages)
+        matched: List[List[str]] = [[] for _ in messages]
+        for rule_name in rule_names:
+            for rules, is_match in zip(matched, self._select_batch(rule_name, batch)):
+                if is_match:
+                    rules.append(rule_name)
+        self._record_evaluations(batch)
+        if self.duplicates:
+            for message, rules in zip(messages, matched):
+                if rules:
+                    self._remember_match(message.id)
+        return matched
 
     def get_matching_rules(
         self,
-        message: discord.Message,
-        member: discord.Member | None = None,
+        message: "discord.Message",
+        member: "discord.Member | None" = None,
+        rule_names: Optional[Collection[str]] = None,
     ) -> List[str]:
-        return [
+        if self.duplicates:
+            key = fingerprint(message.content)
+            for duplicates in self.duplicates.values():
+                # 常駐モードではメッセージが時刻順に届くので、窓を過ぎた本文を忘れてよい
+                duplicates.expire(message.id)
+                self._late_duplicates.extend(duplicates.add(key, message))
+        # 全ルールではなく、メッセージのサーバー・チャンネル・送信者に関係するルールだけ評価する
+        index = self.rule_index
+        if rule_names is None:
+            candidates = index.candidates(message)
+        else:
+            candidates = index.candidates_in(message, rule_names)
+        if not candidates:
+            return []
+        if member is None and self.member_roles is not None:
+            # ロールの解決はルールごとではなくメッセージごとに1回だけ行う
+            member = self.member_roles.roles_of(message)
+        matched = [
             rule_name
-            for rule_name in self.filters
+            for rule_name in candidates
             if self.matches_rule(rule_name, message, member)
         ]
+        if matched and self.duplicates:
+            self._remember_match(message.id)
+        return matched
+
+    def take_duplicate_matches(
+        self, rule_names: Optional[Collection[str]] = None
+    ) -> List[Tuple[Any, List[str]]]:
+        """duplicate の波がしきい値に達したことで後から一致した、判定済みのメッセージを返す
+
+        しきい値に達する前に届いた投稿は、判定した時点では一致しない。get_matching_rules や
+        match_rules_batch の後に呼び、返されたメッセージと一致したルール名も削除する。
+        rule_names を省略すると、読み込まれているすべてのルールで判定する。
+        """
+        late, self._late_duplicates = self._late_duplicates, []
+        if rule_names is None:
+            rule_names = self.compiled
+        result = []
+        for message in late:
+            if message.id in self._matched_ids:
+                continue
+            rules = [name for name in rule_names if self.matches_rule(name, message)]
+            if rules:
+                self._remember_match(message.id)
+                result.append((message, rules))
+        return result
+
+    def _remember_match(self, message_id: int) -> None:
+        self._matched_ids[message_id] = None
+        if len(self._matched_ids) > MAX_FLAGGED:
+            del self._matched_ids[next(iter(self._matched_ids))]
+
+    @property
+    def rule_index(self) -> RuleIndex:
+        if self._index is None:
+            self._index = RuleIndex(self.compiled)
+        return self._index
+
+    def scan_plan(self, rule_names: Sequence[str]) -> ScanPlan:
+        """いずれかのルールに一致しうるメッセージをすべて含む取得範囲"""
+        plan = EMPTY_PLAN
+        for rule_name in rule_names:
+            predicate = self.compiled.get(rule_name)
+            if predicate is not None:
+                plan = plan.union(plan_scan(predicate))
+        return plan
+
+    def uses_roles(self, rule_names: Sequence[str]) -> bool:
+        return any(
+            isinstance(node, (RoleIn, RoleNotIn))
+            for rule_name in rule_names
+            if rule_name in self.compiled
+            for node in walk(self.compiled[rule_name])
+        )
+
+    def filter_types(self, rule_names: Sequence[str]) -> frozenset[str]:
+        """ルールが参照するフィルタータイプ(メッセージのどの項目を保持すべきか)"""
+        return frozenset(
+            node.filter_type
+            for rule_name in rule_names
+            if rule_name in self.compiled
+            for node in walk(self.compiled[rule_name])
+        )
+
+    def rule_set_key(self, rule_names: Sequence[str]) -> str:
+        """ルールの組み合わせごとのチェックポイントのキー(1ルールなら rule_keys と同じ)"""
+        return "+".join(sorted(self.rule_keys[rule_name] for rule_name in rule_names))
+
+    def scan_cache(
+        self, rule_names: Sequence[str], cache: "MessageCache"
+    ) -> Iterator[tuple["CachedMessage", List[str]]]:
+        """ネットワークに接続せず、キャッシュ済みメッセージからいずれかのルールに一致するものを返す"""
+        allowed = frozenset(rule_names)
+        for message in cache.iter_messages(self.scan_plan(rule_names)):
+            matched = self.get_matching_rules(message, rule_names=allowed)
+            if matched:
+                yield message, matched
 
     def load_all_rules(self, rules: Dict[str, Dict]) -> None:
         for rule_name, rule_config in rules.items():
             self.load_rule(rule_name, rule_config)
-        logger.info(f"Loaded {len(self.filters)} rules")
+        self._index = RuleIndex(self.compiled)
+        logger.info(
+            f"Loaded {len(self.filters)} rules "
+            f"({self._index.indexed_rules} indexed by guild/channel/user ID)"
+        )
@@ -0,0 +1,73 @@
+import re
+from typing import Callable, Iterable, Literal
+
+KeywordMode = Literal["contains", "prefix", "suffix"]
+
+# これ以下の件数なら、正規表現を組み立てるより str のメソッドで順に調べる方が速い
+LINEAR_SCAN_MAX = 48
+
+_END = ""
+
+
+def _build_trie(keywords: Iterable[str]) -> dict:
+    root: dict = {}
+    for keyword in keywords:
+        node = root
+        for char in keyword:
+            if _END in node:
+                # より短いキーワードで既に一致するので、これ以上伸ばす必要はない
+                break
+            node = node.setdefault(char, {})
+        else:
+            node.clear()
+            node[_END] = {}
+    return root
+
+
+def _trie_regex(node: dict) -> str:
+    if _END in node:
+        return ""
+    branches = [re.escape(char) + _trie_regex(child) for char, child in node.items()]
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
+
+
+def _compile(keywords: list[str]) -> re.Pattern:
+    try:
+        return re.compile(_trie_regex(_build_trie(keywords)))
+    except (re.error, RecursionError):
+        return re.compile("|".join(map(re.escape, keywords)))
+
+
+def compile_keywords(
+    keywords: Iterable[str], mode: KeywordMode
+) -> Callable[[str], bool]:
+    """いずれかのキーワードを含む/で始まる/で終わるかを1回の走査で判定する関数を返す
+
+    キーワードはトライ木にまとめてから1つの正規表現にするため、
+    判定のコストはキーワード数ではなくテキストの長さに比例する。
+    """
+    keywords = list(dict.fromkeys(keywords))
+    if not keywords:
+        return lambda text: False
+    if "" in keywords:
+        return lambda text: True
+
+    if len(keywords) <= LINEAR_SCAN_MAX:
+        if mode == "contains":
+            return lambda text: any(keyword in text for keyword in keywords)
+        affixes = tuple(keywords)
+        if mode == "prefix":
+            return lambda text: text.startswith(affixes)
+        return lambda text: text.endswith(affixes)
+
+    if mode == "contains":
+        search = _compile(keywords).search
+        return lambda text: search(text) is not None
+    if mode == "prefix":
+        match = _compile(keywords).match
+        return lambda text: match(text) is not None
+    # 末尾の一致は、反転したキーワードを反転したテキストの先頭で調べる
+    reversed_match = _compile([keyword[::-1] for keyword in keywords]).match
+    return lambda text: reversed_match(text[::-1]) is not None
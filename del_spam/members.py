@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import discord
+from loguru import logger
+
+
+class MemberRoleCache:
+    """サーバーごとのメンバー → ロール ID の集合のキャッシュ
+
+    履歴のメッセージの author がキャッシュされていない User だとロールがわからないため、
+    実行の最初にサーバーのメンバーをまとめて取得しておく。
+    TTL を過ぎたサーバーは次の load で取り直し、それまでは取得済みのロールを使い続ける
+    (数時間かかる走査の途中でロールがわからなくならないように)。
+    max_guilds を超えたら古いものから捨てる。
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_guilds: int = 50):
+        self.ttl = ttl
+        self.max_guilds = max_guilds
+        self._guilds: OrderedDict[int, tuple[float, dict[int, frozenset]]] = (
+            OrderedDict()
+        )
+
+    def _roles(self, guild_id: int) -> Optional[dict[int, frozenset]]:
+        entry = self._guilds.get(guild_id)
+        if entry is None:
+            return None
+        self._guilds.move_to_end(guild_id)
+        return entry[1]
+
+    async def load(self, guild: discord.Guild) -> None:
+        """guild のメンバーを取得する(取得から TTL 以内なら何もしない)"""
+        entry = self._guilds.get(guild.id)
+        if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+            return
+
+        started = time.perf_counter()
+        try:
+            if guild.chunked:
+                members = guild.members
+            else:
+                # Gateway のチャンク取得が使えない場合は、1000件ずつの HTTP 取得にする
+                try:
+                    members = await guild.chunk()
+                except discord.ClientException:
+                    members = [m async for m in guild.fetch_members(limit=None)]
+        except (discord.ClientException, discord.HTTPException) as e:
+            # 取り直しに失敗したときは、前に取得したロールを使い続ける
+            logger.warning(
+                f"[MEMBERS] Could not load members of {guild.name}, "
+                f"ROLE filters only see cached members: {e}"
+            )
+            return
+
+        roles = {
+            member.id: frozenset(role.id for role in member.roles) for member in members
+        }
+        self._guilds[guild.id] = (time.monotonic(), roles)
+        while len(self._guilds) > self.max_guilds:
+            self._guilds.popitem(last=False)
+        logger.info(
+            f"[MEMBERS] Loaded roles of {len(roles)} member(s) in {guild.name} "
+            f"({time.perf_counter() - started:.2f}s)"
+        )
+
+    def get(self, guild_id: int, user_id: int) -> Optional[frozenset]:
+        roles = self._roles(guild_id)
+        return None if roles is None else roles.get(user_id)
+
+    def roles_of(self, message: Any) -> Optional[frozenset]:
+        """メッセージの送信者のロール ID(author にロールがあればそれを優先する)"""
+        roles = getattr(message.author, "roles", None)
+        if roles is not None:
+            return frozenset(role.id for role in roles)
+        if message.guild is None:
+            return None
+        return self.get(message.guild.id, message.author.id)
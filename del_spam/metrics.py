@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from loguru import logger
+
+# ラベル付きカウンターのキー: (名前, ((ラベル名, 値), ...))
+MetricKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _prometheus_name(key: MetricKey, suffix: str = "") -> str:
+    name, labels = key
+    name = f"del_spam_{name}{suffix}"
+    if not labels:
+        return name
+    rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{rendered}}}"
+
+
+class Metrics:
+    """実行中のカウンターと段ごとの所要時間を集計する"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: Counter[MetricKey] = Counter()
+        self.timings: Counter[str] = Counter()
+
+    def inc(self, name: str, value: int = 1, **labels: Any) -> None:
+        self.counters[_key(name, labels)] += value
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.timings[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - started
+
+    def summary(self) -> dict[str, Any]:
+        counters: dict[str, Any] = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            if labels:
+                label = ",".join(f"{k}={v}" for k, v in labels)
+                counters.setdefault(name, {})[label] = value
+            else:
+                counters[name] = value
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "counters": counters,
+            "stage_seconds": {
+                stage: round(seconds, 3)
+                for stage, seconds in sorted(self.timings.items())
+            },
+        }
+
+    def export(self) -> dict[str, Any]:
+        """別プロセスの Metrics に merge するための JSON にできる形"""
+        return {
+            "started_at": self.started_at,
+            "counters": [
+                [name, [list(label) for label in labels], value]
+                for (name, labels), value in self.counters.items()
+            ],
+            "timings": dict(self.timings),
+        }
+
+    def merge(self, exported: dict[str, Any]) -> None:
+        """export した別の Metrics の値を足し合わせる(複数ワーカーの集計用)"""
+        self.started_at = min(self.started_at, exported["started_at"])
+        for name, labels, value in exported["counters"]:
+            self.counters[name, tuple(tuple(label) for label in labels)] += value
+        self.timings.update(exported["timings"])
+
+    def write_json(self, path: str | Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.summary(), indent=2) + "\n")
+        logger.info(f"[METRICS] Wrote run summary to {path}")
+
+    def log_summary(self) -> None:
+        stages = ", ".join(f"{k} {v:.2f}s" for k, v in sorted(self.timings.items()))
+        logger.info(f"[METRICS] Stage time: {stages or 'none'}")
+        for (name, labels), value in sorted(self.counters.items()):
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            logger.info(f"[METRICS] {name}{f'{{{label}}}' if label else ''}: {value}")
+
+    def to_prometheus(self) -> str:
+        lines = []
+        declared = set()
+        for key, value in sorted(self.counters.items()):
+            if key[0] not in declared:
+                declared.add(key[0])
+                lines.append(f"# TYPE del_spam_{key[0]}_total counter")
+            lines.append(f"{_prometheus_name(key, '_total')} {value}")
+        lines.append("# TYPE del_spam_stage_seconds_total counter")
+        for stage, seconds in sorted(self.timings.items()):
+            key = _key("stage_seconds", {"stage": stage})
+            lines.append(f"{_prometheus_name(key, '_total')} {seconds:.6f}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Prometheus のテキスト形式でメトリクスを返す HTTP エンドポイントを開始する"""
+
+        async def handle(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                pass
+            body = self.to_prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"[METRICS] Serving Prometheus metrics on http://{host}:{port}/")
+        return server
+
+
+class MatchLog:
+    """一致したメッセージのログを最初の sample 件だけ INFO で出し、残りは DEBUG にする
+
+    DEBUG の行は出力されるときだけ組み立てるので、ログがホットパスの負荷にならない。
+    """
+
+    def __init__(self, sample: int):
+        self.sample = sample
+        self.count = 0
+
+    def log(self, build: Callable[[], str]) -> None:
+        self.count += 1
+        if self.count <= self.sample:
+            logger.info(build())
+            if self.count == self.sample:
+                logger.info(
+                    f"Logged {self.sample} matched message(s), "
+                    "further matches are logged at DEBUG level"
+                )
+        else:
+            logger.opt(lazy=True).debug("{}", build)
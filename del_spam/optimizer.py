@@ -0,0 +1,182 @@
+from typing import Callable, Optional
+
+from del_spam.predicate import (
+    AllOf,
+    AnyOf,
+    ContentContains,
+    ContentEndsWith,
+    ContentNotContains,
+    ContentRegex,
+    ContentStartsWith,
+    DuplicateContent,
+    IdIn,
+    IdNotIn,
+    Never,
+    Predicate,
+    RoleIn,
+    RoleNotIn,
+    TimeRange,
+)
+
+# 1メッセージあたりの評価コストの目安(ID の集合判定を 1 とする)
+_COSTS: dict[type, float] = {
+    IdIn: 1.0,
+    IdNotIn: 1.0,
+    TimeRange: 1.5,
+    RoleIn: 3.0,
+    RoleNotIn: 3.0,
+    # 指紋の列は索引への登録で計算済みなので、重複しない本文は辞書を1回引くだけ
+    DuplicateContent: 2.0,
+    ContentStartsWith: 4.0,
+    ContentEndsWith: 4.0,
+    ContentContains: 6.0,
+    ContentNotContains: 6.0,
+    ContentRegex: 20.0,
+}
+
+# 述語ごとの [評価したメッセージ数, 通過(一致)したメッセージ数]。キーは id(predicate)
+Selectivity = dict[int, list[int]]
+
+# この件数以上評価した述語だけ、実測の通過率で並べ替える
+MIN_OBSERVATIONS = 1000
+
+
+def estimate_cost(predicate: Predicate) -> float:
+    if isinstance(predicate, (AllOf, AnyOf)):
+        return sum(estimate_cost(child) for child in predicate.children) or 1.0
+    return _COSTS.get(type(predicate), 1.0)
+
+
+def _min_optional(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max_optional(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _merge_all(a: Predicate, b: Predicate) -> Optional[Predicate]:
+    """a AND b を1つの述語で表せる場合はそれを返す"""
+    if isinstance(a, IdIn) and isinstance(b, IdIn) and a.target == b.target:
+        ids = a.ids & b.ids
+        return IdIn(a.target, ids) if ids else Never()
+    if isinstance(a, IdNotIn) and isinstance(b, IdNotIn) and a.target == b.target:
+        return IdNotIn(a.target, a.ids | b.ids)
+    if isinstance(a, IdIn) and isinstance(b, IdNotIn) and a.target == b.target:
+        ids = a.ids - b.ids
+        return IdIn(a.target, ids) if ids else Never()
+    if isinstance(a, IdNotIn) and isinstance(b, IdIn) and a.target == b.target:
+        return _merge_all(b, a)
+    if isinstance(a, RoleNotIn) and isinstance(b, RoleNotIn):
+        return RoleNotIn(a.ids | b.ids)
+    if isinstance(a, TimeRange) and isinstance(b, TimeRange):
+        start = _max_optional(a.start_id, b.start_id)
+        end = _min_optional(a.end_id, b.end_id)
+        if start is not None and end is not None and start > end:
+            return Never()
+        return TimeRange(start, end)
+    if isinstance(a, ContentNotContains) and isinstance(b, ContentNotContains):
+        return ContentNotContains(tuple(dict.fromkeys(a.needles + b.needles)))
+    return None
+
+
+def _merge_any(a: Predicate, b: Predicate) -> Optional[Predicate]:
+    """a OR b を1つの述語で表せる場合はそれを返す"""
+    if isinstance(a, IdIn) and isinstance(b, IdIn) and a.target == b.target:
+        return IdIn(a.target, a.ids | b.ids)
+    if isinstance(a, IdNotIn) and isinstance(b, IdNotIn) and a.target == b.target:
+        return IdNotIn(a.target, a.ids & b.ids)
+    if isinstance(a, RoleIn) and isinstance(b, RoleIn):
+        return RoleIn(a.ids | b.ids)
+    if isinstance(a, ContentContains) and isinstance(b, ContentContains):
+        return ContentContains(tuple(dict.fromkeys(a.needles + b.needles)))
+    if isinstance(a, ContentStartsWith) and isinstance(b, ContentStartsWith):
+        return ContentStartsWith(tuple(dict.fromkeys(a.prefixes + b.prefixes)))
+    if isinstance(a, ContentEndsWith) and isinstance(b, ContentEndsWith):
+        return ContentEndsWith(tuple(dict.fromkeys(a.suffixes + b.suffixes)))
+    if isinstance(a, ContentRegex) and isinstance(b, ContentRegex):
+        return ContentRegex(tuple(dict.fromkeys(a.patterns + b.patterns)))
+    return None
+
+
+def _merge_children(
+    children: list[Predicate],
+    merge: Callable[[Predicate, Predicate], Optional[Predicate]],
+) -> list[Predicate]:
+    merged: list[Predicate] = []
+    for child in children:
+        for i, existing in enumerate(merged):
+            combined = merge(existing, child)
+            if combined is not None:
+                merged[i] = combined
+                break
+        else:
+            merged.append(child)
+    return merged
+
+
+def optimize(predicate: Predicate) -> Predicate:
+    """結果を変えずに述語木を簡約し、安い条件から評価されるよう並べ替える
+
+    - 同じ演算子のネストしたグループを平坦化する
+    - 重複した条件を取り除き、同じ項目の条件を1つにまとめる(矛盾すれば Never)
+    - 子を推定コストの昇順に並べる
+    """
+    if not isinstance(predicate, (AllOf, AnyOf)):
+        return predicate
+
+    group = type(predicate)
+    children: list[Predicate] = []
+    for child in predicate.children:
+        child = optimize(child)
+        if isinstance(child, group):
+            children.extend(child.children)
+        else:
+            children.append(child)
+    children = list(dict.fromkeys(children))
+
+    if group is AllOf:
+        if any(isinstance(child, Never) for child in children):
+            return Never()
+        children = _merge_children(children, _merge_all)
+        if any(isinstance(child, Never) for child in children):
+            return Never()
+    else:
+        children = [child for child in children if not isinstance(child, Never)]
+        children = _merge_children(children, _merge_any)
+        if not children:
+            return Never()
+
+    if len(children) == 1:
+        return children[0]
+    children.sort(key=estimate_cost)
+    return group(tuple(children))
+
+
+def _rank(child: Predicate, selectivity: Selectivity, conjunctive: bool) -> float:
+    cost = estimate_cost(child)
+    evaluated, passed = selectivity.get(id(child), (0, 0))
+    if evaluated < MIN_OBSERVATIONS:
+        # 実測が少ないうちは通過率を 1/2 とみなし、コスト順を保つ
+        rate = 0.5
+    else:
+        rate = passed / evaluated
+    # AND は多く落とす条件、OR は多く一致する条件を、コストあたりで先に評価する
+    useful = 1.0 - rate if conjunctive else rate
+    return cost / max(useful, 1e-6)
+
+
+def reorder(predicate: Predicate, selectivity: Selectivity) -> Predicate:
+    """実行中に計測した通過率で AND/OR の子の評価順を並べ替える"""
+    if not isinstance(predicate, (AllOf, AnyOf)):
+        return predicate
+    conjunctive = isinstance(predicate, AllOf)
+    children = [reorder(child, selectivity) for child in predicate.children]
+    # 並べ替えた子グループにも、元のグループの計測値を引き継ぐ
+    for old, new in zip(predicate.children, children):
+        if old is not new and id(old) in selectivity:
+            selectivity[id(new)] = selectivity.pop(id(old))
+    children.sort(key=lambda child: _rank(child, selectivity, conjunctive))
+    if all(a is b for a, b in zip(children, predicate.children)):
+        return predicate
+    return type(predicate)(tuple(children))
@@ -0,0 +1,410 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+import discord
+from loguru import logger
+
+from del_spam.cache import CachedMessage
+from del_spam.checkpoint import Checkpoint, CheckpointStore
+from del_spam.plan_file import write_plan
+from del_spam.planner import (
+    HISTORY_PAGE_SIZE,
+    DirectFetch,
+    ScanPlan,
+    ScanStats,
+    iter_planned_messages,
+)
+from del_spam.records import MatchWriter, RecordFactory, ScanRecord
+from del_spam.snowflake import is_bulk_deletable
+
+if TYPE_CHECKING:
+    from del_spam.deleter import DeletionBudget, MessageDeleter
+
+PAGE_QUEUE_SIZE = 8
+MATCH_QUEUE_SIZE = 32
+OLD_MESSAGE_QUEUE_SIZE = 1000
+
+
+@dataclass
+class ChannelScan:
+    channel: discord.TextChannel
+    previous: Optional[Checkpoint] = None
+    # 判定と削除キューへの投入が済んだ最古のメッセージ ID と、このスキャンで見た最新の ID
+    oldest_scanned_id: Optional[int] = None
+    newest_scanned_id: Optional[int] = None
+    # 削除キューに入っていてまだ処理されていないメッセージ ID
+    outstanding: set[int] = field(default_factory=set)
+    exhausted: bool = False
+    truncated: bool = False
+    finished: bool = False
+
+    def history_bounds(self) -> tuple[Optional[int], Optional[int]]:
+        if self.previous is None:
+            return None, None
+        if self.previous.completed:
+            return self.previous.newest_scanned_id, None
+        return None, self.previous.oldest_scanned_id
+
+    def checkpoint(self) -> Optional[Checkpoint]:
+        previous = self.previous
+        completed = (
+            self.finished
+            and self.exhausted
+            and not self.truncated
+            and not self.outstanding
+        )
+        if previous is not None and previous.completed:
+            # 完了済みチャンネルの差分スキャンは、最後まで終わったときだけ記録する
+            if not completed:
+                return None
+            newest = max(
+                (
+                    i
+                    for i in (previous.newest_scanned_id, self.newest_scanned_id)
+                    if i is not None
+                ),
+                default=None,
+            )
+            return Checkpoint(previous.oldest_scanned_id, newest, True)
+
+        oldest = self.oldest_scanned_id
+        if self.outstanding:
+            # 未処理のメッセージを次回のスキャン範囲に残す
+            oldest = max(self.outstanding) + 1
+        newest = self.newest_scanned_id
+        if previous is not None:
+            oldest = oldest or previous.oldest_scanned_id
+            newest = previous.newest_scanned_id or newest
+        if oldest is None and not completed:
+            return None
+        return Checkpoint(oldest, newest, completed)
+
+
+ScannedMessage = ScanRecord | CachedMessage
+
+# ページ/一致 ID が None の要素はそのチャンネルの終端を表す
+PageItem = Optional[tuple[ChannelScan, Optional[list[ScannedMessage]]]]
+MatchItem = Optional[tuple[ChannelScan, Optional[list[int]], Optional[int]]]
+OldMessageItem = Optional[tuple[ChannelScan, int]]
+
+
+class DeletionPipeline:
+    """履歴の取得・ルール判定・削除を有界キューでつなぎ、各段を並行に動かす"""
+
+    def __init__(
+        self,
+        deleter: "MessageDeleter",
+        rule_names: list[str],
+        plan: ScanPlan,
+        stats: ScanStats,
+        budget: "DeletionBudget",
+        checkpoints: Optional[CheckpointStore] = None,
+    ):
+        self.deleter = deleter
+        self.rule_names = rule_names
+        self.rule_key = deleter.filter_engine.rule_set_key(rule_names)
+        self.plan = plan
+        # ID を直接取得するかは、走査するチャンネル数がわかる run で決める
+        self.direct: Optional[DirectFetch] = None
+        self.stats = stats
+        self.budget = budget
+        # ドライランでは何も削除しないので、本番の再開位置として記録しない
+        self.checkpoints = None if deleter.dry_run else checkpoints
+        self.pages: asyncio.Queue[PageItem] = asyncio.Queue(PAGE_QUEUE_SIZE)
+        self.matches: asyncio.Queue[MatchItem] = asyncio.Queue(MATCH_QUEUE_SIZE)
+        self.old_messages: asyncio.Queue[OldMessageItem] = asyncio.Queue(
+            OLD_MESSAGE_QUEUE_SIZE
+        )
+        # キューが満杯のときに溢れた古いメッセージ(一括削除の後にまとめて削除する)
+        self.old_spill: deque[tuple[ChannelScan, int]] = deque()
+        self.deleted_count = 0
+        # チャンネル ID -> スキャン(duplicate で後から一致したメッセージの送り先)
+        self.scans: dict[int, ChannelScan] = {}
+        # ドライランの一致はメモリに溜めず、ファイルに書き出す
+        self.match_writer: Optional[MatchWriter] = None
+        if deleter.dry_run and deleter.matches_path:
+            self.match_writer = MatchWriter(deleter.matches_path)
+
+    async def run(self, channels: list[discord.TextChannel]) -> int:
+        self.direct = self.plan.direct_fetch(len(channels))
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self._match())
+                tg.create_task(self._delete())
+                tg.create_task(self._delete_old())
+                await asyncio.gather(*(self._fetch(channel) for channel in channels))
+                await self.pages.put(None)
+        finally:
+            if self.match_writer is not None:
+                self.match_writer.close()
+        if self.match_writer is not None and self.deleter.plan_path:
+            # 一致をチャンネル・ID 順に並べ、そのまま実行できる削除計画にする
+            write_plan(
+                [self.match_writer.path],
+                self.deleter.plan_path,
+                self.deleter.batch_size,
+            )
+        return self.deleted_count
+
+    def _start_scan(self, channel: discord.TextChannel) -> ChannelScan:
+        scan = ChannelScan(channel)
+        self.scans[channel.id] = scan
+        if self.checkpoints is None:
+            return scan
+
+        scan.previous = self.checkpoints.get(
+            self.rule_key, channel.guild.id, channel.id
+        )
+        after, before = scan.history_bounds()
+        if after is not None:
+            logger.info(f"[CHECKPOINT] Scanning #{channel.name} after {after}")
+        elif before is not None:
+            logger.info(f"[CHECKPOINT] Resuming #{channel.name} before {before}")
+        return scan
+
+    def _save_checkpoint(self, scan: ChannelScan) -> None:
+        if self.checkpoints is None:
+            return
+        checkpoint = scan.checkpoint()
+        if checkpoint is not None:
+            self.checkpoints.save(
+                self.rule_key, scan.channel.guild.id, scan.channel.id, checkpoint
+            )
+
+    async def _iter_messages(
+        self,
+        channel: discord.TextChannel,
+        after: Optional[int],
+        before: Optional[int],
+    ) -> AsyncIterator[ScannedMessage]:
+        cache = self.deleter.cache
+        if cache is None:
+            engine = self.deleter.filter_engine
+            make_record = RecordFactory(
+                channel.guild.id, channel.id, engine.filter_types(self.rule_names)
+            )
+            fetched = 0
+            async for message in iter_planned_messages(
+                channel, self.plan, self.stats, after, before, self.direct
+            ):
+                fetched += 1
+                if fetched % HISTORY_PAGE_SIZE == 0:
+                    # ルールの再読み込みで参照する項目が増えても取りこぼさないよう、ページごとに見直す
+                    make_record.filter_types = engine.filter_types(self.rule_names)
+                # discord.Message は判定に使う項目だけを残した記録に変換して手放す
+                yield make_record(message)
+            return
+
+        # キャッシュを差分更新してから、判定はキャッシュに対して行う
+        await cache.sync_channel(channel)
+        for message in cache.iter_messages(self.plan, channel.id, after, before):
+            yield message
+
+    async def _fetch(self, channel: discord.TextChannel) -> None:
+        async with self.deleter.scheduler.slot():
+            scan = self._start_scan(channel)
+            after, before = scan.history_bounds()
+            page: list[ScannedMessage] = []
+            metrics = self.deleter.metrics
+            # キューへの投入待ちを除いた、履歴の取得にかかった時間を計る
+            fetch_started = time.perf_counter()
+            try:
+                if not self.budget.exhausted:
+                    async for message in self._iter_messages(channel, after, before):
+                        page.append(message)
+                        if len(page) >= HISTORY_PAGE_SIZE:
+                            metrics.add_time(
+                                "fetch", time.perf_counter() - fetch_started
+                            )
+                            await self._put_page(scan, page)
+                            page = []
+                            fetch_started = time.perf_counter()
+                            if self.budget.exhausted:
+                                break
+                    else:
+                        scan.exhausted = True
+            except discord.Forbidden:
+                logger.warning(
+                    f"Permission denied for channel: {channel.name} in {channel.guild.name}"
+                )
+            except Exception as e:
+                logger.error(
+                    f"Error processing channel {channel.name} in {channel.guild.name}: {e}"
+                )
+
+            metrics.add_time("fetch", time.perf_counter() - fetch_started)
+            if page:
+                await self._put_page(scan, page)
+            await self.pages.put((scan, None))
+
+    async def _put_page(self, scan: ChannelScan, page: list[ScannedMessage]) -> None:
+        self.deleter.metrics.inc("messages_fetched", len(page))
+        self.deleter.metrics.inc("pages_fetched")
+        await self.pages.put((scan, page))
+
+    async def _match(self) -> None:
+        engine = self.deleter.filter_engine
+        while (item := await self.pages.get()) is not None:
+            scan, page = item
+            if page is None:
+                await self.matches.put((scan, None, None))
+                continue
+
+            if scan.truncated:
+                # 上限に達した位置より先を判定済みとして記録しないよう、残りのページは捨てる
+                continue
+
+            if scan.newest_scanned_id is None:
+                scan.newest_scanned_id = page[0].id
+
+            matched: list[int] = []
+            scanned_id: Optional[int] = None
+            # 選択されたすべてのルールを同じページに対して評価する
+            with self.deleter.metrics.timer("match"):
+                matched_rules = engine.match_rules_batch(self.rule_names, page)
+            # 上限の予約はページごとにまとめて行う(共有状態では予約ごとに SQLite の排他を取る)
+            hits = sum(1 for rules in matched_rules if rules)
+            granted = self.budget.reserve(hits) if hits else 0
+            for message, rules in zip(page, matched_rules):
+                if rules:
+                    if not granted:
+                        scan.truncated = True
+                        break
+
+                    granted -= 1
+                    matched.append(message.id)
+                    self._log_match(scan, message, rules)
+                scanned_id = message.id
+
+            await self.matches.put((scan, matched, scanned_id))
+            await self._match_duplicates()
+
+        await self.matches.put(None)
+
+    async def _match_duplicates(self) -> None:
+        """duplicate の波がしきい値に達して後から一致した、判定済みのメッセージを削除に回す
+
+        しきい値に達する前の投稿は、ほかのチャンネルや前のページで判定済みのことがある。
+        """
+        late = self.deleter.filter_engine.take_duplicate_matches(self.rule_names)
+        # 索引はエンジンが実行をまたいで持つので、この実行で走査していないチャンネルは除く
+        late = [item for item in late if item[0].channel.id in self.scans]
+        if not late:
+            return
+        granted = self.budget.reserve(len(late))
+        by_scan: dict[int, tuple[ChannelScan, list[int]]] = {}
+        for message, rules in late[:granted]:
+            scan = self.scans[message.channel.id]
+            by_scan.setdefault(scan.channel.id, (scan, []))[1].append(message.id)
+            self._log_match(scan, message, rules)
+        skipped = late[granted:]
+        if skipped:
+            # 削除しなかったメッセージを未処理として残し、次回のスキャン範囲に含める
+            for message, _ in skipped:
+                scan = self.scans[message.channel.id]
+                scan.truncated = True
+                scan.outstanding.add(message.id)
+            logger.warning(
+                f"[BATCH] Deletion limit reached; skipped {len(skipped)} "
+                "duplicate matches (they will be rescanned next run)"
+            )
+        for scan, message_ids in by_scan.values():
+            await self.matches.put((scan, message_ids, None))
+
+    def _log_match(
+        self, scan: ChannelScan, message: ScannedMessage, rules: list[str]
+    ) -> None:
+        channel = scan.channel
+        if self.match_writer is not None:
+            self.match_writer.write(channel.guild.id, channel.id, message, rules)
+        prefix = "[DRY RUN] Would delete" if self.deleter.dry_run else "[BATCH] Added"
+        self.deleter.match_log.log(
+            lambda: (
+                f"{prefix} message {message.id} "
+                f"from {message.author} in #{channel.name}: "
+                f"{message.content[:50]} (rules: {', '.join(rules)})"
+            )
+        )
+
+    async def _delete(self) -> None:
+        batch_size = self.deleter.batch_size
+        pending: dict[int, list[int]] = {}
+
+        while (item := await self.matches.get()) is not None:
+            scan, message_ids, scanned_id = item
+            channel = scan.channel
+            if message_ids is None:
+                scan.finished = True
+                batch = pending.pop(channel.id, None)
+                if batch:
+                    await self._flush(scan, batch)
+                self._save_checkpoint(scan)
+                continue
+
+            if scanned_id is not None:
+                scan.oldest_scanned_id = scanned_id
+
+            if self.deleter.dry_run:
+                self.deleted_count += len(message_ids)
+                continue
+
+            scan.outstanding.update(message_ids)
+            batch = pending.setdefault(channel.id, [])
+            for message_id in message_ids:
+                if is_bulk_deletable(message_id):
+                    batch.append(message_id)
+                else:
+                    self._queue_old(scan, message_id)
+            while len(batch) >= batch_size:
+                await self._flush(scan, batch[:batch_size])
+                del batch[:batch_size]
+            self._save_checkpoint(scan)
+
+        # 終えたチャンネルにも、duplicate で後から一致したメッセージが届くことがある
+        for channel_id, batch in pending.items():
+            if batch:
+                scan = self.scans[channel_id]
+                await self._flush(scan, batch)
+                self._save_checkpoint(scan)
+        # 終端はキューが空くのを待って入れる(溢れた分は _delete_old が最後に削除する)
+        await self.old_messages.put(None)
+
+    def _queue_old(self, scan: ChannelScan, message_id: int) -> None:
+        # 1件ずつの削除は遅いので、キューが満杯でも待たずに溢れた分を後回しにし、
+        # 他のチャンネルの一括削除を止めない
+        try:
+            self.old_messages.put_nowait((scan, message_id))
+        except asyncio.QueueFull:
+            if not self.old_spill:
+                logger.warning(
+                    f"[BATCH] Old message queue is full ({OLD_MESSAGE_QUEUE_SIZE}); "
+                    "deferring single deletes until bulk deletion finishes"
+                )
+            self.old_spill.append((scan, message_id))
+
+    async def _delete_old(self) -> None:
+        # 一括削除できない14日以上前のメッセージは、専用のレート制限で1件ずつ削除する
+        while (item := await self.old_messages.get()) is not None:
+            scan, message_id = item
+            await self._flush(scan, [message_id])
+            self._save_checkpoint(scan)
+        if self.old_spill:
+            logger.info(
+                f"[BATCH] Deleting {len(self.old_spill)} deferred old message(s)"
+            )
+        while self.old_spill:
+            scan, message_id = self.old_spill.popleft()
+            await self._flush(scan, [message_id])
+            self._save_checkpoint(scan)
+
+    async def _flush(self, scan: ChannelScan, message_ids: list[int]) -> None:
+        deleted = await self.deleter._flush_batch(
+            scan.channel, message_ids, self.budget
+        )
+        self.deleted_count += deleted
+        if self.deleter.cache is not None and deleted == len(message_ids):
+            self.deleter.cache.remove(message_ids)
+        scan.outstanding.difference_update(message_ids)
@@ -0,0 +1,111 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable
+
+from loguru import logger
+
+PLAN_VERSION = 1
+
+
+@dataclass(frozen=True)
+class PlanBatch:
+    guild_id: int
+    channel_id: int
+    # (メッセージ ID, 一致したルール名) の ID 昇順のリスト
+    messages: list[tuple[int, list[str]]]
+
+    @property
+    def message_ids(self) -> list[int]:
+        return [message_id for message_id, _ in self.messages]
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+
+def write_plan(
+    matches_paths: Iterable[str | Path], plan_path: str | Path, batch_size: int
+) -> int:
+    """ドライランの一致(MatchWriter の出力)から削除計画ファイルを作り、バッチ数を返す
+
+    1行目は概要、2行目以降は1行が1回の一括削除になる。チャンネル ID・メッセージ ID の
+    昇順に並べ、時刻などは含めないので、同じ一致からは常に同じファイルができる。
+    """
+    entries: list[tuple[int, int, int, tuple[str, ...]]] = []
+    for path in matches_paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                match = json.loads(line)
+                entries.append(
+                    (
+                        match["channel_id"],
+                        match["message_id"],
+                        match["guild_id"],
+                        tuple(sorted(match["rules"])),
+                    )
+                )
+    entries.sort()
+
+    batches: list[PlanBatch] = []
+    for channel_id, message_id, guild_id, rules in entries:
+        last = batches[-1] if batches else None
+        if (
+            last is None
+            or last.channel_id != channel_id
+            or len(last.messages) >= batch_size
+        ):
+            last = PlanBatch(guild_id, channel_id, [])
+            batches.append(last)
+        last.messages.append((message_id, list(rules)))
+
+    plan_path = Path(plan_path)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    with plan_path.open("w", encoding="utf-8") as f:
+        header = {
+            "plan": PLAN_VERSION,
+            "batch_size": batch_size,
+            "messages": len(entries),
+            "batches": len(batches),
+            "channels": len({batch.channel_id for batch in batches}),
+            "rules": sorted({rule for *_, rules in entries for rule in rules}),
+        }
+        f.write(_dumps(header) + "\n")
+        for batch in batches:
+            line = {
+                "guild_id": batch.guild_id,
+                "channel_id": batch.channel_id,
+                "messages": batch.messages,
+            }
+            f.write(_dumps(line) + "\n")
+    logger.info(
+        f"[PLAN] Wrote deletion plan to {plan_path}: {len(entries)} message(s) "
+        f"in {len(batches)} batch(es)"
+    )
+    return len(batches)
+
+
+def read_plan(plan_path: str | Path) -> tuple[dict[str, Any], list[PlanBatch]]:
+    """削除計画ファイルを読み込む(形式が違えば ValueError)"""
+    with open(plan_path, encoding="utf-8") as f:
+        header = json.loads(f.readline() or "null")
+        if not isinstance(header, dict) or header.get("plan") != PLAN_VERSION:
+            raise ValueError(
+                f"{plan_path} is not a deletion plan (version {PLAN_VERSION})"
+            )
+        batches = []
+        for line_number, line in enumerate(f, 2):
+            try:
+                data = json.loads(line)
+                batches.append(
+                    PlanBatch(
+                        int(data["guild_id"]),
+                        int(data["channel_id"]),
+                        [(int(i), list(rules)) for i, rules in data["messages"]],
+                    )
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(
+                    f"{plan_path}:{line_number}: invalid batch: {e}"
+                ) from e
+    return header, batches
@@ -0,0 +1,253 @@
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+from loguru import logger
+
+from del_spam.predicate import AllOf, AnyOf, IdIn, IdNotIn, Never, Predicate, TimeRange
+
+if TYPE_CHECKING:
+    import discord
+
+# ID の数 × チャンネル数がこれ以下なら、history を辿らずメッセージ ID で直接取得する
+# (メッセージのないチャンネルへの取得は 404 になり、要求が無駄になる)
+DIRECT_FETCH_LIMIT = 50
+HISTORY_PAGE_SIZE = 100
+
+
+@dataclass(frozen=True)
+class IdScope:
+    only: Optional[frozenset] = None
+    excluded: frozenset = frozenset()
+
+    def allows(self, value: int) -> bool:
+        if self.only is not None:
+            return value in self.only
+        return value not in self.excluded
+
+    def intersect(self, other: "IdScope") -> "IdScope":
+        if self.only is not None and other.only is not None:
+            return IdScope(only=self.only & other.only)
+        if self.only is not None:
+            return IdScope(only=self.only - other.excluded)
+        if other.only is not None:
+            return IdScope(only=other.only - self.excluded)
+        return IdScope(excluded=self.excluded | other.excluded)
+
+    def union(self, other: "IdScope") -> "IdScope":
+        if self.only is not None and other.only is not None:
+            return IdScope(only=self.only | other.only)
+        if self.only is not None:
+            return IdScope(excluded=other.excluded - self.only)
+        if other.only is not None:
+            return IdScope(excluded=self.excluded - other.only)
+        return IdScope(excluded=self.excluded & other.excluded)
+
+
+@dataclass(frozen=True)
+class TimeWindow:
+    # 作成時刻の範囲を表すメッセージ ID の範囲(両端を含む)
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+    def intersect(self, other: "TimeWindow") -> "TimeWindow":
+        starts = [t for t in (self.start, other.start) if t is not None]
+        ends = [t for t in (self.end, other.end) if t is not None]
+        return TimeWindow(max(starts, default=None), min(ends, default=None))
+
+    def union(self, other: "TimeWindow") -> "TimeWindow":
+        start = None
+        if self.start is not None and other.start is not None:
+            start = min(self.start, other.start)
+        end = None
+        if self.end is not None and other.end is not None:
+            end = max(self.end, other.end)
+        return TimeWindow(start, end)
+
+    @property
+    def is_empty(self) -> bool:
+        return self.start is not None and self.end is not None and self.start > self.end
+
+
+@dataclass(frozen=True)
+class ScanPlan:
+    """ルールが一致し得るメッセージの範囲(取得前に評価する)"""
+
+    guilds: IdScope = IdScope()
+    channels: IdScope = IdScope()
+    message_ids: IdScope = IdScope()
+    window: TimeWindow = TimeWindow()
+    empty: bool = False
+
+    def intersect(self, other: "ScanPlan") -> "ScanPlan":
+        if self.empty or other.empty:
+            return EMPTY_PLAN
+        return ScanPlan(
+            guilds=self.guilds.intersect(other.guilds),
+            channels=self.channels.intersect(other.channels),
+            message_ids=self.message_ids.intersect(other.message_ids),
+            window=self.window.intersect(other.window),
+        )._normalized()
+
+    def union(self, other: "ScanPlan") -> "ScanPlan":
+        if self.empty:
+            return other
+        if other.empty:
+            return self
+        return ScanPlan(
+            guilds=self.guilds.union(other.guilds),
+            channels=self.channels.union(other.channels),
+            message_ids=self.message_ids.union(other.message_ids),
+            window=self.window.union(other.window),
+        )
+
+    def _normalized(self) -> "ScanPlan":
+        scopes = (self.guilds, self.channels, self.message_ids)
+        if self.window.is_empty or any(
+            s.only is not None and not s.only for s in scopes
+        ):
+            return EMPTY_PLAN
+        return self
+
+    def history_bounds(self) -> tuple[Optional[int], Optional[int]]:
+        """history(after=, before=) に渡す排他的なスノーフレーク境界"""
+        after: Optional[int] = None
+        before: Optional[int] = None
+        if self.window.start is not None and self.window.start > 0:
+            after = self.window.start - 1
+        if self.window.end is not None:
+            before = self.window.end + 1
+        if self.message_ids.only:
+            low = min(self.message_ids.only) - 1
+            high = max(self.message_ids.only) + 1
+            after = low if after is None else max(after, low)
+            before = high if before is None else min(before, high)
+        return after, before
+
+    def direct_fetch(self, channels: int) -> Optional["DirectFetch"]:
+        """channels 個のチャンネルで ID を直接取得するほうが安ければ、その状態を返す"""
+        ids = self.message_ids.only
+        if ids is None or len(ids) * channels > DIRECT_FETCH_LIMIT:
+            return None
+        return DirectFetch(sorted(ids, reverse=True))
+
+
+@dataclass
+class DirectFetch:
+    """メッセージ ID を直接取得するときの、チャンネル間で共有する状態
+
+    ID はすべてのチャンネルで一意なので、どこかで見つかった ID は他のチャンネルでは取得しない。
+    """
+
+    ids: list[int]
+    found: set[int] = field(default_factory=set)
+
+
+EMPTY_PLAN = ScanPlan(empty=True)
+FULL_PLAN = ScanPlan()
+
+
+def plan_scan(predicate: Predicate) -> ScanPlan:
+    if isinstance(predicate, Never):
+        return EMPTY_PLAN
+    if isinstance(predicate, AllOf):
+        plan = FULL_PLAN
+        for child in predicate.children:
+            plan = plan.intersect(plan_scan(child))
+        return plan
+    if isinstance(predicate, AnyOf):
+        plan = EMPTY_PLAN
+        for child in predicate.children:
+            plan = plan.union(plan_scan(child))
+        return plan
+    if isinstance(predicate, (IdIn, IdNotIn)):
+        if isinstance(predicate, IdIn):
+            # 数値以外の値は ID と一致し得ないので範囲計算から外す
+            scope = IdScope(
+                only=frozenset(v for v in predicate.ids if isinstance(v, int))
+            )
+        else:
+            scope = IdScope(excluded=predicate.ids)
+        if predicate.target == "guild":
+            return ScanPlan(guilds=scope)._normalized()
+        if predicate.target == "channel":
+            return ScanPlan(channels=scope)._normalized()
+        if predicate.target == "message_id":
+            return ScanPlan(message_ids=scope)._normalized()
+    if isinstance(predicate, TimeRange):
+        window = TimeWindow(predicate.start_id, predicate.end_id)
+        return ScanPlan(window=window)._normalized()
+    return FULL_PLAN
+
+
+@dataclass
+class ScanStats:
+    guilds_skipped: int = 0
+    channels_skipped: int = 0
+    bounded_scans: int = 0
+    direct_fetches: int = 0
+    pages_fetched: int = 0
+
+    def log_summary(self) -> None:
+        # 範囲を絞った走査や直接取得で省いたページ数は、全件数が分からないので数えない
+        logger.info(
+            f"[PLAN] Skipped {self.guilds_skipped} guild(s) and "
+            f"{self.channels_skipped} channel(s), "
+            f"{self.bounded_scans} bounded scan(s), "
+            f"{self.direct_fetches} direct fetch(es), "
+            f"{self.pages_fetched} history page(s) fetched"
+        )
+
+
+async def iter_planned_messages(
+    channel: "discord.TextChannel",
+    plan: ScanPlan,
+    stats: ScanStats,
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    direct: Optional[DirectFetch] = None,
+) -> AsyncIterator["discord.Message"]:
+    """新しい順にメッセージを返す(after/before でチェックポイントの範囲をさらに絞る)
+
+    direct を渡すと、history を辿らずにその ID だけを直接取得する。
+    """
+    # ルールの検証だけのときに discord.py を読み込まないよう、取得を始めるときに import する
+    import discord
+
+    if direct is not None:
+        for message_id in direct.ids:
+            if message_id in direct.found:
+                continue
+            if (after is not None and message_id <= after) or (
+                before is not None and message_id >= before
+            ):
+                continue
+            stats.direct_fetches += 1
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.NotFound:
+                continue
+            direct.found.add(message_id)
+            yield message
+        return
+
+    plan_after, plan_before = plan.history_bounds()
+    if plan_after is not None or plan_before is not None:
+        stats.bounded_scans += 1
+    if plan_after is not None:
+        after = plan_after if after is None else max(after, plan_after)
+    if plan_before is not None:
+        before = plan_before if before is None else min(before, plan_before)
+
+    fetched = 0
+    async for message in channel.history(
+        limit=None,
+        after=discord.Object(after) if after is not None else None,
+        before=discord.Object(before) if before is not None else None,
+        oldest_first=False,
+    ):
+        if fetched % HISTORY_PAGE_SIZE == 0:
+            stats.pages_fetched += 1
+        fetched += 1
+        yield message
+    if fetched == 0:
+        stats.pages_fetched += 1
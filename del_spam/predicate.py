@@ -0,0 +1,385 @@
+import re
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ClassVar,
+    Iterable,
+    Iterator,
+    Optional,
+)
+
+from del_spam.batch import MessageBatch
+from del_spam.matcher import compile_keywords
+
+if TYPE_CHECKING:
+    import discord
+
+    from del_spam.duplicates import DuplicateIndex
+
+
+def _guild_id(message: "discord.Message") -> Optional[int]:
+    guild = message.guild
+    return None if guild is None else guild.id
+
+
+def _channel_id(message: "discord.Message") -> int:
+    return message.channel.id
+
+
+def _author_id(message: "discord.Message") -> int:
+    return message.author.id
+
+
+def _message_id(message: "discord.Message") -> int:
+    return message.id
+
+
+ID_FIELDS: dict[str, Callable[[Any], Optional[int]]] = {
+    "guild": _guild_id,
+    "channel": _channel_id,
+    "user": _author_id,
+    "message_id": _message_id,
+}
+
+
+def member_role_ids(
+    message: "discord.Message", member: "discord.Member | frozenset | None"
+) -> Optional[Iterable[int]]:
+    if isinstance(member, frozenset):
+        # MemberRoleCache で解決済みのロール ID
+        return member
+    if member is None:
+        member = message.author
+    roles = getattr(member, "roles", None)
+    if roles is None:
+        return None
+    return (role.id for role in roles)
+
+
+def _merge_patterns(patterns: Iterable[re.Pattern]) -> Optional[re.Pattern]:
+    """複数の正規表現を1つの選択パターンにまとめる(グループを含む場合はまとめない)"""
+    patterns = list(patterns)
+    if not patterns or any(p.groups for p in patterns):
+        return None
+    try:
+        return re.compile("|".join(f"(?:{p.pattern})" for p in patterns))
+    except re.error:
+        return None
+
+
+class Predicate:
+    __slots__ = ()
+    # メトリクスで評価回数を集計するときの区分(設定のフィルタータイプに対応する)
+    filter_type: ClassVar[str] = "unknown"
+
+    def matches(
+        self, message: "discord.Message", member: "discord.Member | None" = None
+    ) -> bool:
+        raise NotImplementedError
+
+    def select(self, batch: MessageBatch, candidates: list[int]) -> list[int]:
+        """candidates(バッチ内の位置)のうち一致するものを順序を保って返す"""
+        messages = batch.messages
+        return [i for i in candidates if self.matches(messages[i])]
+
+
+@dataclass(frozen=True, slots=True)
+class Never(Predicate):
+    filter_type: ClassVar[str] = "never"
+
+    def matches(self, message, member=None) -> bool:
+        return False
+
+    def select(self, batch, candidates) -> list[int]:
+        return []
+
+
+@dataclass(frozen=True, slots=True)
+class IdIn(Predicate):
+    target: str
+    ids: frozenset
+    key: Callable[[Any], Optional[int]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "key", ID_FIELDS[self.target])
+
+    @property
+    def filter_type(self) -> str:
+        return self.target
+
+    def matches(self, message, member=None) -> bool:
+        value = self.key(message)
+        return value is not None and value in self.ids
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column(self.target)
+        ids = self.ids
+        return [i for i in candidates if column[i] in ids and column[i] is not None]
+
+
+@dataclass(frozen=True, slots=True)
+class IdNotIn(Predicate):
+    target: str
+    ids: frozenset
+    key: Callable[[Any], Optional[int]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "key", ID_FIELDS[self.target])
+
+    @property
+    def filter_type(self) -> str:
+        return self.target
+
+    def matches(self, message, member=None) -> bool:
+        value = self.key(message)
+        return value is not None and value not in self.ids
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column(self.target)
+        ids = self.ids
+        return [i for i in candidates if column[i] not in ids and column[i] is not None]
+
+
+@dataclass(frozen=True, slots=True)
+class RoleIn(Predicate):
+    filter_type: ClassVar[str] = "role"
+    ids: frozenset
+
+    def matches(self, message, member=None) -> bool:
+        role_ids = member_role_ids(message, member)
+        return role_ids is not None and not self.ids.isdisjoint(role_ids)
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column("roles")
+        ids = self.ids
+        return [
+            i
+            for i in candidates
+            if column[i] is not None and not ids.isdisjoint(column[i])
+        ]
+
+
+@dataclass(frozen=True, slots=True)
+class RoleNotIn(Predicate):
+    filter_type: ClassVar[str] = "role"
+    ids: frozenset
+
+    def matches(self, message, member=None) -> bool:
+        role_ids = member_role_ids(message, member)
+        return role_ids is not None and self.ids.isdisjoint(role_ids)
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column("roles")
+        ids = self.ids
+        return [
+            i for i in candidates if column[i] is not None and ids.isdisjoint(column[i])
+        ]
+
+
+@dataclass(frozen=True, slots=True)
+class TimeRange(Predicate):
+    """作成時刻の範囲を、メッセージ ID(スノーフレーク)の範囲として判定する
+
+    start_id / end_id は両端を含み、None はその側に制限がないことを表す。
+    """
+
+    filter_type: ClassVar[str] = "timestamp"
+    start_id: Optional[int]
+    end_id: Optional[int]
+
+    def matches(self, message, member=None) -> bool:
+        message_id = message.id
+        if self.start_id is not None and message_id < self.start_id:
+            return False
+        if self.end_id is not None and message_id > self.end_id:
+            return False
+        return True
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column("message_id")
+        low = self.start_id if self.start_id is not None else -1
+        high = self.end_id if self.end_id is not None else 1 << 64
+        return [i for i in candidates if low <= column[i] <= high]
+
+
+def _select_content(
+    test: Callable[[str], bool], batch: MessageBatch, candidates: list[int]
+) -> list[int]:
+    column = batch.column("content")
+    return [i for i in candidates if test(column[i])]
+
+
+@dataclass(frozen=True, slots=True)
+class ContentContains(Predicate):
+    filter_type: ClassVar[str] = "content"
+    needles: tuple[str, ...]
+    test: Callable[[str], bool] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "test", compile_keywords(self.needles, "contains"))
+
+    def matches(self, message, member=None) -> bool:
+        return self.test(message.content.lower())
+
+    def select(self, batch, candidates) -> list[int]:
+        return _select_content(self.test, batch, candidates)
+
+
+@dataclass(frozen=True, slots=True)
+class ContentNotContains(Predicate):
+    filter_type: ClassVar[str] = "content"
+    needles: tuple[str, ...]
+    test: Callable[[str], bool] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "test", compile_keywords(self.needles, "contains"))
+
+    def matches(self, message, member=None) -> bool:
+        return not self.test(message.content.lower())
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column("content")
+        test = self.test
+        return [i for i in candidates if not test(column[i])]
+
+
+@dataclass(frozen=True, slots=True)
+class ContentStartsWith(Predicate):
+    filter_type: ClassVar[str] = "content"
+    prefixes: tuple[str, ...]
+    test: Callable[[str], bool] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "test", compile_keywords(self.prefixes, "prefix"))
+
+    def matches(self, message, member=None) -> bool:
+        return self.test(message.content.lower())
+
+    def select(self, batch, candidates) -> list[int]:
+        return _select_content(self.test, batch, candidates)
+
+
+@dataclass(frozen=True, slots=True)
+class ContentEndsWith(Predicate):
+    filter_type: ClassVar[str] = "content"
+    suffixes: tuple[str, ...]
+    test: Callable[[str], bool] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "test", compile_keywords(self.suffixes, "suffix"))
+
+    def matches(self, message, member=None) -> bool:
+        return self.test(message.content.lower())
+
+    def select(self, batch, candidates) -> list[int]:
+        return _select_content(self.test, batch, candidates)
+
+
+@dataclass(frozen=True, slots=True)
+class ContentRegex(Predicate):
+    filter_type: ClassVar[str] = "content"
+    patterns: tuple[re.Pattern, ...]
+    merged: Optional[re.Pattern] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "merged", _merge_patterns(self.patterns))
+
+    def matches(self, message, member=None) -> bool:
+        content = message.content.lower()
+        if self.merged is not None:
+            return self.merged.search(content) is not None
+        return any(pattern.search(content) for pattern in self.patterns)
+
+    def select(self, batch, candidates) -> list[int]:
+        column = batch.column("content")
+        if self.merged is not None:
+            search = self.merged.search
+            return [i for i in candidates if search(column[i]) is not None]
+        patterns = self.patterns
+        return [i for i in candidates if any(p.search(column[i]) for p in patterns)]
+
+
+@dataclass(frozen=True, slots=True)
+class DuplicateContent(Predicate):
+    """同じ本文が window_ms 以内に copies 件以上、channels 個以上のチャンネルに投稿されたか
+
+    メッセージは FilterEngine が評価の前に index へ登録し、しきい値に達した波の投稿を
+    index が一致として覚えるので、ここでは引くだけ。index は FilterEngine がルールの
+    読み込み時に結び付ける。
+    """
+
+    filter_type: ClassVar[str] = "duplicate"
+    copies: int
+    window_ms: int
+    channels: int
+    index: Optional["DuplicateIndex"] = field(default=None, repr=False, compare=False)
+
+    def bind(self, index: "DuplicateIndex") -> None:
+        object.__setattr__(self, "index", index)
+
+    def matches(self, message, member=None) -> bool:
+        index = self.index
+        return index is not None and index.is_flagged(message.id)
+
+    def select(self, batch, candidates) -> list[int]:
+        index = self.index
+        if index is None:
+            return []
+        ids = batch.column("message_id")
+        is_flagged = index.is_flagged
+        return [i for i in candidates if is_flagged(ids[i])]
+
+
+@dataclass(frozen=True, slots=True)
+class AllOf(Predicate):
+    filter_type: ClassVar[str] = "group"
+    children: tuple[Predicate, ...]
+
+    def matches(self, message, member=None) -> bool:
+        for child in self.children:
+            if not child.matches(message, member):
+                return False
+        return True
+
+    def select(self, batch, candidates) -> list[int]:
+        for child in self.children:
+            if not candidates:
+                break
+            evaluated = len(candidates)
+            candidates = child.select(batch, candidates)
+            batch.observe(child, evaluated, len(candidates))
+        return candidates
+
+
+@dataclass(frozen=True, slots=True)
+class AnyOf(Predicate):
+    filter_type: ClassVar[str] = "group"
+    children: tuple[Predicate, ...]
+
+    def matches(self, message, member=None) -> bool:
+        for child in self.children:
+            if child.matches(message, member):
+                return True
+        return False
+
+    def select(self, batch, candidates) -> list[int]:
+        found: set[int] = set()
+        remaining = candidates
+        for child in self.children:
+            if not remaining:
+                break
+            matched = child.select(batch, remaining)
+            batch.observe(child, len(remaining), len(matched))
+            if matched:
+                found.update(matched)
+                remaining = [i for i in remaining if i not in found]
+        return [i for i in candidates if i in found]
+
+
+def walk(predicate: Predicate) -> Iterator[Predicate]:
+    """述語木のすべてのノードを返す"""
+    yield predicate
+    for child in getattr(predicate, "children", ()):
+        yield from walk(child)
@@ -0,0 +1,93 @@
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from loguru import logger
+
+from del_spam.cache import CachedAuthor, CachedRef
+from del_spam.snowflake import snowflake_to_ms
+
+
+class ScanRecord:
+    """履歴から取得したメッセージのうち、ルールの判定とログに使う項目だけを持つ記録
+
+    discord.Message はページに入れる前にこれに変換して手放す。
+    guild / channel はチャンネル内のすべての記録で同じオブジェクトを共有し、
+    本文とロールはルールが参照するときだけ保持する。
+    """
+
+    __slots__ = ("id", "guild", "channel", "author", "content")
+
+    def __init__(
+        self,
+        id: int,
+        guild: CachedRef,
+        channel: CachedRef,
+        author: CachedAuthor,
+        content: str,
+    ):
+        self.id = id
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(snowflake_to_ms(self.id) / 1000, tz=timezone.utc)
+
+
+class RecordFactory:
+    """1つのチャンネルのメッセージを ScanRecord に変換する"""
+
+    def __init__(self, guild_id: int, channel_id: int, filter_types: frozenset[str]):
+        self.guild = CachedRef(guild_id)
+        self.channel = CachedRef(channel_id)
+        self.filter_types = filter_types
+
+    def __call__(self, message: Any) -> ScanRecord:
+        author = message.author
+        roles = None
+        if "role" in self.filter_types:
+            member_roles = getattr(author, "roles", None)
+            if member_roles is not None:
+                roles = [CachedRef(role.id) for role in member_roles]
+        keep_content = not self.filter_types.isdisjoint(("content", "duplicate"))
+        content = message.content if keep_content else ""
+        author = CachedAuthor(author.id, roles)
+        return ScanRecord(message.id, self.guild, self.channel, author, content)
+
+
+class MatchWriter:
+    """ドライランで一致したメッセージを JSON Lines でファイルに書き出す
+
+    一致をメモリに溜めないので、チャンネルの大きさによらずメモリ使用量は一定になる。
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file: Optional[IO[str]] = self.path.open("w", encoding="utf-8")
+        self.count = 0
+
+    def write(
+        self, guild_id: int, channel_id: int, message: Any, rules: list[str]
+    ) -> None:
+        assert self._file is not None
+        record = {
+            "guild_id": guild_id,
+            "channel_id": channel_id,
+            "message_id": message.id,
+            "author_id": message.author.id,
+            "rules": rules,
+        }
+        self._file.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        logger.info(f"[DRY RUN] Wrote {self.count} match(es) to {self.path}")
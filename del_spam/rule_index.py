@@ -0,0 +1,86 @@
+from collections import defaultdict
+from typing import Any, Iterable, Optional
+
+from del_spam.predicate import ID_FIELDS, AllOf, AnyOf, IdIn, Never, Predicate
+
+# 索引に使う ID の項目(サーバー・チャンネル・送信者)
+INDEXED_TARGETS = ("guild", "channel", "user")
+
+
+def required_ids(predicate: Predicate, target: str) -> Optional[frozenset]:
+    """一致するメッセージの target の ID が必ず含まれる集合(制約がなければ None)"""
+    if isinstance(predicate, Never):
+        return frozenset()
+    if isinstance(predicate, IdIn):
+        return predicate.ids if predicate.target == target else None
+    if isinstance(predicate, AllOf):
+        result = None
+        for child in predicate.children:
+            ids = required_ids(child, target)
+            if ids is not None:
+                result = ids if result is None else result & ids
+        return result
+    if isinstance(predicate, AnyOf):
+        result = frozenset()
+        for child in predicate.children:
+            ids = required_ids(child, target)
+            if ids is None:
+                return None
+            result |= ids
+        return result
+    return None
+
+
+class RuleIndex:
+    """サーバー・チャンネル・送信者の ID から、一致し得るルールを引く転置索引
+
+    各ルールは一致に必須な ID の集合が最も小さい項目の下にだけ登録し、
+    ID の制約がないルールは常に評価する。メッセージごとの候補の数は
+    全ルール数ではなく、そのメッセージに関係するルールの数で決まる。
+    """
+
+    def __init__(self, rules: dict[str, Predicate]):
+        # 候補を設定ファイルの順に並べるための、ルールの読み込み順
+        self.positions = {rule_name: i for i, rule_name in enumerate(rules)}
+        self.always: list[str] = []
+        self.by_id: dict[str, dict[Any, list[str]]] = {
+            target: defaultdict(list) for target in INDEXED_TARGETS
+        }
+        for rule_name, predicate in rules.items():
+            self._add(rule_name, predicate)
+
+    def _add(self, rule_name: str, predicate: Predicate) -> None:
+        best: Optional[tuple[str, frozenset]] = None
+        for target in INDEXED_TARGETS:
+            ids = required_ids(predicate, target)
+            if ids is not None and (best is None or len(ids) < len(best[1])):
+                best = (target, ids)
+        if best is None:
+            self.always.append(rule_name)
+            return
+        # 必須の ID が空のルールはどのメッセージにも一致しないので登録しない
+        target, ids = best
+        for value in ids:
+            self.by_id[target][value].append(rule_name)
+
+    def candidates(self, message: Any) -> list[str]:
+        """message に一致し得るルール名(読み込み順)"""
+        found = list(self.always)
+        for target, index in self.by_id.items():
+            if index:
+                value = ID_FIELDS[target](message)
+                if value is not None:
+                    found.extend(index.get(value, ()))
+        if len(found) > 1:
+            found.sort(key=self.positions.__getitem__)
+        return found
+
+    def candidates_in(self, message: Any, rule_names: Iterable[str]) -> list[str]:
+        allowed = (
+            rule_names if isinstance(rule_names, (set, frozenset)) else set(rule_names)
+        )
+        return [name for name in self.candidates(message) if name in allowed]
+
+    @property
+    def indexed_rules(self) -> int:
+        return len(self.positions) - len(self.always)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+import tomllib
+from pathlib import Path
+from typing import Any, Optional
+
+from loguru import logger
+
+from del_spam.filter import FilterEngine, RuleConfigError, RuleSet, validate_rules
+
+
+def load_rules_file(path: str | Path) -> dict[str, dict]:
+    """DELETE_RULES と同じ形のルールを JSON / TOML / YAML ファイルから読み込む
+
+    読めない場合や誤りがある場合は RuleConfigError を送出する。
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError as e:
+        raise RuleConfigError([f"{path}: {e}"]) from e
+
+    data: Any
+    try:
+        if suffix == ".json":
+            data = json.loads(text)
+        elif suffix == ".toml":
+            data = tomllib.loads(text)
+        elif suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as e:
+                raise RuleConfigError(
+                    [f"{path}: reading YAML rules requires PyYAML (pip install pyyaml)"]
+                ) from e
+            data = yaml.safe_load(text)
+        else:
+            supported = ".json, .toml or .yaml"
+            raise RuleConfigError(
+                [f"{path}: unsupported rules file type {suffix!r}, use {supported}"]
+            )
+    except RuleConfigError:
+        raise
+    except Exception as e:
+        # json.JSONDecodeError / tomllib.TOMLDecodeError / yaml.YAMLError
+        raise RuleConfigError([f"{path}: {e}"]) from e
+
+    errors = validate_rules(data)
+    if errors:
+        raise RuleConfigError(errors)
+    return data
+
+
+class RuleFileWatcher:
+    """ルールファイルの変更を監視し、変わったら FilterEngine のルールを入れ替える
+
+    読み込みとコンパイルは別スレッドで行い、入れ替えだけをイベントループ上で行う。
+    誤りのある更新は拒否し、それまでのルールで動き続ける。
+    """
+
+    def __init__(self, path: str | Path, engine: FilterEngine, interval: float = 5.0):
+        self.path = Path(path)
+        self.engine = engine
+        self.interval = interval
+        self._stamp = self._stat()
+
+    def _stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def run(self) -> None:
+        logger.info(f"[RULES] Watching {self.path} for changes")
+        while True:
+            await asyncio.sleep(self.interval)
+            stamp = self._stat()
+            # 保存の途中で消えている間は前のルールのまま待つ
+            if stamp is None or stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            await self.reload()
+
+    def _prepare(self) -> RuleSet:
+        return self.engine.prepare_rules(load_rules_file(self.path))
+
+    async def reload(self) -> bool:
+        started = time.perf_counter()
+        try:
+            rule_set = await asyncio.to_thread(self._prepare)
+        except RuleConfigError as e:
+            logger.error(
+                f"[RULES] Rejected update of {self.path}, keeping the current rules:"
+            )
+            for error in e.errors:
+                logger.error(f"[RULES]   {error}")
+            self._count("rejected")
+            return False
+
+        if not (rule_set.added or rule_set.changed or rule_set.removed):
+            logger.debug(f"[RULES] {self.path} changed but no rule did")
+            return True
+        self.engine.swap_rules(rule_set)
+        self._count("applied")
+        logger.info(
+            f"[RULES] Reloaded {self.path} in {time.perf_counter() - started:.2f}s: "
+            f"added {rule_set.added or 'none'}, changed {rule_set.changed or 'none'}, "
+            f"removed {rule_set.removed or 'none'}, {rule_set.unchanged} unchanged"
+        )
+        return True
+
+    def _count(self, result: str) -> None:
+        if self.engine.metrics is not None:
+            self.engine.metrics.inc("rule_reloads", result=result)
@@ -36,3 +36,25 @@ DRY_RUN: bool = True
 MAX_DELETIONS_PER_RUN: int = 1000
 BATCH_SIZE: int = 100
 API_CALL_INTERVAL: float = 0.5
+MAX_CONCURRENT_CHANNELS: int = 5
+SINGLE_DELETE_INTERVAL: float = 1.0
+CHECKPOINT_PATH: str | None = None
+MESSAGE_CACHE_PATH: str | None = None
+OFFLINE_DRY_RUN: bool = False
+WATCH_BATCH_WINDOW: float = 0.5
+WATCH_MAX_BATCH_WINDOW: float = 2.0
+WATCH_MAX_PENDING: int = 1000
+WATCH_REPORT_INTERVAL: float = 300.0
+# 常駐モードの MAX_DELETIONS_PER_RUN を何秒ごとの上限にするか(None なら終了までの上限)
+WATCH_DELETION_LIMIT_INTERVAL: float | None = 3600.0
+MEMBERS_INTENT: bool = False
+MEMBER_ROLE_CACHE_TTL: float = 3600.0
+MEMBER_ROLE_CACHE_MAX_GUILDS: int = 50
+LOG_LEVEL: str = "INFO"
+MATCH_LOG_SAMPLE: int = 20
+METRICS_PATH: str | None = "logs/metrics.json"
+METRICS_PORT: int | None = None
+RULES_PATH: str | None = None
+RULES_RELOAD_INTERVAL: float = 5.0
+DRY_RUN_MATCHES_PATH: str | None = "logs/dry_run_matches.jsonl"
+DRY_RUN_PLAN_PATH: str | None = "logs/deletion_plan.jsonl"
@@ -0,0 +1,234 @@
+import asyncio
+import multiprocessing
+import sys
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+import discord
+from loguru import logger
+
+import del_spam.config as config
+from del_spam.coordination import SharedState, WorkerReport
+from del_spam.deleter import MessageDeleter, configured_batch_size
+from del_spam.filter import FilterEngine
+from del_spam.metrics import Metrics
+from del_spam.plan_file import write_plan
+
+
+@dataclass(frozen=True)
+class ShardJob:
+    """コーディネーターから各ワーカープロセスに渡す実行内容(pickle できる値だけを持つ)"""
+
+    rules: dict[str, dict]
+    rule_names: list[str]
+    guild_ids: Optional[list[int]]
+    dry_run: bool
+    max_deletions: int
+    workers: int
+    state_path: str
+    log_level: str = "INFO"
+    # ドライランの一致を worker ごとに書き出すディレクトリ(計画はコーディネーターが作る)
+    matches_dir: Optional[str] = None
+
+
+class RestGuild:
+    """REST で取得したサーバーに、Gateway のキャッシュの代わりにテキストチャンネルを持たせる
+
+    REST だけのクライアントはメンバーのチャンクを要求できないので、
+    MemberRoleCache は fetch_members(HTTP)での取得に切り替わる。
+    """
+
+    chunked = False
+
+    def __init__(self, guild: discord.Guild, text_channels: list[discord.TextChannel]):
+        self._guild = guild
+        self.text_channels = text_channels
+
+    async def chunk(self) -> list[discord.Member]:
+        raise discord.ClientException("Member chunking needs a gateway connection")
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._guild, name)
+
+
+async def fetch_guilds(
+    client: discord.Client, guild_ids: Optional[list[int]]
+) -> list[RestGuild]:
+    if not guild_ids:
+        guild_ids = [guild.id async for guild in client.fetch_guilds(limit=None)]
+
+    result = []
+    for guild_id in guild_ids:
+        # 一覧の部分的なサーバーにはロールがないので、1つずつ取り直す(ROLE フィルターに必要)
+        try:
+            guild = await client.fetch_guild(guild_id)
+        except discord.HTTPException as e:
+            logger.error(f"Guild not accessible: {guild_id} ({e})")
+            continue
+        channels = await guild.fetch_channels()
+        text_channels = sorted(
+            (c for c in channels if isinstance(c, discord.TextChannel)),
+            key=lambda c: c.position,
+        )
+        result.append(RestGuild(guild, text_channels))
+    return result
+
+
+def attach_worker(
+    deleter: MessageDeleter, state: SharedState, index: int, workers: int
+) -> None:
+    """deleter をワーカー index/workers として動かす(担当チャンネルと共有状態を設定する)"""
+    deleter.shard = (index, workers)
+    deleter.shared_state = state
+    deleter.scheduler.shared = state
+
+
+def _matches_path(matches_dir: str, index: int) -> str:
+    return str(Path(matches_dir) / f"matches_{index}.jsonl")
+
+
+def _merge_matches(matches_dir: str, workers: int) -> None:
+    """ワーカーごとの一致を1つのファイルにまとめ、削除計画を作る"""
+    paths = [
+        path
+        for path in (_matches_path(matches_dir, i) for i in range(workers))
+        if Path(path).exists()
+    ]
+    matches_path = getattr(config, "DRY_RUN_MATCHES_PATH", None)
+    if matches_path:
+        Path(matches_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(matches_path, "w", encoding="utf-8") as out:
+            for path in paths:
+                with open(path, encoding="utf-8") as f:
+                    out.writelines(f)
+    plan_path = getattr(config, "DRY_RUN_PLAN_PATH", None)
+    if plan_path:
+        write_plan(paths, plan_path, configured_batch_size())
+
+
+async def _run_worker(job: ShardJob, index: int) -> WorkerReport:
+    state = SharedState(job.state_path)
+    engine = FilterEngine()
+    engine.load_all_rules(job.rules)
+    deleter = MessageDeleter(engine)
+    deleter.dry_run = job.dry_run
+    deleter.max_deletions = job.max_deletions
+    deleter.matches_path = (
+        None if job.matches_dir is None else _matches_path(job.matches_dir, index)
+    )
+    deleter.plan_path = None
+    attach_worker(deleter, state, index, job.workers)
+
+    intents = discord.Intents.default()
+    intents.members = getattr(config, "MEMBERS_INTENT", False)
+    # Gateway には接続せず、履歴の取得と削除を REST だけで行う
+    client = discord.Client(intents=intents)
+    deleted = 0
+    exit_code = 0
+    try:
+        await client.login(config.DISCORD_TOKEN)
+        guilds = await fetch_guilds(client, job.guild_ids)
+        if job.guild_ids and len(guilds) < len(job.guild_ids):
+            exit_code = 2
+        deleted = await deleter.delete_by_rules(client, job.rule_names, guilds)
+    except Exception as e:
+        logger.error(f"Worker failed: {e}")
+        exit_code = 1
+    finally:
+        await client.close()
+
+    report = WorkerReport(index, deleted, exit_code, deleter.metrics.export())
+    state.add_report(report)
+    state.close()
+    return report
+
+
+def run_worker(job: ShardJob, index: int) -> None:
+    """ワーカープロセスの入口"""
+    logger.remove()
+    logger.add(
+        sys.stderr,
+        level=job.log_level,
+        format="{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | "
+        f"worker {index} | {{message}}",
+    )
+    logger.add(
+        f"logs/file_{{time}}_worker{index}.log",
+        rotation="1 week",
+        enqueue=True,
+        level=job.log_level,
+    )
+    asyncio.run(_run_worker(job, index))
+
+
+async def run_sharded(
+    rules: dict[str, dict],
+    rule_names: list[str],
+    guild_ids: Optional[list[int]],
+    dry_run: bool,
+    max_deletions: int,
+    workers: int,
+) -> tuple[int, int, Metrics]:
+    """チャンネルを workers 個のプロセスに振り分けて削除し、結果をまとめる
+
+    削除件数の上限とレート制限による待機は SQLite を通じて全ワーカーで共有する。
+    戻り値は (削除件数の合計, 終了コード, 全ワーカーのメトリクスの合計)。
+    """
+    with tempfile.TemporaryDirectory(prefix="del_spam_") as workdir:
+        state_path = str(Path(workdir) / "shared.db")
+        state = SharedState.create(state_path, max_deletions)
+        job = ShardJob(
+            rules=rules,
+            rule_names=rule_names,
+            guild_ids=guild_ids,
+            dry_run=dry_run,
+            max_deletions=max_deletions,
+            workers=workers,
+            state_path=state_path,
+            log_level=getattr(config, "LOG_LEVEL", "INFO"),
+            matches_dir=workdir if dry_run else None,
+        )
+
+        # fork したイベントループや SQLite の接続を引き継がないよう spawn で起動する
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=run_worker, args=(job, index), name=f"worker-{index}"
+            )
+            for index in range(workers)
+        ]
+        logger.info(f"[SHARD] Starting {workers} worker process(es)")
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                await asyncio.to_thread(process.join)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        reports = {report.worker: report for report in state.reports()}
+        state.close()
+        if dry_run:
+            _merge_matches(workdir, workers)
+
+    metrics = Metrics()
+    total = 0
+    exit_code = 0
+    for index, process in enumerate(processes):
+        report = reports.get(index)
+        if report is None:
+            logger.error(
+                f"[SHARD] Worker {index} exited without a report "
+                f"(exit code {process.exitcode})"
+            )
+            exit_code = max(exit_code, 1)
+            continue
+        logger.info(f"[SHARD] Worker {index}: deleted {report.deleted}")
+        metrics.merge(report.metrics)
+        total += report.deleted
+        exit_code = max(exit_code, report.exit_code)
+    return total, exit_code, metrics
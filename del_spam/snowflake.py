@@ -0,0 +1,45 @@
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+DISCORD_EPOCH_MS = 1420070400000
+# スノーフレークの下位 22 ビットはワーカー・プロセス・連番で、上位が作成時刻(ミリ秒)
+TIMESTAMP_SHIFT = 22
+_UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+BULK_DELETE_MAX_AGE_MS = 14 * 24 * 60 * 60 * 1000
+# バッチが送信されるまでの間に期限を越えないよう余裕を持たせる
+BULK_DELETE_SAFETY_MS = 5 * 60 * 1000
+
+
+def snowflake_to_ms(snowflake: int) -> int:
+    return (snowflake >> TIMESTAMP_SHIFT) + DISCORD_EPOCH_MS
+
+
+def utc_ms(value: datetime, round_up: bool = False) -> int:
+    """UNIX 時刻のミリ秒(タイムゾーンのない値は UTC とみなす)"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    us = (value - _UNIX_EPOCH) // timedelta(microseconds=1)
+    return -(-us // 1000) if round_up else us // 1000
+
+
+def snowflake_range(
+    start: Optional[datetime], end: Optional[datetime]
+) -> tuple[Optional[int], Optional[int]]:
+    """start 以降 end 以前に作られたメッセージの ID の範囲(どちらも両端を含む)
+
+    メッセージの作成時刻はミリ秒単位なので、start は切り上げ、end は切り捨てる。
+    """
+    low = high = None
+    if start is not None:
+        low = (utc_ms(start, round_up=True) - DISCORD_EPOCH_MS) << TIMESTAMP_SHIFT
+    if end is not None:
+        high = ((utc_ms(end) - DISCORD_EPOCH_MS + 1) << TIMESTAMP_SHIFT) - 1
+    return low, high
+
+
+def is_bulk_deletable(message_id: int, now_ms: Optional[int] = None) -> bool:
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+    age_ms = now_ms - snowflake_to_ms(message_id)
+    return age_ms < BULK_DELETE_MAX_AGE_MS - BULK_DELETE_SAFETY_MS
@@ -0,0 +1,200 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Optional
+
+import discord
+from loguru import logger
+
+from del_spam.batcher import DeleteBatcher, PendingBatch
+from del_spam.snowflake import is_bulk_deletable
+
+if TYPE_CHECKING:
+    from del_spam.deleter import DeletionBudget, MessageDeleter
+
+# 受信から削除までの時間のヒストグラムの区切り(ミリ秒)
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 編集イベントで同じメッセージを二重に削除しないよう覚えておく件数
+SEEN_LIMIT = 10000
+
+
+class LatencyHistogram:
+    def __init__(self, bounds: tuple[int, ...] = LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms: float) -> None:
+        self.counts[bisect_left(self.bounds, latency_ms)] += 1
+        self.total += 1
+        self.sum_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """q 分位点を含む区間の上限(最後の区間は最大値)を返す"""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max_ms
+
+    def log_summary(self) -> None:
+        if not self.total:
+            logger.info("[LATENCY] No messages deleted yet")
+            return
+        logger.info(
+            f"[LATENCY] {self.total} message(s), "
+            f"mean {self.sum_ms / self.total:.0f}ms, "
+            f"p50 <= {self.percentile(0.5):.0f}ms, "
+            f"p95 <= {self.percentile(0.95):.0f}ms, "
+            f"max {self.max_ms:.0f}ms"
+        )
+        lower = 0
+        for bound, count in zip(self.bounds, self.counts):
+            if count:
+                logger.info(f"[LATENCY]   {lower:>5}-{bound}ms: {count}")
+            lower = bound
+        if self.counts[-1]:
+            logger.info(f"[LATENCY]   >{lower}ms: {self.counts[-1]}")
+
+
+class MessageWatcher:
+    """Gateway から受信したメッセージをその場で判定し、チャンネルごとにまとめて削除する"""
+
+    def __init__(
+        self,
+        deleter: "MessageDeleter",
+        rule_names: Optional[list[str]],
+        budget: "DeletionBudget",
+        guild_ids: Optional[set[int]] = None,
+        window: float = 0.5,
+        max_window: float = 2.0,
+        max_pending: int = 1000,
+    ):
+        self.deleter = deleter
+        self.rule_names = rule_names
+        # None なら読み込まれているすべてのルール(ルールの再読み込みにも追従する)
+        self._rule_set = None if rule_names is None else frozenset(rule_names)
+        self.budget = budget
+        self.guild_ids = guild_ids
+        self.latency = LatencyHistogram()
+        self.deleted_count = 0
+        self.batcher = DeleteBatcher(
+            deleter, budget, window, max_window, max_pending, on_flushed=self._record
+        )
+        self._seen: dict[int, None] = {}
+        # 削除件数の上限に達したことを、上限に達するたびに1回だけ警告する
+        self._limit_warned = False
+        self._tasks: set[asyncio.Task] = set()
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def on_message(self, message: discord.Message) -> None:
+        arrived = time.monotonic()
+        if message.guild is None:
+            return
+        if self.guild_ids is not None and message.guild.id not in self.guild_ids:
+            return
+        if message.id in self._seen:
+            return
+        if self.budget.exhausted:
+            self._warn_limit()
+            return
+        self._limit_warned = False
+
+        member = message.author if isinstance(message.author, discord.Member) else None
+        engine = self.deleter.filter_engine
+        rules = engine.get_matching_rules(message, member, rule_names=self._rule_set)
+        if rules:
+            self._delete(message, rules, arrived)
+        # duplicate の波がしきい値に達したら、それより前に届いた投稿も削除する
+        for earlier, earlier_rules in engine.take_duplicate_matches(self._rule_set):
+            if earlier.id not in self._seen:
+                self._delete(earlier, earlier_rules, arrived)
+
+    def _delete(
+        self, message: discord.Message, rules: list[str], arrived: float
+    ) -> None:
+        if not self.budget.reserve(1):
+            self._warn_limit()
+            return
+
+        self._seen[message.id] = None
+        if len(self._seen) > SEEN_LIMIT:
+            del self._seen[next(iter(self._seen))]
+        channel = message.channel
+        prefix = "[DRY RUN] Would delete" if self.deleter.dry_run else "[LIVE] Matched"
+        self.deleter.match_log.log(
+            lambda: (
+                f"{prefix} message {message.id} "
+                f"from {message.author} in #{channel.name}: "
+                f"{message.content[:50]} (rules: {', '.join(rules)})"
+            )
+        )
+        if self.deleter.dry_run:
+            self.deleted_count += 1
+            return
+
+        if not is_bulk_deletable(message.id):
+            # 編集された古いメッセージは一括削除できないので、待たずに1件で削除する
+            self._spawn(self._flush(PendingBatch(channel, [message.id], [arrived])))
+            return
+
+        self.batcher.add(channel, message.id, arrived)
+
+    def _warn_limit(self) -> None:
+        if self._limit_warned:
+            return
+        self._limit_warned = True
+        resets_in = getattr(self.budget, "resets_in", None)
+        until = (
+            "until the watcher is restarted"
+            if resets_in is None
+            else f"for the next {resets_in:.0f}s"
+        )
+        logger.warning(
+            f"[LIVE] Reached the deletion limit ({self.budget.limit}); "
+            f"matching messages are ignored {until}"
+        )
+
+    async def on_message_edit(
+        self, before: discord.Message, after: discord.Message
+    ) -> None:
+        # 編集後の本文でルールに一致するようになったメッセージも削除する
+        await self.on_message(after)
+
+    async def _flush(self, batch: PendingBatch) -> None:
+        deleted = await self.deleter._flush_batch(
+            batch.channel, batch.message_ids, self.budget
+        )
+        self._record(batch, deleted)
+
+    def _record(self, batch: PendingBatch, deleted: int) -> None:
+        self.deleted_count += deleted
+        if not deleted:
+            return
+        now = time.monotonic()
+        for arrived in batch.arrivals:
+            self.latency.record((now - arrived) * 1000)
+
+    async def report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.latency.log_summary()
+
+    async def close(self) -> None:
+        """保留中のバッチをすべて削除し、結果を記録する"""
+        await self.batcher.close()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.latency.log_summary()
+        logger.info(f"Watch mode stopped. Total: {self.deleted_count} messages")
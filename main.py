@@ -1,33 +1,129 @@
+import argparse
 import asyncio
 import sys
+import time
+from typing import TYPE_CHECKING, Optional
 
-import discord
 from loguru import logger
 
 import del_spam.config as config
-from del_spam.deleter import MessageDeleter
-from del_spam.filter import FilterEngine
+from del_spam.filter import FilterEngine, RuleConfigError, validate_rules
+from del_spam.metrics import Metrics
+from del_spam.plan_file import PlanBatch, read_plan
+from del_spam.rules_file import RuleFileWatcher, load_rules_file
 
+# discord.py(と aiohttp)の読み込みには時間がかかるので、Discord に接続するときだけ import する
+if TYPE_CHECKING:
+    import discord
 
-async def main():
-    logger.add("logs/file_{time}.log", rotation="1 week", enqueue=True)
-    logger.info("=== Discord Message Deleter ===")
+    from del_spam.deleter import MessageDeleter
 
-    filter_engine = FilterEngine()
-    filter_engine.load_all_rules(config.DELETE_RULES)
 
-    print("\n=== Available Rules ===")
-    enabled_rules = [
-        name for name, rule in config.DELETE_RULES.items() if rule.get("enabled", False)
-    ]
+def run_offline_dry_run(
+    filter_engine: FilterEngine, rule_names: list[str], max_deletions: int
+) -> int:
+    from del_spam.cache import MessageCache
+
+    cache = MessageCache(config.MESSAGE_CACHE_PATH)
+    matched_count = 0
+    for message, rules in filter_engine.scan_cache(rule_names, cache):
+        logger.info(
+            f"[DRY RUN] Would delete message {message.id} "
+            f"from {message.author} in channel {message.channel.id}: "
+            f"{message.content[:50]} (rules: {', '.join(rules)})"
+        )
+        matched_count += 1
+        if matched_count >= max_deletions:
+            logger.info(f"Reached maximum deletions limit ({max_deletions})")
+            break
+    cache.close()
+    return matched_count
 
-    if not enabled_rules:
-        logger.warning("No enabled rules found")
-        print("No enabled rules. Please enable a rule in config.py")
-        return
 
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Delete Discord messages matching the rules in config.py. "
+        "Without --rule/--all-enabled the rule is chosen interactively."
+    )
+    parser.add_argument(
+        "--rule",
+        dest="rules",
+        action="append",
+        metavar="NAME",
+        help="rule to run (repeatable; all rules share one history scan)",
+    )
+    parser.add_argument(
+        "--all-enabled", action="store_true", help="run every enabled rule"
+    )
+    parser.add_argument(
+        "--guild",
+        dest="guilds",
+        action="append",
+        type=int,
+        metavar="ID",
+        help="limit the scan to this guild (repeatable)",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_const",
+        const=True,
+        help="only log what would be deleted (overrides DRY_RUN)",
+    )
+    mode.add_argument(
+        "--execute",
+        dest="dry_run",
+        action="store_const",
+        const=False,
+        help="actually delete messages (overrides DRY_RUN)",
+    )
+    parser.add_argument(
+        "--max-deletions",
+        type=int,
+        metavar="N",
+        help="override MAX_DELETIONS_PER_RUN",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and delete new or edited messages as they arrive",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="split the channel scan across N worker processes "
+        "(shared deletion limit and rate limits; not with --watch)",
+    )
+    parser.add_argument(
+        "--execute-plan",
+        dest="plan",
+        metavar="PATH",
+        help="delete the messages listed in a deletion plan written by a dry run "
+        "(no history scan; combine with --execute to actually delete)",
+    )
+    parser.add_argument(
+        "--validate",
+        nargs="?",
+        const="",
+        metavar="PATH",
+        help="check and compile the rules (RULES_PATH/DELETE_RULES, or the rules "
+        "file PATH) and exit without connecting to Discord; exits 1 on errors",
+    )
+    return parser.parse_args(argv)
+
+
+def select_rule_interactively(
+    rules: dict[str, dict],
+    enabled_rules: list[str],
+    dry_run: bool,
+    max_deletions: int,
+) -> Optional[str]:
+    print("\n=== Available Rules ===")
     for i, rule_name in enumerate(enabled_rules, 1):
-        rule = config.DELETE_RULES[rule_name]
+        rule = rules[rule_name]
         print(f"{i}. {rule_name}: {rule.get('description', 'No description')}")
 
     print(f"{len(enabled_rules) + 1}. Exit")
@@ -39,7 +135,7 @@ async def main():
 
             if choice_num == len(enabled_rules) + 1:
                 logger.info("Exiting...")
-                return
+                return None
 
             if 1 <= choice_num <= len(enabled_rules):
                 selected_rule = enabled_rules[choice_num - 1]
@@ -49,14 +145,14 @@ async def main():
         except ValueError:
             print("Invalid input. Please enter a number.")
 
-    rule_config = config.DELETE_RULES[selected_rule]
+    rule_config = rules[selected_rule]
     print("\n=== Confirmation ===")
     print(f"Rule: {selected_rule}")
     print(f"Description: {rule_config.get('description', 'No description')}")
-    print(f"Dry Run: {config.DRY_RUN}")
-    print(f"Max Deletions: {config.MAX_DELETIONS_PER_RUN}")
+    print(f"Dry Run: {dry_run}")
+    print(f"Max Deletions: {max_deletions}")
 
-    if config.DRY_RUN:
+    if dry_run:
         print("\nThis is a DRY RUN - no messages will actually be deleted")
     else:
         print("\nWARNING: This will actually delete messages!")
@@ -67,31 +163,339 @@ async def main():
             break
         elif confirm in ["no", "n"]:
             logger.info("Operation cancelled by user")
-            return
+            return None
         else:
             print("invalid input. Please enter 'yes' or 'no'")
             break
 
-    logger.info("Connecting to Discord...")
-    bot = discord.Client(intents=discord.Intents.default())
+    return selected_rule
 
-    deleter = MessageDeleter(filter_engine)
+
+def load_rules(path: Optional[str]) -> dict[str, dict]:
+    """path(なければ RULES_PATH、それもなければ config.DELETE_RULES)のルールを検証して返す
+
+    誤りがあれば RuleConfigError を送出する。
+    """
+    if path:
+        return load_rules_file(path)
+    rules = config.DELETE_RULES
+    errors = validate_rules(rules)
+    if errors:
+        raise RuleConfigError(errors)
+    return rules
+
+
+def run_validate(path: Optional[str]) -> int:
+    """ルールを検証・コンパイルして結果を表示する(discord.py は読み込まない)"""
+    started = time.perf_counter()
+    source = path or "config.DELETE_RULES"
+    try:
+        rules = load_rules(path)
+    except RuleConfigError as e:
+        print(f"{source}: {len(e.errors)} error(s)", file=sys.stderr)
+        for error in e.errors:
+            print(f"  {error}", file=sys.stderr)
+        return 1
+
+    engine = FilterEngine()
+    engine.load_all_rules(rules)
+    never = [name for name in engine.filters if engine.scan_plan([name]).empty]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    enabled = sum(1 for rule in rules.values() if rule.get("enabled", False))
+    print(
+        f"{source}: OK, {len(rules)} rule(s) ({enabled} enabled) "
+        f"compiled in {elapsed_ms:.1f}ms"
+    )
+    for name in never:
+        print(f"  warning: rule {name!r} can never match any message")
+    return 0
+
+
+def client_intents() -> "discord.Intents":
+    import discord
+
+    intents = discord.Intents.default()
+    # ROLE フィルターでメンバーのロールをまとめて取得するには Server Members Intent が必要
+    intents.members = getattr(config, "MEMBERS_INTENT", False)
+    return intents
+
+
+def report_metrics(metrics: Metrics) -> None:
+    metrics.log_summary()
+    metrics_path = getattr(config, "METRICS_PATH", None)
+    if metrics_path:
+        metrics.write_json(metrics_path)
+
+
+async def run_once(
+    deleter: "MessageDeleter", rule_names: list[str], guild_ids: Optional[list[int]]
+) -> int:
+    import discord
+
+    logger.info("Connecting to Discord...")
+    bot = discord.Client(intents=client_intents())
+    exit_code = 0
 
     @bot.event
     async def on_ready():
+        nonlocal exit_code
         logger.info(f"Logged in as {bot.user}")
 
-        deleted_count = await deleter.delete_by_rule(bot, selected_rule)
-        logger.info(f"Total deleted: {deleted_count}")
+        guilds = None
+        if guild_ids:
+            guilds = [bot.get_guild(guild_id) for guild_id in guild_ids]
+            for guild_id, guild in zip(guild_ids, guilds):
+                if guild is None:
+                    logger.error(f"Guild not accessible: {guild_id}")
+                    exit_code = 2
+            guilds = [guild for guild in guilds if guild is not None]
 
-        await bot.close()
+        try:
+            deleted_count = await deleter.delete_by_rules(bot, rule_names, guilds)
+            logger.info(f"Total deleted: {deleted_count}")
+        finally:
+            await bot.close()
 
     await bot.start(config.DISCORD_TOKEN)
+    return exit_code
+
+
+async def run_plan(deleter: "MessageDeleter", batches: list[PlanBatch]) -> int:
+    import discord
+
+    logger.info("Connecting to Discord (REST only)...")
+    # 計画にあるチャンネルとメッセージを ID で直接扱うので、Gateway には接続しない
+    client = discord.Client(intents=client_intents())
+    try:
+        await client.login(config.DISCORD_TOKEN)
+        deleted_count = await deleter.delete_planned(client, batches)
+        logger.info(f"Total deleted: {deleted_count}")
+    finally:
+        await client.close()
+    return 0
+
+
+async def run_watch(
+    deleter: "MessageDeleter",
+    rule_names: Optional[list[str]],
+    guild_ids: Optional[list[int]],
+) -> int:
+    import discord
+
+    from del_spam.deleter import DeletionBudget, IntervalBudget
+    from del_spam.watcher import MessageWatcher
+
+    logger.info("Connecting to Discord (watch mode)...")
+    intents = client_intents()
+    # 受信したメッセージの本文をルールで判定するために必要
+    intents.message_content = True
+    bot = discord.Client(intents=intents)
+
+    # 常駐は終わらないので、上限は WATCH_DELETION_LIMIT_INTERVAL 秒ごとの件数にする
+    limit_interval = getattr(config, "WATCH_DELETION_LIMIT_INTERVAL", 3600.0)
+    if limit_interval:
+        budget = IntervalBudget(deleter.max_deletions, limit_interval)
+    else:
+        budget = DeletionBudget(deleter.max_deletions)
+    watcher = MessageWatcher(
+        deleter,
+        rule_names,
+        budget,
+        guild_ids=set(guild_ids) if guild_ids else None,
+        window=getattr(config, "WATCH_BATCH_WINDOW", 0.5),
+        max_window=getattr(config, "WATCH_MAX_BATCH_WINDOW", 2.0),
+        max_pending=getattr(config, "WATCH_MAX_PENDING", 1000),
+    )
+    report_task: Optional[asyncio.Task] = None
+    roles_task: Optional[asyncio.Task] = None
+
+    async def refresh_member_roles() -> None:
+        # ROLE フィルターのために対象サーバーのメンバーのロールを取得し、TTL ごとに取り直す
+        # (ルールの再読み込みで ROLE フィルターが増えても、次の取り直しで取得する)
+        engine = deleter.filter_engine
+        while True:
+            if engine.uses_roles(rule_names or list(engine.compiled)):
+                for guild in bot.guilds:
+                    if not guild_ids or guild.id in guild_ids:
+                        await deleter.member_roles.load(guild)
+            await asyncio.sleep(deleter.member_roles.ttl)
+
+    @bot.event
+    async def on_ready():
+        nonlocal report_task, roles_task
+        logger.info(f"Logged in as {bot.user}")
+        watched = ", ".join(rule_names) if rule_names else "all enabled rules"
+        logger.info(f"Watching for messages matching: {watched}")
+        if report_task is None:
+            # 再接続のたびに on_ready が呼ばれるので、レポートは1つだけ動かす
+            report_task = asyncio.create_task(
+                watcher.report(getattr(config, "WATCH_REPORT_INTERVAL", 300.0))
+            )
+        if roles_task is None:
+            roles_task = asyncio.create_task(refresh_member_roles())
+
+    @bot.event
+    async def on_message(message: discord.Message):
+        await watcher.on_message(message)
+
+    @bot.event
+    async def on_message_edit(before: discord.Message, after: discord.Message):
+        await watcher.on_message_edit(before, after)
+
+    try:
+        await bot.start(config.DISCORD_TOKEN)
+    finally:
+        for task in (report_task, roles_task):
+            if task is not None:
+                task.cancel()
+        # 接続を閉じる前に保留中のバッチを削除する
+        await watcher.close()
+        if not bot.is_closed():
+            await bot.close()
+    return 0
+
+
+async def main(argv: Optional[list[str]] = None) -> int:
+    args = parse_args(argv)
+    log_level = getattr(config, "LOG_LEVEL", "INFO")
+    logger.remove()
+    if args.validate is not None:
+        # CI やコミット前のフックで使うので、ログファイルは作らず警告以上だけを表示する
+        logger.add(sys.stderr, level="WARNING")
+        return run_validate(args.validate or getattr(config, "RULES_PATH", None))
+    logger.add(sys.stderr, level=log_level)
+    logger.add("logs/file_{time}.log", rotation="1 week", enqueue=True, level=log_level)
+    logger.info("=== Discord Message Deleter ===")
+
+    dry_run = config.DRY_RUN if args.dry_run is None else args.dry_run
+    max_deletions = (
+        config.MAX_DELETIONS_PER_RUN
+        if args.max_deletions is None
+        else args.max_deletions
+    )
+
+    if args.plan:
+        if args.watch or args.workers > 1:
+            logger.error("--execute-plan cannot be combined with --watch or --workers")
+            return 2
+        try:
+            header, batches = read_plan(args.plan)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot read deletion plan: {e}")
+            return 2
+        logger.info(
+            f"Deletion plan {args.plan}: {header.get('messages')} message(s) "
+            f"in {len(batches)} batch(es) (rules: {', '.join(header.get('rules', []))})"
+        )
+        from del_spam.deleter import MessageDeleter
+
+        # 計画にはルールの判定結果が入っているので、ルールは読み込まない
+        deleter = MessageDeleter(FilterEngine())
+        deleter.dry_run = dry_run
+        deleter.max_deletions = max_deletions
+        try:
+            return await run_plan(deleter, batches)
+        finally:
+            report_metrics(deleter.metrics)
+
+    rules_path = getattr(config, "RULES_PATH", None)
+    try:
+        rules = load_rules(rules_path)
+    except RuleConfigError as e:
+        logger.error(f"Invalid rules in {rules_path or 'config.DELETE_RULES'}:")
+        for error in e.errors:
+            logger.error(f"  {error}")
+        return 2
+
+    filter_engine = FilterEngine()
+    filter_engine.load_all_rules(rules)
+
+    enabled_rules = [name for name, rule in rules.items() if rule.get("enabled", False)]
+
+    if args.rules or args.all_enabled:
+        # ヘッドレス実行(cron など): 入力を待たずに指定されたルールをまとめて実行する
+        selected_rules = list(dict.fromkeys(args.rules or enabled_rules))
+        unknown = [name for name in selected_rules if name not in filter_engine.filters]
+        if unknown:
+            logger.error(f"Unknown or disabled rule(s): {', '.join(unknown)}")
+            return 2
+        if not selected_rules:
+            logger.warning("No enabled rules found")
+            return 1
+    else:
+        if not enabled_rules:
+            logger.warning("No enabled rules found")
+            print("No enabled rules. Please enable a rule in config.py or RULES_PATH")
+            return 0
+        selected_rule = select_rule_interactively(
+            rules, enabled_rules, dry_run, max_deletions
+        )
+        if selected_rule is None:
+            return 0
+        selected_rules = [selected_rule]
+
+    if (
+        dry_run
+        and not args.watch
+        and getattr(config, "OFFLINE_DRY_RUN", False)
+        and getattr(config, "MESSAGE_CACHE_PATH", None)
+    ):
+        logger.info("Evaluating rules against the local message cache (offline)")
+        matched_count = run_offline_dry_run(
+            filter_engine, selected_rules, max_deletions
+        )
+        logger.info(f"Total matched: {matched_count}")
+        return 0
+
+    if args.workers > 1:
+        if args.watch:
+            logger.error("--workers cannot be combined with --watch")
+            return 2
+        from del_spam.shard import run_sharded
+
+        total, exit_code, metrics = await run_sharded(
+            rules, selected_rules, args.guilds, dry_run, max_deletions, args.workers
+        )
+        logger.info(f"Total deleted: {total}")
+        report_metrics(metrics)
+        return exit_code
+
+    from del_spam.deleter import MessageDeleter
+
+    deleter = MessageDeleter(filter_engine)
+    deleter.dry_run = dry_run
+    deleter.max_deletions = max_deletions
+
+    metrics_server = None
+    metrics_port = getattr(config, "METRICS_PORT", None)
+    if metrics_port:
+        metrics_server = await deleter.metrics.serve(
+            getattr(config, "METRICS_HOST", "127.0.0.1"), metrics_port
+        )
+    reload_task: Optional[asyncio.Task] = None
+    if rules_path:
+        # 接続やキャッシュを保ったまま、ルールファイルの変更をバッチの合間に反映する
+        rule_watcher = RuleFileWatcher(
+            rules_path, filter_engine, getattr(config, "RULES_RELOAD_INTERVAL", 5.0)
+        )
+        reload_task = asyncio.create_task(rule_watcher.run())
+    try:
+        if args.watch:
+            # --all-enabled なら、再読み込みで追加・有効化されたルールも監視の対象にする
+            watch_rules = None if args.all_enabled and rules_path else selected_rules
+            return await run_watch(deleter, watch_rules, args.guilds)
+        return await run_once(deleter, selected_rules, args.guilds)
+    finally:
+        if reload_task is not None:
+            reload_task.cancel()
+        report_metrics(deleter.metrics)
+        if metrics_server is not None:
+            metrics_server.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        sys.exit(asyncio.run(main()))
     except KeyboardInterrupt:
         logger.info("Shutting down...")
         sys.exit(0)